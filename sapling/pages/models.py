@@ -20,7 +20,7 @@ class Page(models.Model):
     name = models.CharField(max_length=255, unique=True)
     slug = models.SlugField(max_length=255, editable=False, unique=True)
     content = HTML5FragmentField(allowed_elements=allowed_tags)
-    history = TrackChanges()
+    history = TrackChanges(head_table=True, metadata_listings=True)
 
     def save(self, *args, **kwargs):
         self.slug = slugify(self.name)
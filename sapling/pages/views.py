@@ -3,7 +3,7 @@ from forms import PageForm
 from django.views.generic.simple import direct_to_template
 from django.views.generic import DetailView, UpdateView, ListView
 
-from django.http import HttpResponseNotFound
+from django.http import HttpResponseNotFound, Http404
 from django.core.urlresolvers import reverse
 from utils.views import Custom404Mixin, CreateObjectMixin
 from django.shortcuts import get_object_or_404, redirect
@@ -22,7 +22,8 @@ class PageDetailView(Custom404Mixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(PageDetailView, self).get_context_data(**kwargs)
-        context['date'] = self.object.history.most_recent().history_info.date
+        history = self.object.history.metadata()
+        context['date'] = history.most_recent().history_info.date
         return context
 
 
@@ -55,14 +56,28 @@ class PageUpdateView(CreateObjectMixin, UpdateView):
 class PageHistoryView(ListView):
     context_object_name = "version_list"
     template_name = "pages/page_history.html"
+    per_page = 50
 
     def get_queryset(self):
         self.page = get_object_or_404(Page, slug__exact=self.kwargs['slug'])
-        return self.page.history.all()
+        after = self.request.GET.get('after')
+        try:
+            if after is not None:
+                after = int(after)
+            # Grab one extra to see if there's another page.
+            versions = self.page.history.page(self.per_page + 1, after=after)
+        except (ValueError, self.page.history.model.DoesNotExist):
+            raise Http404
+        self.has_older = len(versions) > self.per_page
+        self.after = after
+        return versions[:self.per_page]
 
     def get_context_data(self, **kwargs):
         context = super(PageHistoryView, self).get_context_data(**kwargs)
         context['page'] = self.page
+        context['is_first_page'] = self.after is None
+        if self.has_older:
+            context['older_after'] = self.object_list[-1].history_id
         return context
 
 
@@ -78,9 +93,21 @@ def compare(request, slug, version1=None, version2=None, **kwargs):
     new = max(versions)
     if len(versions) == 1:
         old = max(new - 1, 1)
-    old_version = page.history.as_of(version=old)
-    new_version = page.history.as_of(version=new)
-    context = {'old': old_version, 'new': new_version, 'page': page}
+    # Compare the digests before loading the versions' content, which
+    # we don't need if they're identical.
+    history = page.history.metadata()
+    old_version = history.as_of(version=old)
+    new_version = history.as_of(version=new)
+    identical = (old_version.history_info.digest is not None and
+                 old_version.history_info.digest ==
+                 new_version.history_info.digest)
+    if not identical:
+        loaded = page.history.in_bulk([old_version.history_id,
+                                       new_version.history_id])
+        old_version = loaded[old_version.history_id]
+        new_version = loaded[new_version.history_id]
+    context = {'old': old_version, 'new': new_version, 'page': page,
+               'identical': identical}
     return direct_to_template(request, 'pages/page_diff.html', context)
 
 
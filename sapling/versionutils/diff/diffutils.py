@@ -8,6 +8,7 @@ from django.conf import settings
 import diff_match_patch
 import daisydiff
 from versionutils.versioning.utils import is_historical_instance
+from versionutils.versioning.utils import digested_fields
 
 class DiffUtilNotFound(Exception):
     """
@@ -134,6 +135,10 @@ class BaseModelDiff(object):
     """
     fields = None
     excludes = ()
+    # Set when the instances are known to be the same, e.g. historical
+    # records with the same digest, so the fields the digest covers
+    # needn't be compared.
+    identical = False
 
     def __init__(self, model1, model2):
         """
@@ -207,6 +212,9 @@ class BaseModelDiff(object):
                 diff_class = name[1]
             diff_utils[field] = diff_class
 
+        digested = ()
+        if self.identical:
+            digested = digested_fields(self.model1.__class__)
         for field, diff_class in diff_utils.items():
             if not (isinstance(field, (models.AutoField,
                                        ))
@@ -214,6 +222,10 @@ class BaseModelDiff(object):
                 if field.name in self.excludes:
                     continue
 
+                if self.identical and field in digested:
+                    value = getattr(self.model1, field.name)
+                    diff[field.name] = diff_class(value, value)
+                    continue
                 diff[field.name] = diff_class(
                     getattr(self.model1, field.name),
                     getattr(self.model2, field.name)
@@ -463,6 +475,11 @@ def diff(object1, object2):
           '</td>
           '</tr>')
 
+    Historical instances with the same digest are identical, so the
+    fields the digest covers aren't compared.  To skip loading versions
+    that turn out to be identical, compare their history_digest first,
+    e.g. using values_list() or history.metadata().
+
     Returns:
         An object that can be used to display differences.  Object will be
         either BaseModelDiff or a subclass.
@@ -471,12 +488,29 @@ def diff(object1, object2):
         DiffUtilNotFound: If there's no registered or inferred diff for
         the objects.
     """
+    identical = _same_digest(object1, object2)
     if is_historical_instance(object1): 
         object1 = object1.history_info._object
     if is_historical_instance(object2): 
         object2 = object2.history_info._object
-    diff_util = registry.get_diff_util(object1.__class__)
-    return diff_util(object1, object2)
+    diff_util = registry.get_diff_util(object1.__class__)(object1, object2)
+    diff_util.identical = identical
+    return diff_util
+
+
+def _same_digest(object1, object2):
+    """
+    Returns:
+        True if both objects are historical instances of the same model
+        and their stored digests say they're identical.
+    """
+    if not (is_historical_instance(object1) and
+            is_historical_instance(object2)):
+        return False
+    if object1._original_model is not object2._original_model:
+        return False
+    digest = object1.history_info.digest
+    return digest is not None and digest == object2.history_info.digest
 
 
 # Built-in diff utils provided for some of the Django field types.
@@ -108,6 +108,27 @@ class ModelDiffTest(TestCase):
         o2 = M5Versioned(a="O2")
         o2.save()
 
+    def test_historical_identical(self):
+        """
+        Historical instances with the same digest are identical without
+        comparing their fields.
+        """
+        o1 = M5Versioned(a="O1")
+        o1.save()
+        o1.save()
+        h1, h2 = o1.history.all()
+        with self.assertNumQueries(0):
+            d = diff.diff(h1, h2)
+            self.assertEqual(d.as_dict(), None)
+            self.assertTrue('No differences' in d.as_html())
+        # The diff still has the objects themselves.
+        self.assertEqual((d.model1.a, d.model2.a), ("O1", "O1"))
+        self.assertEqual(d.get_diff()['a'].field1, "O1")
+        o1.a = "O2"
+        o1.save()
+        d = diff.diff(h1, o1.history.most_recent()).as_dict()
+        self.assertTrue(d['a'])
+
 class BaseFieldDiffTest(TestCase):
     test_class = BaseFieldDiff
 
@@ -1 +1,4 @@
 from models import TrackChanges
+from manager import TrackedManager
+from history_model_methods import prefetch_history_related
+from coalesce import coalesce_history
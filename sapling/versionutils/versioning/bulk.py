@@ -0,0 +1,61 @@
+"""
+Multi-row INSERTs.
+
+Django can only insert a single row per query, which makes writing
+historical records for thousands of objects at once painfully slow.
+"""
+from django.db import connections, transaction
+from django.db.models import AutoField
+
+# Rows per INSERT statement.
+DEFAULT_BATCH_SIZE = 500
+# SQLite limits the number of parameters in a single statement.
+SQLITE_MAX_VARIABLES = 999
+
+
+def bulk_insert(model, objs, using='default'):
+    """
+    Inserts the model instances using as few INSERT statements as
+    possible.
+
+    Like QuerySet.update(), this doesn't call save() or send any
+    signals.  Automatically assigned primary keys are left unset on the
+    provided instances.
+
+    Args:
+        model: The model class to insert rows for.
+        objs: A list of unsaved instances of model.
+        using: The database alias to write to.
+    """
+    if not objs:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    fields = model._meta.local_fields
+    pk = model._meta.pk
+    if isinstance(pk, AutoField):
+        pk_values = [getattr(obj, pk.attname) for obj in objs]
+        if None in pk_values:
+            # Let the database assign primary keys.
+            fields = [f for f in fields if f is not pk]
+
+    batch_size = DEFAULT_BATCH_SIZE
+    if connection.vendor == 'sqlite':
+        batch_size = max(1, SQLITE_MAX_VARIABLES // len(fields))
+
+    columns = ', '.join([qn(f.column) for f in fields])
+    row_sql = '(%s)' % ', '.join(['%s'] * len(fields))
+    cursor = connection.cursor()
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i + batch_size]
+        params = []
+        for obj in batch:
+            for f in fields:
+                value = f.pre_save(obj, True)
+                params.append(f.get_db_prep_save(value, connection=connection))
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (
+            qn(model._meta.db_table), columns,
+            ', '.join([row_sql] * len(batch)))
+        cursor.execute(sql, params)
+    transaction.commit_unless_managed(using=using)
@@ -0,0 +1,183 @@
+"""
+An optional cache of historical lookups that lives for the length of a
+request.
+
+The cache is off unless enabled, e.g. by ``HistoryCacheMiddleware``.
+It's kept per-thread and is invalidated whenever a historical record is
+written to a historical model.
+
+Along with the latest history_id of objects, it holds an identity map
+of the historical instances looked up during the request, by history_id
+and by the object they're the most recent version of, and the keyframes
+of delta fields (see versionutils.versioning.delta).  The identity map
+hands out copies of its instances, so callers can't change each other's.
+"""
+import copy
+import threading
+
+_local = threading.local()
+
+
+def enable():
+    """
+    Turns on the cache for the current thread, starting out empty.
+    """
+    _local.latest_ids = {}
+    _local.instances = {}
+    _local.heads = {}
+    _local.keyframes = {}
+
+
+def disable():
+    """
+    Turns off and empties the cache for the current thread.
+    """
+    for name in ('latest_ids', 'instances', 'heads', 'keyframes'):
+        _local.__dict__.pop(name, None)
+
+
+def is_enabled():
+    return hasattr(_local, 'latest_ids')
+
+
+def get_latest_ids(history_model, field_name, values):
+    """
+    Args:
+        history_model: A historical model.
+        field_name: Name of the field the values are values of, e.g.
+            'id'.
+        values: A list of values identifying objects of the historical
+            model's model.
+
+    Returns:
+        A tuple (found, missing).  found is a dictionary mapping the values
+        we have cached to the history_id of the most recent historical
+        record of that object.  missing is a list of the values we don't
+        have cached.
+    """
+    if not is_enabled():
+        return {}, list(values)
+    cached = _local.latest_ids.get(history_model, {})
+    found, missing = {}, []
+    for value in values:
+        if (field_name, value) in cached:
+            found[value] = cached[(field_name, value)]
+        else:
+            missing.append(value)
+    return found, missing
+
+
+def set_latest_ids(history_model, field_name, latest_ids):
+    """
+    Args:
+        history_model: A historical model.
+        field_name: Name of the field the values are values of.
+        latest_ids: A dictionary mapping values identifying objects to
+            the history_id of their most recent historical record.
+    """
+    if not is_enabled():
+        return
+    cached = _local.latest_ids.setdefault(history_model, {})
+    for value, history_id in latest_ids.iteritems():
+        cached[(field_name, value)] = history_id
+
+
+def get_instance(history_model, history_id):
+    """
+    Returns:
+        A copy of the cached historical instance of history_model with the
+        provided history_id, or None.
+    """
+    if not is_enabled():
+        return None
+    hm = _local.instances.get(history_model, {}).get(history_id)
+    if hm is None:
+        return None
+    return copy.deepcopy(hm)
+
+
+def set_instance(history_model, hm):
+    """
+    Args:
+        history_model: A historical model.
+        hm: An instance of history_model to cache.
+    """
+    if not is_enabled():
+        return
+    instances = _local.instances.setdefault(history_model, {})
+    instances[hm.history_id] = copy.deepcopy(hm)
+
+
+def get_head(history_model, key):
+    """
+    Args:
+        history_model: A historical model.
+        key: The head key of an object, see HistoryManager.head_key().
+
+    Returns:
+        A copy of the cached most recent historical instance of the
+        object, or None.
+    """
+    if not is_enabled():
+        return None
+    history_id = _local.heads.get(history_model, {}).get(key)
+    return get_instance(history_model, history_id)
+
+
+def set_head(history_model, key, hm):
+    """
+    Caches hm as the most recent historical instance of the object with
+    the provided head key.
+    """
+    if not is_enabled():
+        return
+    set_instance(history_model, hm)
+    _local.heads.setdefault(history_model, {})[key] = hm.history_id
+
+
+def get_keyframe(history_model, history_id):
+    """
+    Returns:
+        The cached values of the delta fields of the keyframe record of
+        history_model with the provided history_id, or None.
+    """
+    if not is_enabled():
+        return None
+    return _local.keyframes.get(history_model, {}).get(history_id)
+
+
+def set_keyframe(history_model, history_id, values):
+    """
+    Args:
+        history_model: A historical model with delta fields.
+        history_id: The history_id of a keyframe record.
+        values: A dictionary mapping attnames of the delta fields to their
+            full text in the keyframe record.
+    """
+    if not is_enabled():
+        return
+    _local.keyframes.setdefault(history_model, {})[history_id] = values
+
+
+def forget_keyframe(history_model, history_id):
+    if not is_enabled():
+        return
+    _local.keyframes.get(history_model, {}).pop(history_id, None)
+
+
+def invalidate(history_model):
+    """
+    Forgets everything cached about history_model.  Call this after
+    writing historical records to it.
+    """
+    if not is_enabled():
+        return
+    # Historical records of a subclass are also records of the parent
+    # historical models.
+    parents = list(history_model._meta.get_parent_list())
+    for model in [history_model] + parents:
+        _local.latest_ids.pop(model, None)
+        _local.instances.pop(model, None)
+        _local.heads.pop(model, None)
+        # A rolled back record's history_id may be handed out again.
+        _local.keyframes.pop(model, None)
@@ -0,0 +1,193 @@
+"""
+Transaction-scoped coalescing of historical records.
+
+Saving the same object several times in one go, e.g. saving it and then
+saving it again after some post-processing, normally writes a historical
+record per save.  Inside coalesce_history(), the records are held back
+until the transaction commits, and then a single record is written per
+object: its last state, with the comments of all the saves.  If the
+transaction is rolled back, the held back records are dropped with it.
+"""
+import sys
+import threading
+from functools import wraps
+
+from django.db import models, transaction
+
+from constants import *
+from utils import snapshot_of
+
+_local = threading.local()
+
+DELETED_TYPES = (TYPE_DELETED, TYPE_REVERTED_DELETED)
+ADDED_TYPES = (TYPE_ADDED, TYPE_REVERTED_ADDED)
+
+
+class coalesce_history(object):
+    """
+    Like transaction.commit_on_success, and usable in the same ways,
+    e.g.::
+
+        with coalesce_history():
+            page.save()
+            ...
+            page.save(comment="Updated links")
+
+    writes one historical record of the page.  Nested blocks are part of
+    the outermost block's transaction: they don't commit when they exit,
+    and their records are held back until the outermost block exits.  If
+    the outermost block raises, the transaction is rolled back, changes
+    made in nested blocks and all, and the records are dropped.
+
+    Historical records held back aren't visible to history lookups until
+    the block exits.
+    """
+    def __init__(self, using=None):
+        self.using = using
+
+    def __enter__(self):
+        buffers = _buffers()
+        if buffers:
+            # Part of the outermost block's transaction.
+            buffers.append(_Buffer())
+            return
+        buffer = _Buffer(transaction.commit_on_success(using=self.using))
+        buffer.transaction.__enter__()
+        buffers.append(buffer)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        buffer = _buffers().pop()
+        if _buffers():
+            # Whatever the nested block did is still part of the
+            # transaction, so its records go with the transaction, too.
+            _buffers()[-1].merge(buffer)
+            return
+        if exc_type is None:
+            try:
+                buffer.write()
+            except:
+                buffer.transaction.__exit__(*sys.exc_info())
+                raise
+        buffer.transaction.__exit__(exc_type, exc_value, traceback)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return inner
+
+
+def is_active():
+    return bool(getattr(_local, 'buffers', None))
+
+
+def hold(tracker, instance, type):
+    """
+    Holds back a historical record of the instance, as it is now, until
+    the coalesce_history() block exits.
+
+    Args:
+        tracker: The TrackChanges of the instance's model.
+        instance: The saved or deleted instance.
+        type: The history type to record, e.g. TYPE_UPDATED.
+    """
+    snapshot = snapshot_of(instance)
+    snapshot._save_with = dict(getattr(instance, '_save_with', {}))
+    _buffers()[-1].add(tracker, snapshot, type)
+
+
+def write_held():
+    """
+    Writes the historical records held back so far, e.g. before changes
+    that apply to the most recent historical records.
+    """
+    for buffer in _buffers():
+        buffer.write()
+
+
+def _buffers():
+    if not hasattr(_local, 'buffers'):
+        _local.buffers = []
+    return _local.buffers
+
+
+def _coalesced_type(first, last):
+    """
+    Returns:
+        The history type of the single record standing in for an object's
+        records of types first, ..., last, or None if the object came
+        and went, so there's nothing to record.
+    """
+    if first in ADDED_TYPES:
+        if last in DELETED_TYPES:
+            return None
+        return first
+    if first in DELETED_TYPES and last in ADDED_TYPES:
+        # Deleted and re-created.
+        return TYPE_UPDATED
+    return last
+
+
+def _combined_comment(history_model, first, last):
+    comments = []
+    for comment in (first, last):
+        if comment and comment not in comments:
+            comments.append(comment)
+    if not comments:
+        return None
+    combined = '; '.join(comments)
+    try:
+        field = history_model._meta.get_field('history_comment')
+    except models.FieldDoesNotExist:
+        return combined
+    return combined[:field.max_length]
+
+
+class _Buffer(object):
+    def __init__(self, transaction_block=None):
+        # The commit_on_success of the outermost block, None for nested
+        # blocks.
+        self.transaction = transaction_block
+        # (history model, pk) -> [tracker, snapshot, first type, last type]
+        self.entries = {}
+        # Keys of entries, in the order the objects were first saved.
+        self.order = []
+
+    def add(self, tracker, snapshot, type, first_type=None):
+        history_model = getattr(snapshot.__class__, tracker.manager_name).model
+        key = (history_model, snapshot.pk)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [tracker, snapshot, first_type or type, type]
+            self.order.append(key)
+            return
+        comment = _combined_comment(history_model,
+            entry[1]._save_with.get('comment'),
+            snapshot._save_with.get('comment'))
+        if comment is not None:
+            snapshot._save_with['comment'] = comment
+        entry[1] = snapshot
+        entry[3] = type
+
+    def merge(self, other):
+        for key in other.order:
+            tracker, snapshot, first_type, last_type = other.entries[key]
+            self.add(tracker, snapshot, last_type, first_type)
+
+    def write(self):
+        order, entries = self.order, self.entries
+        self.order, self.entries = [], {}
+        # Written outside of any buffer, so they aren't held back again.
+        buffers, _local.buffers = _local.buffers, []
+        try:
+            for key in order:
+                tracker, snapshot, first_type, last_type = entries[key]
+                type = _coalesced_type(first_type, last_type)
+                if type is None:
+                    continue
+                hm = tracker.create_historical_record(snapshot, type)
+                if hm is not None and type in (TYPE_UPDATED, TYPE_REVERTED):
+                    tracker.m2m_init(snapshot, hm)
+        finally:
+            _local.buffers = buffers
@@ -0,0 +1,148 @@
+"""
+Delta-compressed storage for large text fields on historical models.
+
+Every so often a historical record is written as a keyframe, holding
+the full text of its delta fields.  The records in between store their
+delta fields as a patch against the most recent keyframe and point to it
+with history_keyframe.  Reading the field on a historical instance
+applies the patch, so this is invisible unless you look at the raw
+column (e.g. via values()).
+
+Keyframes are kept in the request's cache, if enabled, so that reading
+many versions patched against the same keyframe reads it only once.
+"""
+from versionutils.diff.diff_match_patch import diff_match_patch
+
+import cache
+
+
+def make_delta_field(field):
+    """
+    Turns a (copied) TextField into one that stores patches.  We
+    subclass the field's own class so the diff utils registered for it
+    keep working.
+    """
+    cls = field.__class__
+
+    def contribute_to_class(self, model, name):
+        cls.contribute_to_class(self, model, name)
+        setattr(model, self.attname, DeltaDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        # Save what's stored rather than the reconstructed text.
+        return model_instance.__dict__.get(self.attname)
+
+    field.__class__ = type('Delta%s' % cls.__name__, (cls,), {
+        '__module__': cls.__module__,
+        'contribute_to_class': contribute_to_class,
+        'pre_save': pre_save,
+    })
+    return field
+
+
+class DeltaDescriptor(object):
+    """
+    Holds the stored value of a delta field and reconstructs the full
+    text from it when read.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        decoded = '_delta_%s' % attname
+        if decoded not in instance.__dict__:
+            value = instance.__dict__.get(attname)
+            keyframe_id = instance.__dict__.get('history_keyframe')
+            if keyframe_id is not None and value is not None:
+                keyframe = get_keyframe(instance.__class__, keyframe_id)
+                value = decode(keyframe[attname] or u'', value)
+            instance.__dict__[decoded] = value
+        return instance.__dict__[decoded]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+        instance.__dict__.pop('_delta_%s' % self.field.attname, None)
+
+
+def encode(keyframe_text, text):
+    """
+    Returns:
+        A patch that turns keyframe_text into text, or None if the patch
+        can't be trusted to reproduce text.
+    """
+    dmp = diff_match_patch()
+    patch = dmp.patch_toText(dmp.patch_make(keyframe_text, text))
+    if decode(keyframe_text, patch) != text:
+        return None
+    return patch
+
+
+def decode(keyframe_text, patch):
+    dmp = diff_match_patch()
+    text, results = dmp.patch_apply(dmp.patch_fromText(patch), keyframe_text)
+    return text
+
+
+def get_keyframe(history_model, history_id):
+    """
+    Returns:
+        A dictionary mapping attnames of the delta fields to their full
+        text in the keyframe record history_id.
+    """
+    values = cache.get_keyframe(history_model, history_id)
+    if values is None:
+        attnames = [f.attname for f in history_model._delta_fields]
+        values = history_model.objects.filter(history_id=history_id).values(
+            *attnames)[0]
+        remember_keyframe(history_model, history_id, values)
+    return values
+
+
+def remember_keyframe(history_model, history_id, values):
+    cache.set_keyframe(history_model, history_id, values)
+
+
+def forget_keyframe(history_model, history_id):
+    cache.forget_keyframe(history_model, history_id)
+
+
+def release_keyframe(history_model, hm):
+    """
+    Called before the historical record hm is deleted.  If hm is a
+    keyframe, the oldest record patched against it becomes the new
+    keyframe and the rest are patched against that instead.
+    """
+    forget_keyframe(history_model, hm.history_id)
+    # Read from the database, as hm may have been made a keyframe since it
+    # was loaded, e.g. when its own keyframe was deleted.
+    stored = history_model.objects.filter(history_id=hm.history_id)
+    if list(stored.values_list('history_keyframe', flat=True)) != [None]:
+        return
+    dependents = list(history_model.objects.filter(
+        history_keyframe=hm.history_id).order_by('history_id'))
+    if not dependents:
+        return
+    attnames = [f.attname for f in history_model._delta_fields]
+    # Reconstruct everything while the old keyframe is still around.
+    texts = [dict([(a, getattr(d, a)) for a in attnames])
+             for d in dependents]
+
+    new_keyframe = dependents[0].history_id
+    history_model.objects.filter(history_id=new_keyframe).update(
+        history_keyframe=None, **texts[0])
+    for d, values in zip(dependents[1:], texts[1:]):
+        patches = {'history_keyframe': new_keyframe}
+        for a in attnames:
+            if values[a] is None:
+                patches[a] = None
+                continue
+            patches[a] = encode(texts[0][a] or u'', values[a])
+            if patches[a] is None:
+                # Can't patch, so store this one in full as well.
+                patches = dict(values, history_keyframe=None)
+                break
+        history_model.objects.filter(history_id=d.history_id).update(
+            **patches)
@@ -9,11 +9,11 @@ import datetime
 
 from django.db import models
 from django.db.models import Max
-from django.utils.functional import SimpleLazyObject
 from django.db.models.sql.constants import LOOKUP_SEP
 
 from constants import *
 from utils import *
+import cache
 
 
 def get_history_methods(self, model):
@@ -27,9 +27,6 @@ def get_history_methods(self, model):
         'history_info': HistoricalMetaInfo(),
         'revert_to': revert_to,
         '__init__': historical_record_init,
-        '__getattribute__':
-            # not sure why functools.partial doesn't work here
-            lambda m, name: historical_record_getattribute(model, m, name),
     }
 
     return fields
@@ -48,13 +45,20 @@ def get_history_fields(self, model):
         'history_id': models.AutoField(primary_key=True),
         'history__object': HistoricalObjectDescriptor(model),
         'history_date': models.DateTimeField(default=datetime.datetime.now),
-        'history_version_number': version_number_of,
+        # Stored rather than computed so that listing many versions
+        # doesn't require counting the rows that came before each one.
+        'history_version_number': models.PositiveIntegerField(null=True,
+                                                              db_index=True),
         'history_type': models.SmallIntegerField(choices=TYPE_CHOICES),
+        # A digest of the object's field values, so we can tell whether
+        # two versions are the same without comparing them field by field.
+        'history_digest': models.CharField(max_length=40, null=True,
+                                           db_index=True),
         'history_type_verbose': type_to_verbose,
         # If you want to display "Reverted to version N" in every change
         # comment then you should stash that in the comment field
         # directly rather than using
-        # reverted_to_version.version_number() on each display.
+        # reverted_to_version.version_number on each display.
         'history_reverted_to_version': models.ForeignKey('self', null=True),
     }
 
@@ -73,6 +77,8 @@ def historical_record_init(m, *args, **kws):
         base = kws.get('__class__').__base__
     else:
         base = m.__class__.__base__
+        if '_reverse_lookups' not in m.__class__.__dict__:
+            add_reverse_lookups(m.__class__)
 
     if is_historical_instance(base):
         kws['__class__'] = base
@@ -80,139 +86,209 @@ def historical_record_init(m, *args, **kws):
         if kws.get('__class__'):
             del kws['__class__']
 
-    retval = base.__init__(m, *args, **kws)
-    m._direct_lookup_fields = {}
-    _wrap_reverse_lookups(m)
-    return retval
+    return base.__init__(m, *args, **kws)
 
 
-def _wrap_reverse_lookups(m):
+def add_reverse_lookups(history_model):
     """
     Make reverse foreign key lookups return historical versions
     if the model is versioned.
 
+    We do this when the first instance of the historical model is
+    created rather than along with the historical model, as the models
+    pointing at it may not have been defined yet.
+
     Args:
-        m: A historical record instance.
+        history_model: A historical model class.
     """
-    def _reverse_set_lookup(m, rel_o):
-        attr = rel_o.field.name
-        parent_model = rel_o.model
-        as_of = m.history_info.date
-        parent_pk_att = parent_model._meta.pk.attname
-
-        # Find unique fields of the base (non-historical) model
-        # or use the pk.  We use unique fields, if available, because
-        # the underlying pk can change through delete -> recreation
-        # cycles while the unique fields stay the same.
-        unique_values = unique_lookup_values_for(m.history_info._object)
-        if not unique_values:
-            pk_att = m.history_info._object._meta.pk.attname
-            pk_val = getattr(m.history_info._object, pk_att)
-            unique_values = {pk_att: pk_val}
-
-        # Construct something like {'b__email':'a@example.org', ...}
-        # from the unique fields of the base model.
-        new_unique_values = {}
-        for k, v in unique_values.iteritems():
-            new_unique_values['%s%s%s' % (attr, LOOKUP_SEP, k)] = v
-        unique_values = new_unique_values
-
-        # Grab parent history objects that are less than the as_of date
-        # that point at the base model.
-        qs = parent_model.history.filter(
-            history_date__lte=as_of,
-            **unique_values
-        )
-        # Then group by the parent_pk
-        qs = qs.order_by(parent_pk_att).values(parent_pk_att).distinct()
-        # then annotate the maximum history object id
-        ids = qs.annotate(Max('history_id'))
-        history_ids = [v['history_id__max'] for v in ids]
-        # return a QuerySet containing the proper history objects
-        return parent_model.history.filter(history_id__in=history_ids)
-
-    def _reverse_attr_lookup(m, rel_o):
-        attr = rel_o.field.name
-        parent_model = rel_o.model
-        as_of = m.history_info.date
-        is_subclass = False
-
-        # Find unique values of the base (non-historical) model.
-        unique_values = unique_lookup_values_for(m.history_info._object)
-        if not unique_values:
-            # Check to see if this is a subclass relation with a
-            # historical model.
-            for k, v in rel_o.opts.parents.iteritems():
-                if is_versioned(k):
-                    # Cheap comparison hack.
-                    is_subclass = v.related.__dict__ == rel_o.__dict__
-
-            pk_att = m.history_info._object._meta.pk.attname
-            if is_subclass:
-                # For subclassed historical models' implicit OneToOne
-                # relation we want to use the id of the historical
-                # model when the related object is also versioned.
-                pk_val = getattr(m, 'history_id')
-            else:
-                pk_val = getattr(m.history_info._object, pk_att)
-            unique_values = {pk_att: pk_val}
-
-        # Construct something like {'b__email':'a@example.org', ...}
-        # from the unique fields of the base model.
-        new_unique_values = {}
-        for k, v in unique_values.iteritems():
-            new_unique_values['%s%s%s' % (attr, LOOKUP_SEP, k)] = v
-        unique_values = new_unique_values
-
-        try:
-            obj = parent_model.history.filter(
-                history_date__lte=as_of,
-                **unique_values
-            )[0]
-        except IndexError:
-            raise parent_model.history.model.DoesNotExist(
-                "%s matching query does not exist." %
-                parent_model.history.model._meta.object_name)
-        return obj
-
-    model_meta = m.history_info._object._meta
+    model_meta = history_model.history__object.model._meta
     related_objects = model_meta.get_all_related_objects()
     related_objects += model_meta.get_all_related_many_to_many_objects()
     related_versioned = [o for o in related_objects if is_versioned(o.model)]
     for rel_o in related_versioned:
-        # Set the accessor to a lazy lookup function that, when
-        # accessed, looks up the proper related set.
-        accessor = rel_o.get_accessor_name()
+        setattr(history_model, rel_o.get_accessor_name(),
+                ReverseLookupDescriptor(rel_o))
+    history_model._reverse_lookups = [
+        o.get_accessor_name() for o in related_versioned]
 
-        if isinstance(rel_o.field, models.OneToOneField):
-            # OneToOneFields have a direct lookup (not a set).
-            _reverse_lookup = partial(_reverse_attr_lookup, m, rel_o)
-        else:
-            _reverse_lookup = partial(_reverse_set_lookup, m, rel_o)
-        m._direct_lookup_fields[accessor] = SimpleLazyObject(_reverse_lookup)
 
+class ReverseLookupDescriptor(object):
+    """
+    Looks up the related set (or, for OneToOneFields, the related
+    object) of a historical instance as it was at the time of the
+    historical instance.
 
-def historical_record_getattribute(model, m, name):
+    The result is kept in the instance's __dict__, which takes precedence
+    over this descriptor from then on.
     """
-    We have to define our own __getattribute__ because otherwise there's
-    no way to set our wrapped foreign key attributes.
+    def __init__(self, rel_o):
+        self.rel_o = rel_o
 
-    If we try and set
-    history_instance.att = SimpleLazyObject(_lookup_proper_fk_version)
-    we'll get an error because Django does an isinstance() check on
-    assignment to model fields. Additionally, the __set__ method on
-    related fields will force evaluation due to equality checks.
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if isinstance(self.rel_o.field, models.OneToOneField):
+            # OneToOneFields have a direct lookup (not a set).
+            value = _reverse_attr_lookup(instance, self.rel_o)
+        else:
+            value = _reverse_set_lookup(instance, self.rel_o)
+        instance.__dict__[self.rel_o.get_accessor_name()] = value
+        return value
+
+
+def _reverse_set_lookup(m, rel_o):
+    attr = rel_o.field.name
+    parent_model = rel_o.model
+    as_of = m.history_info.date
+    parent_pk_att = parent_model._meta.pk.attname
+
+    # Construct something like {'b__email':'a@example.org', ...}
+    # from the unique fields of the base model.
+    unique_values = {}
+    for k, v in _unique_values_of(m).iteritems():
+        unique_values['%s%s%s' % (attr, LOOKUP_SEP, k)] = v
+
+    # Grab parent history objects that are less than the as_of date
+    # that point at the base model.
+    qs = parent_model.history.filter(
+        history_date__lte=as_of,
+        **unique_values
+    )
+    # Then group by the parent_pk and pick the maximum history object
+    # id of each, as a subquery.
+    latest = qs.order_by().values(parent_pk_att).annotate(
+        Max('history_id')).values('history_id__max')
+    # return a QuerySet containing the proper history objects
+    return parent_model.history.filter(history_id__in=latest)
+
+
+def _unique_values_of(m):
+    """
+    Returns:
+        A {name: value} dictionary identifying the object the historical
+        instance m is a version of.
+    """
+    # Find unique fields of the base (non-historical) model
+    # or use the pk.  We use unique fields, if available, because
+    # the underlying pk can change through delete -> recreation
+    # cycles while the unique fields stay the same.
+    unique_values = unique_lookup_values_for(m.history_info._object)
+    if not unique_values:
+        pk_att = m.history_info._object._meta.pk.attname
+        pk_val = getattr(m.history_info._object, pk_att)
+        unique_values = {pk_att: pk_val}
+    return unique_values
+
+
+def prefetch_history_related(instances, accessor):
+    """
+    Looks up a reverse related set, e.g. page_hist.mapdata_set, for each
+    of a list of historical instances, using a single query for all of
+    them rather than one per instance.  The related sets are then
+    accessed as usual, so iterating over instances[0].mapdata_set
+    doesn't query the database.  Filtering a set, or calling all() on
+    it, queries the database as usual.
+
+    Other kinds of related lookups, e.g. reverse OneToOneFields or
+    ManyToManyFields, are looked up one instance at a time.
 
     Args:
-        model: A model class.
-        m: The model instance.
-        name: The string representing the attribute name.
+        instances: A list of instances of a single historical model.
+        accessor: Name of the reverse related set, e.g. 'mapdata_set'.
     """
-    basedict = model.__getattribute__(m, '__dict__')
-    direct_val = basedict.get('_direct_lookup_fields', {}).get(name)
-    if direct_val is not None:
-        return direct_val
-    return model.__getattribute__(m, name)
+    if not instances:
+        return
+    rel_o = getattr(instances[0].__class__, accessor).rel_o
+    if not isinstance(rel_o.field, models.ForeignKey) or isinstance(
+            rel_o.field, models.OneToOneField):
+        for m in instances:
+            getattr(m, accessor)
+        return
+
+    attr = rel_o.field.name
+    parent_model = rel_o.model
+    wanted = [(m, _unique_values_of(m)) for m in instances]
+    lookup = models.Q()
+    related = set([attr])
+    for m, unique_values in wanted:
+        kws = {'history_date__lte': m.history_info.date}
+        for k, v in unique_values.iteritems():
+            kws['%s%s%s' % (attr, LOOKUP_SEP, k)] = v
+            # Spanning a relation, so we need that object, too.
+            parts = k.split(LOOKUP_SEP)
+            for i in range(1, len(parts)):
+                related.add(LOOKUP_SEP.join([attr] + parts[:i]))
+        lookup |= models.Q(**kws)
+    rows = list(parent_model.history.filter(lookup).select_related(
+        *related))
+
+    def _lookup_value(obj, k):
+        for part in k.split(LOOKUP_SEP):
+            obj = getattr(obj, part)
+        return obj
+
+    for m, unique_values in wanted:
+        latest = {}
+        for row in rows:
+            if row.history_info.date > m.history_info.date:
+                continue
+            target = getattr(row, attr)
+            if not all([_lookup_value(target, k) == v
+                        for k, v in unique_values.iteritems()]):
+                continue
+            pk = getattr(row, parent_model._meta.pk.attname)
+            if pk not in latest or latest[pk].history_id < row.history_id:
+                latest[pk] = row
+        related_set = _reverse_set_lookup(m, rel_o)
+        related_set._result_cache = sorted(
+            latest.values(), reverse=True,
+            key=lambda r: (r.history_info.date, r.history_id))
+        m.__dict__[accessor] = related_set
+
+
+def _reverse_attr_lookup(m, rel_o):
+    attr = rel_o.field.name
+    parent_model = rel_o.model
+    as_of = m.history_info.date
+    is_subclass = False
+
+    # Find unique values of the base (non-historical) model.
+    unique_values = unique_lookup_values_for(m.history_info._object)
+    if not unique_values:
+        # Check to see if this is a subclass relation with a
+        # historical model.
+        for k, v in rel_o.opts.parents.iteritems():
+            if is_versioned(k):
+                # Cheap comparison hack.
+                is_subclass = v.related.__dict__ == rel_o.__dict__
+
+        pk_att = m.history_info._object._meta.pk.attname
+        if is_subclass:
+            # For subclassed historical models' implicit OneToOne
+            # relation we want to use the id of the historical
+            # model when the related object is also versioned.
+            pk_val = getattr(m, 'history_id')
+        else:
+            pk_val = getattr(m.history_info._object, pk_att)
+        unique_values = {pk_att: pk_val}
+
+    # Construct something like {'b__email':'a@example.org', ...}
+    # from the unique fields of the base model.
+    new_unique_values = {}
+    for k, v in unique_values.iteritems():
+        new_unique_values['%s%s%s' % (attr, LOOKUP_SEP, k)] = v
+    unique_values = new_unique_values
+
+    try:
+        obj = parent_model.history.filter(
+            history_date__lte=as_of,
+            **unique_values
+        )[0]
+    except IndexError:
+        raise parent_model.history.model.DoesNotExist(
+            "%s matching query does not exist." %
+            parent_model.history.model._meta.object_name)
+    return obj
 
 
 def revert_to(hm, delete_newer_versions=False, **kws):
@@ -239,6 +315,8 @@ def revert_to(hm, delete_newer_versions=False, **kws):
     # encourage interaction with the historical instance -- it does
     # fancy foreignkey lookups, etc.
     m = hm.history_info._object
+    # We're about to change m, so don't hand it out again.
+    del hm.__dict__['history__object']
 
     # If we simply grab hm.history_info._object we may hit a uniqueness
     # exception.  If we save the model and it already exists.  This is because
@@ -268,27 +346,30 @@ def revert_to(hm, delete_newer_versions=False, **kws):
         m.save(reverted_to_version=hm, **kws)
 
 
-def version_number_of(hm):
-    """
-    Returns version number.
-
-    Args:
-        hm: Historical record instance.
-    """
-    if getattr(hm.history_info.instance, '_version_number', None) is None:
-        date = hm.history_info.date
-        obj = hm.history_info._object
-        hm.history_info.instance._version_number = len(
-            obj.history.filter(history_date__lte=date)
-        )
-    return hm.history_info.instance._version_number
-
-
 class HistoricalMetaInfo(object):
     def __get__(self, instance, owner):
         self.instance = instance
         return self
 
+    @property
+    def version_number(self):
+        hm = self.__dict__['instance']
+        if hm.history_version_number is not None:
+            return hm.history_version_number
+        if hm.__dict__.get('_version_number') is None:
+            # Written before version numbers were stored, and not yet
+            # numbered by backfill_history.  Such records come before
+            # any numbered ones, so count the unnumbered records up to
+            # this one.
+            obj = hm.history_info._object
+            history = getattr(obj, obj._history_manager_name)
+            hm.__dict__['_version_number'] = history.filter(
+                history_version_number=None).filter(
+                    models.Q(history_date__lt=hm.history_date) |
+                    models.Q(history_date=hm.history_date,
+                             history_id__lte=hm.history_id)).count()
+        return hm.__dict__['_version_number']
+
     def __getattr__(self, name):
         try:
             return getattr(self.__dict__['instance'], 'history_%s' % name)
@@ -306,14 +387,22 @@ class HistoricalMetaInfo(object):
 
 
 class HistoricalObjectDescriptor(object):
+    """
+    Reconstructs an instance of the model from a historical instance.
+
+    The reconstructed instance is kept in the historical instance's
+    __dict__, which takes precedence over this descriptor from then on.
+    """
     def __init__(self, model):
         self.model = model
 
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        related_pks = self._related_pks(instance)
         values = []
         for f in self.model._meta.fields:
-            related = getattr(f, 'related', None)
-            if related and is_versioned(related.parent_model):
+            if f.attname in related_pks:
                 # If the field points to a related, versioned model then
                 # we need to subsitute an instance of that model (not
                 # versioned) here.  This is because we use the same
@@ -321,12 +410,72 @@ class HistoricalObjectDescriptor(object):
                 # object.  For instance, if we have "Map" -> OneToOne ->
                 # "Page", then in Map_hist we have page_id which stores
                 # the value of the Page_hist object.
-                attribute = getattr(instance, f.name)
-                if attribute is not None:
-                    values.append(attribute.history_info._object.pk)
-                else:
-                    values.append(None)
+                values.append(related_pks[f.attname])
             else:
                 values.append(getattr(instance, f.attname))
         m = self.model(*values)
+        instance.__dict__['history__object'] = m
         return m
+
+    def _related_pks(self, instance):
+        """
+        Returns:
+            A {attname: primary key} dictionary of the objects the
+            versioned foreign keys of the model pointed to, as of the
+            historical instance.
+
+        Raises:
+            DoesNotExist: A related historical record is gone.
+        """
+        pks = {}
+        # The pks to look up, all in one query.
+        lookups = []
+        for f in self.model._meta.fields:
+            related = getattr(f, 'related', None)
+            if not (related and is_versioned(related.parent_model)):
+                continue
+            history_id = getattr(instance, f.attname)
+            if history_id is None:
+                pks[f.attname] = None
+                continue
+            hist_field = instance._meta.get_field(f.name)
+            cached = (instance.__dict__.get(hist_field.get_cache_name()) or
+                      cache.get_instance(hist_field.rel.to, history_id))
+            if cached is not None:
+                pks[f.attname] = cached.history_info._object.pk
+            elif getattr(f.rel.to._meta.pk, 'rel', None):
+                attribute = getattr(instance, f.name)
+                pks[f.attname] = attribute.history_info._object.pk
+            else:
+                # The pk is stored as-is on the related historical
+                # record, so we don't need to build the record to get
+                # at it.
+                lookups.append(f)
+        if not lookups:
+            return pks
+
+        names = ['%s%s%s' % (f.name, LOOKUP_SEP, f.rel.to._meta.pk.attname)
+                 for f in lookups]
+        rows = instance.__class__._base_manager.filter(
+            history_id=instance.history_id).values_list(*names)
+        row = list(rows[:1])
+        if row:
+            row = row[0]
+        else:
+            # The historical record itself isn't in the database, e.g.
+            # it was deleted, so look up each related record directly.
+            row = []
+            for f in lookups:
+                hist_model = instance._meta.get_field(f.name).rel.to
+                row.append((list(hist_model._base_manager.filter(
+                    history_id=getattr(instance, f.attname)).values_list(
+                        f.rel.to._meta.pk.attname, flat=True)[:1]) or
+                    [None])[0])
+        for f, pk in zip(lookups, row):
+            if pk is None:
+                hist_model = instance._meta.get_field(f.name).rel.to
+                raise hist_model.DoesNotExist(
+                    "%s matching query does not exist." %
+                    hist_model._meta.object_name)
+            pks[f.attname] = pk
+        return pks
@@ -0,0 +1,108 @@
+"""
+Multi-column indexes on historical models.
+
+Django only knows how to create single-column indexes, so we create the
+ones TrackChanges asks for ourselves, right after syncdb creates the
+historical models' tables.
+"""
+import hashlib
+import logging
+
+from django.db import connections, transaction
+from django.db.backends.util import truncate_name
+
+logger = logging.getLogger('versionutils.versioning')
+
+
+# SQL to check whether an index exists, by database vendor.
+INDEX_EXISTS_SQL = {
+    'postgresql': 'SELECT 1 FROM pg_indexes WHERE indexname = %s',
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s",
+    'mysql': ('SELECT 1 FROM information_schema.statistics '
+              'WHERE table_schema = DATABASE() AND index_name = %s'),
+    'oracle': 'SELECT 1 FROM user_indexes WHERE index_name = UPPER(%s)',
+}
+
+
+def _index_columns(model, field_names):
+    """
+    Returns:
+        A list of (column, descending) pairs for the provided field names.
+        A leading "-" on a field name, as in order_by(), makes the column
+        descending.
+    """
+    columns = []
+    for name in field_names:
+        descending = name.startswith('-')
+        field = model._meta.get_field(name.lstrip('-'))
+        columns.append((field.column, descending))
+    return columns
+
+
+def composite_index_name(model, field_names, connection, unique=False):
+    columns = [(descending and '-' or '') + column
+               for column, descending in _index_columns(model, field_names)]
+    if unique:
+        columns.insert(0, 'UNIQUE')
+    # Named after a digest of the columns, so the name is the same
+    # wherever syncdb runs.
+    digest = hashlib.md5(','.join(columns)).hexdigest()[:8]
+    index_name = '%s_%s' % (model._meta.db_table, digest)
+    return truncate_name(index_name, connection.ops.max_name_length())
+
+
+def sql_for_composite_index(model, field_names, connection, unique=False):
+    """
+    Args:
+        model: A model class.
+        field_names: A tuple of names of local fields on model, each
+            optionally prefixed with "-" for a descending column.
+        connection: The database connection the SQL is meant for.
+        unique: If True, create a UNIQUE index.
+
+    Returns:
+        The CREATE INDEX statement for the multi-column index.
+    """
+    qn = connection.ops.quote_name
+    columns = [qn(column) + (descending and ' DESC' or '')
+               for column, descending in _index_columns(model, field_names)]
+    return 'CREATE %sINDEX %s ON %s (%s);' % (
+        unique and 'UNIQUE ' or '',
+        qn(composite_index_name(model, field_names, connection, unique)),
+        qn(model._meta.db_table),
+        ', '.join(columns))
+
+
+def index_exists(index_name, connection):
+    sql = INDEX_EXISTS_SQL.get(connection.vendor)
+    if sql is None:
+        return False
+    cursor = connection.cursor()
+    cursor.execute(sql, [index_name])
+    return cursor.fetchone() is not None
+
+
+def create_composite_indexes(sender, created_models, verbosity=1,
+                             db='default', **kws):
+    """
+    post_syncdb signal handler that creates the multi-column indexes of
+    newly created historical models.
+    """
+    connection = connections[db]
+    cursor = connection.cursor()
+    for model in created_models:
+        wanted = [(f, False) for f in getattr(model, '_composite_indexes', [])]
+        wanted += [(f, True) for f in getattr(model, '_unique_indexes', [])]
+        for field_names, unique in wanted:
+            # flush also sends post_syncdb, listing every model.
+            name = composite_index_name(model, field_names, connection, unique)
+            if index_exists(name, connection):
+                continue
+            sql = sql_for_composite_index(model, field_names, connection,
+                                          unique)
+            if verbosity >= 2:
+                logger.info("Creating %sindex on %s (%s)" % (
+                    unique and 'unique ' or '', model._meta.db_table,
+                    ', '.join(field_names)))
+            cursor.execute(sql)
+            transaction.commit_unless_managed(using=db)
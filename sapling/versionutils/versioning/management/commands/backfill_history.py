@@ -0,0 +1,186 @@
+from optparse import make_option
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+
+from versionutils.versioning.utils import *
+
+
+class Command(BaseCommand):
+    args = '[appname.ModelName ...]'
+    help = ("Fills in the stored lineages, version numbers and digests of "
+            "historical records written before they were tracked.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500,
+            help='Number of historical records to update per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.verbosity = int(options.get('verbosity', 1))
+
+        if args:
+            to_fill = []
+            for label in args:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError("Expected appname.ModelName, got %s" %
+                                       label)
+                model = models.get_model(app_label, model_name)
+                if model is None or not is_directly_versioned(model):
+                    raise CommandError("%s is not a versioned model" % label)
+                to_fill.append(model)
+        else:
+            to_fill = directly_versioned_models()
+
+        for model in to_fill:
+            history_model = getattr(model, model._history_manager_name).model
+            if history_model._lineage:
+                # Before numbering, as version numbers follow lineages.
+                updated = self.backfill_lineages(model)
+                if self.verbosity > 0:
+                    self.stdout.write("%s: linked %d historical records\n" %
+                                      (model._meta.object_name, updated))
+            updated = self.backfill_version_numbers(model)
+            if self.verbosity > 0:
+                self.stdout.write("%s: numbered %d historical records\n" %
+                                  (model._meta.object_name, updated))
+            updated = self.backfill_digests(model)
+            if self.verbosity > 0:
+                self.stdout.write("%s: digested %d historical records\n" %
+                                  (model._meta.object_name, updated))
+
+    def backfill_lineages(self, model):
+        """
+        Fills in the lineage of every historical record of the model that
+        doesn't have one.  Records are grouped by the object's identity,
+        and a group continues the lineage of its earliest linked record,
+        or else starts one at its earliest record.
+
+        Returns:
+            The number of historical records updated.
+        """
+        history = getattr(model, model._history_manager_name)
+        # The object's identity -> its lineage, or the ids awaiting one.
+        lineages = {}
+        unlinked = {}
+        records = history.all().order_by('history_id')
+        for hm in records.iterator():
+            key = _identity_key(hm, lineage=False)
+            if hm.history_lineage is not None:
+                lineages.setdefault(key, hm.history_lineage)
+            else:
+                unlinked.setdefault(key, []).append(hm.history_id)
+
+        pending = {}
+        updated = 0
+        for key, ids in unlinked.iteritems():
+            pending[lineages.get(key, ids[0])] = ids
+            updated += len(ids)
+            if len(pending) >= self.batch_size:
+                self._update_lineages(history, pending)
+                pending = {}
+        self._update_lineages(history, pending)
+        return updated
+
+    @transaction.commit_on_success
+    def _update_lineages(self, history, pending):
+        for lineage, ids in pending.iteritems():
+            history.filter(history_id__in=ids).update(history_lineage=lineage)
+
+    def backfill_version_numbers(self, model):
+        """
+        Numbers every historical record of the model, oldest first, in the
+        same way version numbers are assigned when records are written.
+
+        Returns:
+            The number of historical records whose version number changed.
+        """
+        history = getattr(model, model._history_manager_name)
+        # The object's identity -> the last version number handed out.
+        numbers = {}
+        changed = []
+
+        records = history.all().order_by('history_date', 'history_id')
+        for hm in records.iterator():
+            key = _identity_key(hm)
+            numbers[key] = numbers.get(key, 0) + 1
+            if hm.history_version_number != numbers[key]:
+                changed.append((hm.history_id, numbers[key]))
+
+        # Version numbers are unique per object, so clear the ones that
+        # change before handing them out again.
+        ids = [history_id for history_id, number in changed]
+        for i in range(0, len(ids), self.batch_size):
+            self._clear_numbers(history, ids[i:i + self.batch_size])
+        pending = {}
+        for i, (history_id, number) in enumerate(changed):
+            pending.setdefault(number, []).append(history_id)
+            if (i + 1) % self.batch_size == 0:
+                self._update_numbers(history, pending)
+                pending = {}
+        self._update_numbers(history, pending)
+        return len(changed)
+
+    @transaction.commit_on_success
+    def _clear_numbers(self, history, ids):
+        history.filter(history_id__in=ids).update(history_version_number=None)
+
+    @transaction.commit_on_success
+    def _update_numbers(self, history, pending):
+        # One UPDATE per distinct version number in the batch, rather than
+        # one per historical record.
+        for number, ids in pending.iteritems():
+            history.filter(history_id__in=ids).update(
+                history_version_number=number)
+
+
+    def backfill_digests(self, model):
+        """
+        Fills in the digest of every historical record of the model that
+        doesn't have one.
+
+        Returns:
+            The number of historical records updated.
+        """
+        history = getattr(model, model._history_manager_name)
+        pending = {}
+        updated = 0
+        records = history.filter(history_digest__isnull=True)
+        for hm in records.order_by('history_id').iterator():
+            pending[hm.history_id] = digest_of(hm.history_info._object)
+            updated += 1
+            if updated % self.batch_size == 0:
+                self._update_digests(history, pending)
+                pending = {}
+        self._update_digests(history, pending)
+        return updated
+
+    @transaction.commit_on_success
+    def _update_digests(self, history, pending):
+        for history_id, digest in pending.iteritems():
+            history.filter(history_id=history_id).update(
+                history_digest=digest)
+
+
+def _identity_key(hm, lineage=True):
+    """
+    Returns:
+        A hashable value identifying the object the historical record
+        belongs to, the same way HistoryManager does.
+    """
+    if lineage and getattr(hm, 'history_lineage', None) is not None:
+        return ('history_lineage', hm.history_lineage)
+    obj = hm.history_info._object
+    try:
+        values = unique_lookup_values_for(obj)
+    except ObjectDoesNotExist:
+        # A versioned OneToOneField pointing at a since-deleted object.
+        values = None
+    if not values:
+        values = {obj._meta.pk.attname: obj.pk}
+    return tuple(sorted(values.items()))
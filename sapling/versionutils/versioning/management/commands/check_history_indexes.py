@@ -0,0 +1,144 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, connections, DEFAULT_DB_ALIAS
+
+from versionutils.versioning.utils import *
+
+
+# How to ask each database for its query plan, and how to tell from the
+# plan's rows that a query reads the whole table or sorts its results.
+EXPLAIN_SQL = {
+    'sqlite': 'EXPLAIN QUERY PLAN %s',
+    'postgresql': 'EXPLAIN %s',
+    'mysql': 'EXPLAIN %s',
+}
+
+
+def _sqlite_problems(rows):
+    problems = []
+    for row in rows:
+        detail = row[-1]
+        if detail.startswith('SCAN') and 'INDEX' not in detail:
+            problems.append(detail)
+        elif 'TEMP B-TREE' in detail:
+            problems.append(detail)
+    return problems
+
+
+def _postgresql_problems(rows):
+    problems = []
+    for row in rows:
+        detail = row[0].strip().lstrip('->').strip()
+        if detail.startswith('Seq Scan') or detail.startswith('Sort '):
+            problems.append(detail)
+    return problems
+
+
+def _mysql_problems(rows):
+    problems = []
+    for row in rows:
+        # id, select_type, table, type, possible_keys, key, key_len, ref,
+        # rows, Extra
+        if row[3] == 'ALL':
+            problems.append('full scan of %s' % row[2])
+        if row[-1] and 'filesort' in row[-1]:
+            problems.append('%s: %s' % (row[2], row[-1]))
+    return problems
+
+
+PLAN_PROBLEMS = {
+    'sqlite': _sqlite_problems,
+    'postgresql': _postgresql_problems,
+    'mysql': _mysql_problems,
+}
+
+
+class Command(BaseCommand):
+    args = '[appname.ModelName ...]'
+    help = ("Reports the common history lookups of versioned models that "
+            "the database can't answer using an index.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to check.  Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        connection = connections[options['database']]
+        if connection.vendor not in EXPLAIN_SQL:
+            raise CommandError("Can't read query plans from %s" %
+                               connection.vendor)
+
+        if args:
+            to_check = []
+            for label in args:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError("Expected appname.ModelName, got %s" %
+                                       label)
+                model = models.get_model(app_label, model_name)
+                if model is None or not is_directly_versioned(model):
+                    raise CommandError("%s is not a versioned model" % label)
+                to_check.append(model)
+        else:
+            to_check = directly_versioned_models()
+
+        unindexed = 0
+        for model in to_check:
+            name = model._meta.object_name
+            queries = self.history_queries(model)
+            if queries is None:
+                if self.verbosity > 0:
+                    self.stdout.write("%s: no historical records, skipped\n" %
+                                      name)
+                continue
+            for description, qs in queries:
+                problems = self.plan_problems(qs, connection)
+                if problems:
+                    unindexed += 1
+                    self.stdout.write("%s: %s isn't indexed: %s\n" %
+                                      (name, description, '; '.join(problems)))
+                elif self.verbosity > 1:
+                    self.stdout.write("%s: %s is indexed\n" %
+                                      (name, description))
+        if self.verbosity > 0:
+            self.stdout.write("%d unindexed history lookups\n" % unindexed)
+
+    def history_queries(self, model):
+        """
+        Returns:
+            A list of (description, QuerySet) pairs of the history lookups
+            to check, made on behalf of an object that has a history, or
+            None if the model has no historical records yet.
+        """
+        history = getattr(model, model._history_manager_name)
+        try:
+            hm = history.all()[0]
+        except IndexError:
+            return None
+        obj_history = getattr(hm.history_info._object,
+                              model._history_manager_name)
+        return [
+            ('history.all()', obj_history.all()),
+            ('history.most_recent()', obj_history.all()[:1]),
+            ('history.as_of(date=..)',
+             obj_history.filter(history_date__lte=hm.history_date)[:1]),
+            ('history.as_of(version=..)',
+             obj_history.filter(history_version_number=1)[:1]),
+            ('history.page(..)',
+             obj_history.all().order_by('-history_date', '-history_id')[:50]),
+        ]
+
+    def plan_problems(self, qs, connection):
+        """
+        Returns:
+            A list of descriptions of the steps in the query plan of qs that
+            read a whole table or sort the results themselves.
+        """
+        sql, params = qs.query.get_compiler(connection=connection).as_sql()
+        cursor = connection.cursor()
+        cursor.execute(EXPLAIN_SQL[connection.vendor] % sql, params)
+        return PLAN_PROBLEMS[connection.vendor](cursor.fetchall())
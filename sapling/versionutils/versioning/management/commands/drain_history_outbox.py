@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from versionutils.versioning import outbox
+from versionutils.versioning.bulk import DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ("Writes the deferred historical records waiting in the "
+            "outbox.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to drain.  Defaults to the "default" database.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=DEFAULT_BATCH_SIZE,
+            help='Number of historical records to write per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        written = outbox.drain(using=options['database'],
+                               batch_size=options['batch_size'])
+        if verbosity > 0:
+            self.stdout.write("%d historical records written\n" % written)
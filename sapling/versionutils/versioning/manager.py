@@ -1,8 +1,16 @@
+import copy
+
 from django.db import models
 from django.db.models.query import QuerySet
+from django.db.models.sql.constants import LOOKUP_SEP
+from django.utils.tree import Node
 
 from utils import *
 from decorators import *
+from constants import *
+from bulk import bulk_insert, DEFAULT_BATCH_SIZE
+import cache
+import outbox
 
 
 class HistoryDescriptor(object):
@@ -19,54 +27,171 @@ class HistoryDescriptor(object):
         return instance._history_manager
 
 
+def rewrite_lookup(history_model, lookup):
+    """
+    Args:
+        history_model: A historical model.
+        lookup: A lookup, e.g. 'history_info__date__lte', as written
+            against the model.
+
+    Returns:
+        The lookup as it needs to be written against history_model, e.g.
+        'history_date__lte'.
+    """
+    rewrites = history_model._lookup_rewrites
+    if lookup not in rewrites:
+        rewrites[lookup] = _rewrite_lookup(history_model, lookup)
+    return rewrites[lookup]
+
+
+def _rewrite_lookup(history_model, lookup):
+    versioned_vars, versioned_parents = _rewrite_tables(history_model)
+    parts = lookup.split(LOOKUP_SEP)
+    # Replace all instances of history_info__whatever with
+    # history_whatever.
+    if len(parts) > 1 and parts[0] == 'history_info':
+        return LOOKUP_SEP.join(['history_%s' % parts[1]] + parts[2:])
+    # Replace all instances of fk__whatever with
+    # fk_hist__whatever if fk is a versioned model.
+    if parts[0] in versioned_vars:
+        return LOOKUP_SEP.join(['%s_hist' % parts[0]] + parts[1:])
+    # Replace all instances of parent_ptr__whatever
+    # with parent_hist_ptr__whatever if parent's versioned.
+    if parts[0] in versioned_parents:
+        # -4 will remove '_ptr' from the original string.
+        return LOOKUP_SEP.join(['%s_hist_ptr' % parts[0][:-4]] + parts[1:])
+    return lookup
+
+
+def _rewrite_tables(history_model):
+    """
+    Returns:
+        A tuple (versioned_vars, versioned_parents) of the names that
+        rewrite_lookup() rewrites.
+    """
+    tables = history_model.__dict__.get('_lookup_tables')
+    if tables is None:
+        model = history_model._original_model
+        # Get the variable names of related, versioned objects.  We
+        # can't do this when the historical model is created, as the
+        # related models may not have been defined yet.
+        rels = model._meta.get_all_related_objects()
+        versioned_vars = set(
+            [o.var_name for o in rels if is_versioned(o.model)])
+        # Get the lookup names of versioned parent models.
+        versioned_parents = set([v.name for k, v in
+                                 model._meta.parents.iteritems()
+                                 if is_versioned(k)])
+        tables = (versioned_vars, versioned_parents)
+        history_model._lookup_tables = tables
+    return tables
+
+
+class LatestAsOf(object):
+    """
+    A subquery selecting the history_id of the most recent historical
+    record of each object as of a date, for use in a history_id__in
+    lookup.  Like as_of(date=..), the most recent record is the one with
+    the latest history_date, and then the highest history_id.
+    """
+    def __init__(self, history, date):
+        """
+        Args:
+            history: A HistoryManager.  Only its historical records are
+                considered.
+            date: A datetime object.
+        """
+        self.history = history
+        self.date = date
+
+    def _prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        fields = (['history_id', 'history_date'] +
+                  self.history._identity_fields())
+        latest = self._query(fields)
+        newer = self._query(fields)
+        # Each query gets its own table aliases, so that newer can refer
+        # to the tables of latest.
+        latest.bump_prefix()
+        newer.bump_prefix()
+        newer.bump_prefix()
+
+        qn = connection.ops.quote_name
+        def columns(query):
+            # Aliases are left unquoted, as Django leaves them.
+            return ['%s.%s' % (alias, qn(column))
+                    for alias, column in query.select]
+        l, n = columns(latest), columns(newer)
+        # A record of the same object that's more recent.
+        where = ['%s = %s' % pair for pair in zip(n[2:], l[2:])]
+        where.append('(%(n_date)s > %(l_date)s OR '
+                     '(%(n_date)s = %(l_date)s AND %(n_id)s > %(l_id)s))' % {
+            'n_id': n[0], 'n_date': n[1], 'l_id': l[0], 'l_date': l[1]})
+        newer.add_extra(None, None, where, None, None, None)
+        sql, params = newer.get_compiler(connection=connection).as_sql()
+
+        latest.add_extra(None, None, ['NOT EXISTS (%s)' % sql], params,
+                         None, None)
+        latest.select = latest.select[:1]
+        return latest.get_compiler(connection=connection).as_sql()
+
+    def _query(self, fields):
+        return self.history.filter(history_date__lte=self.date).order_by(
+            ).values_list(*fields).query
+
+
 class HistoricalMetaInfoQuerySet(QuerySet):
     """
     Simple QuerySet to make filtering intuitive.
+
+    Lookups are written as if against the model, and rewritten to work
+    against the historical model, e.g. history_info__date becomes
+    history_date.  This goes for filter(), exclude(), Q objects,
+    order_by(), values() and values_list().
     """
-    def filter(self, *args, **kws):
-        # Get the variable names of related, versioned objects.
-        rels = self.model._original_model._meta.get_all_related_objects()
-        versioned_vars = [o.var_name for o in rels if is_versioned(o.model)]
+    def _filter_or_exclude(self, negate, *args, **kws):
+        args = [self._rewrite_q(q) for q in args]
+        kws = dict([(self._rewrite(k), v) for k, v in kws.iteritems()])
+        return super(HistoricalMetaInfoQuerySet, self)._filter_or_exclude(
+            negate, *args, **kws)
 
-        # Get the lookup names of versioned parent models.
-        parents = self.model._original_model._meta.parents
-        versioned_parents = []
-        for k, v in parents.iteritems():
-            if is_versioned(k):
-                versioned_parents.append(v.name)
-
-        # Iterate through the provided keywords, replacing certain
-        # attributes with ones that correspond to historical models.
-        kws_new = {}
-        for k, v in kws.iteritems():
-            k_new = k
-            parts = k.split(models.sql.constants.LOOKUP_SEP)
-            # Replace all instances of history_info__whatever with
-            # history_whatever.
-            if len(parts) > 1 and parts[0] == 'history_info':
-                rest = models.sql.constants.LOOKUP_SEP.join(parts[2:])
-                if rest:
-                    rest = "%s%s" % (models.sql.constants.LOOKUP_SEP, rest)
-                k_new = 'history_%s%s' % (parts[1], rest)
-            # Replace all instances of fk__whatever with
-            # fk_hist__whatever if fk is a versioned model.
-            if parts[0] in versioned_vars:
-                rest = models.sql.constants.LOOKUP_SEP.join(parts[2:])
-                if rest:
-                    rest = "%s%s" % (models.sql.constants.LOOKUP_SEP, rest)
-                k_new = '%s_hist%s' % (parts[0], rest)
-            # Replace all instances of parent_ptr__whatever
-            # with parent_hist_ptr__whatever if parent's versioned.
-            if parts[0] in versioned_parents:
-                rest = models.sql.constants.LOOKUP_SEP.join(parts[2:])
-                if rest:
-                    rest = "%s%s" % (models.sql.constants.LOOKUP_SEP, rest)
-                # -4 will remove '_ptr' from the original string.
-                k_new = '%s_hist_ptr%s' % (parts[0][:-4], rest)
-
-            kws_new[k_new] = v
-
-        return super(HistoricalMetaInfoQuerySet, self).filter(*args, **kws_new)
+    def order_by(self, *field_names):
+        names = []
+        for name in field_names:
+            if name.startswith('-'):
+                name = '-%s' % self._rewrite(name[1:])
+            elif name != '?' and '.' not in name:
+                name = self._rewrite(name)
+            names.append(name)
+        return super(HistoricalMetaInfoQuerySet, self).order_by(*names)
+
+    def values(self, *fields):
+        fields = [self._rewrite(f) for f in fields]
+        return super(HistoricalMetaInfoQuerySet, self).values(*fields)
+
+    def values_list(self, *fields, **kws):
+        fields = [self._rewrite(f) for f in fields]
+        return super(HistoricalMetaInfoQuerySet, self).values_list(
+            *fields, **kws)
+
+    def _rewrite(self, lookup):
+        return rewrite_lookup(self.model, lookup)
+
+    def _rewrite_q(self, q):
+        if not isinstance(q, Node):
+            # e.g. something with an add_to_query() method.
+            return q
+        new = copy.copy(q)
+        new.children = []
+        for child in q.children:
+            if isinstance(child, Node):
+                new.children.append(self._rewrite_q(child))
+            else:
+                lookup, value = child
+                new.children.append((self._rewrite(lookup), value))
+        return new
 
 
 class HistoryManager(models.Manager):
@@ -74,6 +199,7 @@ class HistoryManager(models.Manager):
         super(HistoryManager, self).__init__()
         self.model = model
         self.instance = instance
+        self.metadata_only = False
 
         parent_instance = get_parent_instance(
             self.instance, model._original_model)
@@ -86,9 +212,49 @@ class HistoryManager(models.Manager):
             self.instance = parent_instance
 
     def get_query_set(self):
+        # Read our own writes, if they're still in the outbox.
+        outbox.sync(self.model)
+        qs = HistoricalMetaInfoQuerySet(model=self.model)
+        if self.metadata_only:
+            qs = self._defer_fields(qs)
         if self.instance is None:
-            return HistoricalMetaInfoQuerySet(model=self.model)
+            return qs
+        if self.model._lineage:
+            return qs.filter(**self._lineage_lookup())
+        return qs.filter(**self._identity_lookup())
+
+    def metadata(self):
+        """
+        Returns:
+            A copy of this manager whose QuerySets only load the
+            history_* fields of historical records up front, e.g. for
+            listing versions.  The other fields are loaded when they're
+            accessed.
+        """
+        manager = copy.copy(self)
+        manager.metadata_only = True
+        return manager
 
+    def _defer_fields(self, qs):
+        """
+        Returns:
+            qs with the fields of the original model deferred.
+        """
+        deferred = [
+            f.name for f in self.model._meta.fields
+            # Delta fields hold patches, which are small, and would
+            # lose track of their keyframe if deferred.
+            if not (f.primary_key or f.name.startswith('history_') or
+                    f in self.model._delta_fields)
+        ]
+        return qs.defer(*deferred)
+
+    def _identity_lookup(self):
+        """
+        Returns:
+            The filter keywords that select the historical records of
+            self.instance.
+        """
         # TODO: Explore using natural_key() here if it exists on the
         # model. One idea: SHA-1 an escaped, string form of the
         # natural_key() and store it as an indexed field in the
@@ -106,34 +272,108 @@ class HistoryManager(models.Manager):
         # has changed underneath.
         if not unique_fields:
             if self.instance.pk:
-                pk_name = self.instance._meta.pk.name
-                # Having a related object for a pk implies that this is
-                # a concretely subclassed object.  We need to use an
-                # integer lookup in this case.
-                if getattr(self.instance._meta.pk, 'rel', None):
-                    # We normally use the history_id to do the lookup,
-                    # but if the parent model is versioned then the pk
-                    # on the child (historical) model will be a parent
-                    # pointer, so we want this lookup be of the form
-                    # parentmodel_hist_ptr__id rather than
-                    # parentmodel_ptr__id.
-                    original_base = getattr(self.model.__base__,
-                                            '_original_model', None)
-                    if original_base and is_versioned(original_base):
-                        pk_name = "%s%sid" % (
-                            # Use historical model's pk name of the form
-                            # parentmodel_hist_ptr.
-                            self.model._meta.pk.name,
-                            models.sql.constants.LOOKUP_SEP)
-
-                filter = {pk_name: self.instance.pk}
+                filter = {self._pk_lookup_name(): self.instance.pk}
             else:
                 raise self.NoUniqueValuesError(
                     "Wasn't passed an active (existing) instance and model "
                     "has no unique fields or no unique_together defined!"
                 )
+        return filter
+
+    def _pk_lookup_name(self):
+        """
+        Returns:
+            The lookup name that finds the historical records of an
+            object by its primary key.
+        """
+        pk = self.model._original_model._meta.pk
+        pk_name = pk.name
+        # Having a related object for a pk implies that this is
+        # a concretely subclassed object.  We need to use an
+        # integer lookup in this case.
+        if getattr(pk, 'rel', None):
+            # We normally use the history_id to do the lookup,
+            # but if the parent model is versioned then the pk
+            # on the child (historical) model will be a parent
+            # pointer, so we want this lookup be of the form
+            # parentmodel_hist_ptr__id rather than
+            # parentmodel_ptr__id.
+            original_base = getattr(self.model.__base__,
+                                    '_original_model', None)
+            if original_base and is_versioned(original_base):
+                pk_name = "%s%sid" % (
+                    # Use historical model's pk name of the form
+                    # parentmodel_hist_ptr.
+                    self.model._meta.pk.name,
+                    models.sql.constants.LOOKUP_SEP)
+        return pk_name
+
+    def _lineage_lookup(self):
+        """
+        Returns:
+            The filter keywords that select the historical records of
+            self.instance by its lineage, which we find from the most
+            recent historical record with the instance's primary key (or,
+            lacking one, its unique fields).  Objects whose historical
+            records don't have a lineage yet are looked up as usual.
+        """
+        pk = self.instance.pk
+        cached = getattr(self, '_lineage', None)
+        if pk is not None and cached is not None and cached[0] == pk:
+            return {'history_lineage': cached[1]}
+
+        if pk is not None:
+            lookup = {self._pk_lookup_name(): pk}
+        else:
+            lookup = unique_lookup_values_for(self.instance)
+            if not lookup:
+                raise self.NoUniqueValuesError(
+                    "Wasn't passed an active (existing) instance and model "
+                    "has no unique fields or no unique_together defined!"
+                )
+        latest = HistoricalMetaInfoQuerySet(model=self.model).filter(
+            **lookup).order_by('-history_id').values_list('history_lineage',
+                                                          'history_type')
+        latest = list(latest[:1])
+        if not latest:
+            # No history yet.
+            return {'history_id__in': []}
+        lineage, type = latest[0]
+        if lineage is None:
+            # Written before lineages were stored.  Run the
+            # backfill_history command to link them up.
+            return self._identity_lookup()
+        if pk is not None and type not in (TYPE_DELETED,
+                                           TYPE_REVERTED_DELETED):
+            # An object keeps its lineage, so we only look it up once.
+            # A deleted object's primary key may be handed to a new
+            # object, though, which starts a new lineage.
+            self._lineage = (pk, lineage)
+        return {'history_lineage': lineage}
+
+    def _identity_fields(self):
+        """
+        The class-level counterpart of _identity_lookup().
+
+        Returns:
+            A list of the lookup names that together identify an object
+            across its historical records.
+        """
+        if self.model._lineage:
+            return ['history_lineage']
+        lookups = unique_lookup_fields_for(self.model._original_model)
+        if lookups:
+            return lookups
+        return [self._pk_lookup_name()]
 
-        return HistoricalMetaInfoQuerySet(model=self.model).filter(**filter)
+    @require_instance
+    def head_key(self):
+        """
+        Returns:
+            The key identifying self.instance in the historical model's
+            head table.
+        """
+        return head_key_for(self._identity_lookup())
 
     def most_recent(self):
         """
@@ -143,13 +383,54 @@ class HistoryManager(models.Manager):
         Raises:
             DoesNotExist: Instance has no historical record.
         """
+        if self.instance is None or not cache.is_enabled():
+            return self._most_recent()
+        key = self.head_key()
+        v = cache.get_head(self.model, key)
+        if v is None:
+            v = self._most_recent()
+            if not self.metadata_only:
+                cache.set_head(self.model, key, v)
+        return v
+
+    def _most_recent(self):
+        if self.instance and self.model._head_model is not None:
+            # Look up the record the head table points to, rather than
+            # sorting the object's history.
+            head = HistoricalMetaInfoQuerySet(model=self.model)
+            if self.metadata_only:
+                head = self._defer_fields(head)
+            head = head.filter(**{self.model._head_lookup: self.head_key()})
+            for v in head:
+                return v
         try:
-            v = self.all()[0]
+            v = self.get_query_set()[0]
             return v
         except IndexError:
             raise self.instance.DoesNotExist("%s has no historical record." %
                                              self.instance._meta.object_name)
 
+    def get(self, *args, **kws):
+        """
+        Like QuerySet.get().  With the request's cache enabled, looking
+        up a historical record by its history_id alone only queries the
+        database the first time.
+        """
+        by_id = (not args and kws.keys() in (['history_id'], ['pk']) and
+                 not self.metadata_only)
+        if not by_id:
+            return super(HistoryManager, self).get(*args, **kws)
+        history_id = kws.values()[0]
+        v = None
+        if self.instance is None:
+            # Instance-bound lookups also check that the record is one of
+            # the instance's, so they can't use the cache.
+            v = cache.get_instance(self.model, history_id)
+        if v is None:
+            v = super(HistoryManager, self).get(*args, **kws)
+            cache.set_instance(self.model, v)
+        return v
+
     @require_instance
     def as_of(self, date=None, version=None):
         """
@@ -168,14 +449,201 @@ class HistoryManager(models.Manager):
         """
         try:
             if version and version > 0:
-                v = self.all().order_by('history_date')[version - 1]
+                try:
+                    v = self.filter(history_version_number=version)[0]
+                except IndexError:
+                    # Records written before version numbers were stored
+                    # come first, and are numbered by their order until
+                    # backfill_history numbers them.
+                    v = self.filter(history_version_number=None).order_by(
+                        'history_date', 'history_id')[version - 1]
             elif date:
-                v = self.filter(history_date__lte=date)[0]
+                v = self.filter(history_date__lte=date).order_by(
+                    '-history_date', '-history_id')[0]
         except IndexError:
             raise self.instance.DoesNotExist("%s hasn't been created yet." %
                     self.instance._meta.object_name)
 
         return v
 
+    def snapshot(self, date):
+        """
+        Args:
+            date: A datetime object.
+
+        Returns:
+            A QuerySet of historical record instances: the version of
+            every object as of the date provided.  Objects that didn't
+            exist at the time, or had been deleted, are left out.  This is
+            a single query, however many objects there are.
+        """
+        return self.filter(history_id__in=LatestAsOf(self, date)).exclude(
+            history_type__in=(TYPE_DELETED, TYPE_REVERTED_DELETED))
+
+    def page(self, per_page, after=None):
+        """
+        Returns a page of the history, newest first.  Rather than using
+        an OFFSET, which has to skip over all the earlier pages, this
+        starts right after the provided historical record.
+
+        Args:
+            per_page: The maximum number of historical records to return.
+            after: The history_id of the historical record to start after,
+                e.g. the last record of the previous page.  If None, start
+                with the most recent record.
+
+        Returns:
+            A list of historical record instances.
+        """
+        history = self
+        if self.model._metadata_listings:
+            history = self.metadata()
+        qs = history.all().order_by('-history_date', '-history_id')
+        if after is not None:
+            try:
+                date = self.filter(history_id=after).values_list(
+                    'history_date', flat=True)[0]
+            except IndexError:
+                raise self.model.DoesNotExist(
+                    "No historical record with history_id %s" % after)
+            qs = qs.filter(
+                models.Q(history_date__lt=date) |
+                models.Q(history_date=date, history_id__lt=after)
+            )
+        return list(qs[:per_page])
+
+    def iter_pages(self, per_page, after=None):
+        """
+        Iterates over the history, newest first, a page at a time.  See
+        page().
+
+        Args:
+            per_page: The maximum number of historical records per page.
+            after: The history_id of the historical record to start after.
+
+        Yields:
+            Lists of historical record instances.
+        """
+        while True:
+            records = self.page(per_page, after=after)
+            if not records:
+                return
+            yield records
+            if len(records) < per_page:
+                return
+            after = records[-1].history_id
+
+    def identical_to(self, hm):
+        """
+        Args:
+            hm: A historical record instance.
+
+        Returns:
+            A QuerySet of the historical records whose field values are
+            the same as hm's, other than auto_now fields, found by their
+            digest.  Called via an
+            instance, only that object's versions are searched.
+        """
+        digest = hm.history_info.digest
+        if digest is None:
+            # Written before we stored digests.
+            return self.none()
+        return self.filter(history_digest=digest)
+
     class NoUniqueValuesError(Exception):
         pass
+
+
+class TrackedQuerySet(QuerySet):
+    """
+    QuerySet that records history for bulk operations on a versioned
+    model.  Historical records for all affected objects are written
+    with multi-row INSERTs rather than one save() at a time.
+    """
+    def update(self, **kws):
+        if not is_versioned(self.model):
+            return super(TrackedQuerySet, self).update(**kws)
+
+        pks = list(self.values_list('pk', flat=True))
+        rows = super(TrackedQuerySet, self).update(**kws)
+        self._record_history(self._fetch(pks), TYPE_UPDATED)
+        return rows
+    update.alters_data = True
+
+    def bulk_create(self, objs):
+        """
+        Inserts the provided model instances using multi-row INSERTs and
+        records their history in bulk.  Like update(), this doesn't call
+        save() or send any signals.
+
+        The instances need primary keys set, unless the model has a
+        single unique field we can find them by afterward.
+        """
+        if not objs:
+            return objs
+        pk_name = self.model._meta.pk.name
+        lookups = unique_lookup_fields_for(self.model)
+        missing_pks = [m for m in objs if m.pk is None]
+        if missing_pks and (len(lookups) != 1 or LOOKUP_SEP in lookups[0]):
+            raise ValueError("bulk_create() needs primary keys set on %s "
+                             "instances, as it has no single unique field." %
+                             self.model._meta.object_name)
+        if self.model._meta.parents:
+            raise ValueError("bulk_create() can't insert concretely "
+                             "subclassed models.")
+
+        bulk_insert(self.model, objs, using=self.db)
+
+        if not is_versioned(self.model):
+            return objs
+        if missing_pks:
+            name = lookups[0]
+            values = [getattr(m, name) for m in objs]
+            created = []
+            for i in range(0, len(values), DEFAULT_BATCH_SIZE):
+                created += list(self.model._default_manager.filter(
+                    **{'%s__in' % name: values[i:i + DEFAULT_BATCH_SIZE]}))
+        else:
+            created = self._fetch([m.pk for m in objs])
+        self._record_history(created, TYPE_ADDED)
+        return objs
+    bulk_create.alters_data = True
+
+    def _fetch(self, pks):
+        """
+        Returns:
+            The current instances with the provided primary keys.
+        """
+        objs = []
+        for i in range(0, len(pks), DEFAULT_BATCH_SIZE):
+            objs += list(self.model._default_manager.filter(
+                pk__in=pks[i:i + DEFAULT_BATCH_SIZE]))
+        return objs
+
+    def _record_history(self, objs, type):
+        tracker = self.model._history_tracker
+        if is_directly_versioned(self.model) and not self.model._meta.parents:
+            tracker.create_historical_records(objs, type)
+            return
+        # Concrete model inheritance spreads an object across tables, so
+        # we let the signal handlers work out what to record.
+        for m in objs:
+            tracker.post_save(tracker.model, m, created=(type == TYPE_ADDED))
+
+
+class TrackedManager(models.Manager):
+    """
+    Manager for versioned models that records history for
+    QuerySet.update() and bulk_create().  Use it in place of the default
+    manager::
+
+        class Page(models.Model):
+            ...
+            objects = TrackedManager()
+            history = TrackChanges()
+    """
+    def get_query_set(self):
+        return TrackedQuerySet(self.model, using=self._db)
+
+    def bulk_create(self, objs):
+        return self.get_query_set().bulk_create(objs)
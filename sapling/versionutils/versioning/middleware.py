@@ -2,6 +2,7 @@ import functools
 from django.db.models import signals
 
 from registry import FieldRegistry
+import cache
 
 # Ignore auto-tracking of user info on these HTTP methods
 IGNORE_USER_INFO_METHODS = (
@@ -48,3 +49,22 @@ class AutoTrackUserInfoMiddleware(object):
     def process_response(self, request, response):
         signals.pre_save.disconnect(dispatch_uid=request)
         return response
+
+
+class HistoryCacheMiddleware(object):
+    """
+    Optional middleware that caches historical lookups, such as the most
+    recent version of the objects a saved object's foreign keys point to
+    and the historical instances we've looked up, for the length of each
+    request.
+    """
+    def process_request(self, request):
+        cache.enable()
+
+    def process_response(self, request, response):
+        cache.disable()
+        return response
+
+    def process_exception(self, request, exception):
+        cache.disable()
+
@@ -1,19 +1,71 @@
+import sys
 import copy
+import threading
 from functools import partial
 
-from django.db import models
+from django.conf import settings
+from django.db import (models, connections, transaction, IntegrityError,
+    DEFAULT_DB_ALIAS)
+from django.db.models import Max, Count, F
 from django.db.models.options import DEFAULT_NAMES as ALL_META_OPTIONS
+from django.db.models.fields.related import add_lazy_relation
 
 from utils import *
+from bulk import bulk_insert, DEFAULT_BATCH_SIZE, SQLITE_MAX_VARIABLES
 from storage import *
 from constants import *
 from history_model_methods import get_history_fields
 from history_model_methods import get_history_methods
 import fields
 import manager
+import indexes
+import cache
+import delta
+import outbox
+import coalesce
+
+
+# How many times to try writing a historical record when other saves of
+# the object keep taking its version number.
+VERSION_NUMBER_ATTEMPTS = 3
 
 
 class TrackChanges(object):
+    def __init__(self, head_table=False, delta_fields=(),
+                 keyframe_interval=20, skip_unchanged=False,
+                 metadata_listings=False, lineage=False, deferred=False):
+        """
+        Args:
+            head_table: If True, keep a table pointing at the most recent
+                historical record of each object, so that
+                history.most_recent() doesn't have to sort the object's
+                history.
+            delta_fields: Names of TextFields to store as patches against
+                a periodic full copy (a keyframe) in the historical
+                model, rather than in full every time.
+            keyframe_interval: Maximum number of versions between
+                keyframes of the delta_fields.
+            skip_unchanged: If True, saving an object without changing
+                any of its fields doesn't write a new historical record.
+            metadata_listings: If True, history.page() only loads the
+                history_* fields of each historical record up front.  The
+                rest are loaded when they're accessed.
+            lineage: If True, give each object a lineage id, carried by
+                all of its historical records, and look up the object's
+                history by it.  The history then survives changes to the
+                object's unique fields.
+            deferred: If True, historical records are put in the outbox
+                when objects are saved, and written later.  See
+                versionutils.versioning.outbox.
+        """
+        self.head_table = head_table
+        self.delta_fields = delta_fields
+        self.keyframe_interval = keyframe_interval
+        self.skip_unchanged = skip_unchanged
+        self.metadata_listings = metadata_listings
+        self.lineage = lineage
+        self.deferred = deferred
+
     def contribute_to_class(self, cls, name):
         self.manager_name = name
         models.signals.class_prepared.connect(self.finalize, sender=cls)
@@ -32,8 +84,43 @@ class TrackChanges(object):
                 history_model = getattr(sender, hist_attr).model
         else:
             history_model = self.create_history_model(sender)
-
+            history_model._composite_indexes = self.get_composite_indexes(
+                sender, history_model)
+            history_model._unique_indexes = self.get_unique_indexes(
+                sender, history_model)
+            # The historical records of a concrete subclass are partly
+            # stored in its parents' tables, numbered by the subclass, so
+            # version numbers in those tables aren't unique.
+            for parent in history_model._meta.get_parent_list():
+                if hasattr(parent, '_unique_indexes'):
+                    parent._unique_indexes = []
+            models.signals.post_delete.connect(_invalidate_cache,
+                                               sender=history_model)
+            # Set explicitly, as historical models of subclasses would
+            # otherwise inherit their parent's head table.
+            history_model._head_model = None
+            if self.head_table:
+                history_model._head_model = self.create_head_model(
+                    sender, history_model)
+            history_model._delta_fields = [
+                f for f in history_model._meta.local_fields
+                if f.name in self.delta_fields
+            ]
+            history_model._keyframe_interval = self.keyframe_interval
+            history_model._metadata_listings = self.metadata_listings
+            # Lookups rewritten by HistoricalMetaInfoQuerySet, memoized.
+            history_model._lookup_rewrites = {}
+            # Historical models of subclasses inherit the lineage field.
+            history_model._lineage = 'history_lineage' in [
+                f.name for f in history_model._meta.fields]
+            if history_model._delta_fields:
+                models.signals.pre_delete.connect(_release_keyframe,
+                                                  sender=history_model)
+
+        self.model = sender
         setattr(sender, '_track_changes', True)
+        # Lets bulk operations write historical records.
+        setattr(sender, '_history_tracker', self)
 
         # Over-ride the save, delete methods to allow arguments to be passed in
         # such as comment="Made a small change."
@@ -108,6 +195,13 @@ class TrackChanges(object):
             attrs.update(get_history_fields(self, model))
             attrs.update(self.get_extra_history_fields(model))
         attrs.update(self.get_fields(model))
+        if self.delta_fields:
+            # The history_id of the keyframe this record's delta fields
+            # are patched against, or None if this record is a keyframe.
+            attrs['history_keyframe'] = models.IntegerField(null=True)
+        if self.lineage and not self._inherits_lineage(model):
+            # The history_id of the object's first historical record.
+            attrs['history_lineage'] = models.IntegerField(null=True)
 
         name = '%s_hist' % model._meta.object_name
         # If we have a parent (meaning we're concretely subclassing)
@@ -124,6 +218,116 @@ class TrackChanges(object):
             return type(name, (model.__base__,), attrs)
         return type(name, (models.Model,), attrs)
 
+    def _inherits_lineage(self, model):
+        if not model._meta.parents or not is_versioned(model.__base__):
+            return False
+        parent_fields = model.__base__.history.model._meta.fields
+        return 'history_lineage' in [f.name for f in parent_fields]
+
+    def create_head_model(self, model, history_model):
+        """
+        Creates a model, <originalmodel>_hist_head, with a row per object
+        pointing at the object's most recent historical record.  Objects
+        are keyed by head_key_for() their history lookup.
+
+        Returns:
+            Class representing the head table of the historical model.
+        """
+        related_name = '%s_head' % model._meta.object_name.lower()
+        attrs = {
+            '__module__': model.__module__,
+            'key': models.CharField(max_length=40, unique=True),
+            # Deleting historical records (e.g. when reverting) leaves
+            # the pointer empty and most_recent() falls back to sorting
+            # the object's history.
+            'version': models.ForeignKey(history_model, null=True,
+                                         on_delete=models.SET_NULL,
+                                         related_name=related_name),
+        }
+        history_model._head_lookup = '%s%skey' % (related_name, LOOKUP_SEP)
+        name = '%s_hist_head' % model._meta.object_name
+        return type(name, (models.Model,), attrs)
+
+    def get_composite_indexes(self, model, history_model):
+        """
+        Multi-column indexes to create on the historical model's table.
+
+        The history of an object is looked up by its unique fields (or its
+        primary key, or its lineage if it has one) and then sorted by date,
+        so we index these together.  Lookups that span tables can't be
+        indexed this way, so no index is created for those.  Looking up a
+        version uses the index from get_unique_indexes().
+
+        The indexes of a model can be set in the VERSIONING_INDEXES
+        setting instead, a dictionary mapping "app_label.ModelName" to a
+        list of indexes in the same form as the return value.
+
+        Args:
+            model: The model being versioned.
+            history_model: The historical model class for model.
+
+        Returns:
+            A list of tuples of field names on the historical model, each
+            optionally prefixed with "-" for a descending column.  Each
+            tuple is created as a single multi-column index when syncdb
+            creates the historical model's table.
+        """
+        custom = getattr(settings, 'VERSIONING_INDEXES', {})
+        label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        if label in custom:
+            return [tuple(index) for index in custom[label]]
+
+        # all(), most_recent(), as_of(date=..) and page(), newest first.
+        index = self._identity_fields(model, history_model) + (
+            '-history_date', '-history_id')
+        return self._local_indexes(history_model, [index])
+
+    def get_unique_indexes(self, model, history_model):
+        """
+        Multi-column UNIQUE indexes to create on the historical model's
+        table.
+
+        Version numbers are handed out one past the object's latest, so
+        two saves of the same object running at the same time could pick
+        the same number.  A unique index on the object's identity and the
+        version number makes the second one fail, and it's retried with
+        the next number.  The index also serves as_of(version=..).
+
+        Returns:
+            A list of tuples of field names on the historical model, in
+            the same form as get_composite_indexes().
+        """
+        index = self._identity_fields(model, history_model) + (
+            'history_version_number',)
+        return self._local_indexes(history_model, [index])
+
+    def _identity_fields(self, model, history_model):
+        """
+        Returns:
+            A tuple of the names of the fields the history of an object
+            is looked up by.
+        """
+        if 'history_lineage' in [f.name for f in history_model._meta.fields]:
+            return ('history_lineage',)
+        lookups = unique_lookup_fields_for(model)
+        if not lookups:
+            lookups = [model._meta.pk.name]
+        return tuple(lookups)
+
+    def _local_indexes(self, history_model, candidates):
+        """
+        Returns:
+            The indexes among candidates whose fields are all stored in
+            the historical model's own table.
+        """
+        local_names = [f.name for f in history_model._meta.local_fields]
+        indexes = []
+        for index in candidates:
+            if [n for n in index if n.lstrip('-') not in local_names]:
+                continue
+            indexes.append(index)
+        return indexes
+
     def wrap_model_fields(self, model):
         """
         Wrap some of the model's fields to add extra behavior.
@@ -220,9 +424,9 @@ class TrackChanges(object):
             for k in TrackChanges.M2M_FIELDS_TO_COPY:
                 if hasattr(field, k):
                     opts[k] = getattr(field, k, None)
-            # XXX TODO deal with intermediate tables
-            if hasattr(field, 'through'):
-                pass
+            # The historical relation always gets an automatically
+            # created intermediate table, even if the field has its own
+            # through model: see m2m_through_changed().
             return opts
 
         attrs = {}
@@ -247,6 +451,12 @@ class TrackChanges(object):
                 # Don't set auto_now=True historical models' fields.
                 field.auto_now = False
 
+            if field.name in self.delta_fields:
+                if not isinstance(field, models.TextField):
+                    raise TypeError("delta_fields must be TextFields, "
+                                    "%s isn't" % field.name)
+                field = delta.make_delta_field(field)
+
             is_fk = isinstance(field, models.ForeignKey)
             is_m2m = isinstance(field, models.ManyToManyField)
             if is_fk or is_m2m:
@@ -267,11 +477,15 @@ class TrackChanges(object):
                     else:
                         model_type = models.ManyToManyField
                         options = _get_m2m_opts(field)
-                        _m2m_changed = partial(self.m2m_changed, field.attname)
-                        models.signals.m2m_changed.connect(_m2m_changed,
-                            sender=getattr(model, field.attname).through,
-                            weak=False,
-                        )
+                        through = field.rel.through
+                        if isinstance(through, basestring):
+                            # The through model isn't defined yet.
+                            add_lazy_relation(model, field, through,
+                                lambda f, through, cls:
+                                    self._connect_m2m_signals(cls, f,
+                                                              through))
+                        else:
+                            self._connect_m2m_signals(model, field, through)
                     if is_to_self:
                         # Fix related name conflict. We set this manually
                         # elsewhere so giving this a funky name isn't a
@@ -357,8 +571,10 @@ class TrackChanges(object):
             history_type = TYPE_REVERTED_ADDED if is_revert else TYPE_ADDED
         else:
             history_type = history_type or TYPE_UPDATED
-        self.create_historical_record(instance, history_type)
-        self.m2m_init(instance)
+        hm = self.create_historical_record(instance, history_type)
+        if hm is not None and not created:
+            # New objects aren't related to anything yet.
+            self.m2m_init(instance, hm)
 
     def pre_delete(self, parent, instance, **kws):
         # To support subclassing.
@@ -406,25 +622,150 @@ class TrackChanges(object):
         is_revert = history_type == TYPE_REVERTED
         history_type = TYPE_REVERTED_DELETED if is_revert else TYPE_DELETED
         if not is_pk_recycle_a_problem(instance) and instance._track_changes:
+            # Deleting the object deleted its m2m relations, so the
+            # historical record is left without any.
             self.create_historical_record(instance, history_type)
-            self.m2m_init(instance)
 
-        # Disconnect the related objects signals
-        if hasattr(instance, '_rel_objs_methods'):
-            for model, method in instance._rel_objs_methods.iteritems():
-                models.signals.pre_delete.disconnect(method, model, weak=False)
+    def m2m_init(self, instance, hm):
+        """
+        Initialize the ManyToMany sets on a new historical instance, hm,
+        by carrying forward the sets of the object's previous historical
+        record.  m2m_changed() keeps those up to date, so the object's
+        relations needn't be read again.
+        """
+        if not self._versioned_m2m_fields(instance.__class__):
+            return
+        history = getattr(instance, self.manager_name)
+        previous = history.exclude(history_id=hm.history_id).order_by(
+            '-history_id').values_list('history_id', flat=True)
+        previous = list(previous[:1])
+        if previous:
+            self._carry_historical_m2m([instance], previous,
+                                       [hm.history_id])
+
+    def _versioned_m2m_fields(self, model):
+        return [f for f in model._meta.many_to_many
+                if is_versioned(f.related.parent_model)]
+
+    def _carry_historical_m2m(self, instances, previous, new):
+        """
+        Copies the versioned m2m relations of the previous historical
+        record of each of instances to its new one.  The copies point at
+        the most recent historical records of the related objects, leaving
+        out objects deleted since.  This is an INSERT ... SELECT per field
+        and batch of instances, however many related objects there are.
 
-    def m2m_init(self, instance):
+        Args:
+            instances: A list of saved instances of a single model.  The
+                relations are copied in the database they were saved to.
+            previous: The history_id of the previous historical record of
+                each of instances.
+            new: The history_id of the new historical record of each of
+                instances.
+        """
+        model = instances[0].__class__
+        using = instances[0]._state.db or DEFAULT_DB_ALIAS
+        connection = connections[using]
+        batch_size = DEFAULT_BATCH_SIZE
+        if connection.vendor == 'sqlite':
+            batch_size = SQLITE_MAX_VARIABLES // 3
+        carried = [(p, n) for p, n in zip(previous, new)
+                   if p is not None and n is not None]
+        cursor = connection.cursor()
+        for field in self._versioned_m2m_fields(model):
+            sql = self._carry_m2m_sql(field, connection)
+            if sql is None:
+                self._reset_historical_m2m(field, instances, new)
+                continue
+            for i in range(0, len(carried), batch_size):
+                batch = carried[i:i + batch_size]
+                params = []
+                for previous_id, new_id in batch:
+                    params += [previous_id, new_id]
+                params += [previous_id for previous_id, new_id in batch]
+                cursor.execute(sql % {
+                    'cases': ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                    'ids': ', '.join(['%s'] * len(batch)),
+                }, params)
+        transaction.commit_unless_managed(using=using)
+
+    def _carry_m2m_sql(self, field, connection):
+        """
+        Returns:
+            A template for the INSERT ... SELECT statement that copies the
+            historical relation mirroring the m2m field, or None if the
+            related objects' history can't be looked up by a single
+            column.
+        """
+        target = field.rel.to
+        target_history = getattr(target, target._history_manager_name)
+        key = target_history._pk_lookup_name()
+        if LOOKUP_SEP in key:
+            return None
+        through, source_name, target_name = self._historical_m2m(field)
+        qn = connection.ops.quote_name
+        names = {
+            'through': qn(through._meta.db_table),
+            'source': qn(through._meta.get_field(source_name).column),
+            'target': qn(through._meta.get_field(target_name).column),
+            'hist': qn(target_history.model._meta.db_table),
+            'id': qn(target_history.model._meta.get_field(
+                'history_id').column),
+            'key': qn(target_history.model._meta.get_field(key).column),
+            'table': qn(target._meta.db_table),
+            'pk': qn(target._meta.pk.column),
+        }
+        return (
+            'INSERT INTO %(through)s (%(source)s, %(target)s) '
+            'SELECT CASE link.%(source)s %%(cases)s END, MAX(latest.%(id)s) '
+            'FROM %(through)s link '
+            'INNER JOIN %(hist)s linked ON linked.%(id)s = link.%(target)s '
+            'INNER JOIN %(table)s obj ON obj.%(pk)s = linked.%(key)s '
+            'INNER JOIN %(hist)s latest ON latest.%(key)s = linked.%(key)s '
+            'WHERE link.%(source)s IN (%%(ids)s) '
+            'GROUP BY link.%(source)s, linked.%(key)s'
+        ) % names
+
+    def _reset_historical_m2m(self, field, instances, new):
+        """
+        Links each of the new historical records to the most recent
+        historical records of the objects the instance is currently
+        related to via the m2m field.
         """
-        Initialize the ManyToMany sets on a historical instance.
+        through, source_name, target_name = self._historical_m2m(field)
+        source_attname = through._meta.get_field(source_name).attname
+        target_attname = through._meta.get_field(target_name).attname
+        links = []
+        for m, new_id in zip(instances, new):
+            if new_id is None:
+                continue
+            pks = getattr(m, field.attname).values_list('pk', flat=True)
+            for target_id in self._latest_historical_ids_of(field.rel.to,
+                                                            list(pks)):
+                links.append(through(**{source_attname: new_id,
+                                        target_attname: target_id}))
+        bulk_insert(through, links)
+
+    def _connect_m2m_signals(self, model, field, through):
+        """
+        Connects the signal handlers that sync the m2m field's relation
+        with its historical relation.
         """
-        hist_instance = instance.history.most_recent()
-        for field in instance._meta.many_to_many:
-            if is_versioned(field.related.parent_model):
-                current_objs = getattr(instance, field.attname).all()
-                setattr(hist_instance, field.attname,
-                        [o.history.most_recent() for o in current_objs]
-                )
+        if through._meta.auto_created:
+            _m2m_changed = partial(self.m2m_changed, field.attname)
+            models.signals.m2m_changed.connect(_m2m_changed, sender=through,
+                                               weak=False)
+        else:
+            # Through models are written to directly, so m2m_changed
+            # isn't sent.
+            _m2m_changed = partial(self.m2m_through_changed, model,
+                                   field.name)
+            models.signals.pre_save.connect(_m2m_changed, sender=through,
+                                            weak=False)
+            models.signals.post_save.connect(_m2m_changed, sender=through,
+                                             weak=False)
+            models.signals.post_delete.connect(_m2m_changed, sender=through,
+                                               weak=False)
 
     def m2m_changed(self, attname, sender, instance, action, reverse,
                     model, pk_set, **kwargs):
@@ -435,60 +776,804 @@ class TrackChanges(object):
         Args:
             attname: Attribute name of the m2m field on the base model.
         """
-        if pk_set:
-            changed_ms = [model.objects.get(pk=pk) for pk in pk_set]
-            hist_changed_ms = [m.history.most_recent() for m in changed_ms]
-        hist_instance = instance.history.most_recent()
-        hist_through = getattr(hist_instance, attname)
-        if action == 'post_add':
-            for hist_m in hist_changed_ms:
-                hist_through.add(hist_m)
-        elif action == 'post_remove':
-            for hist_m in hist_changed_ms:
-                hist_through.remove(hist_m)
-        elif action == 'post_clear':
-            hist_through.clear()
+        # The links go on the most recent historical records.
+        coalesce.write_held()
+        outbox.sync()
+        if reverse:
+            field = model._meta.get_field(attname)
+        else:
+            field = instance._meta.get_field(attname)
+
+        if action == 'post_clear' and not reverse:
+            self._clear_historical_m2m(field, instance.pk)
+            return
+        if action == 'pre_clear' and reverse:
+            # The objects being cleared aren't passed along, so look them
+            # up while they're still there.
+            pk_set = set(sender._default_manager.filter(
+                **{field.m2m_reverse_field_name(): instance.pk}
+            ).values_list(field.m2m_field_name(), flat=True))
+            action = 'post_remove'
+        if action not in ('post_add', 'post_remove') or not pk_set:
+            return
+
+        if reverse:
+            source_pks, target_pks = pk_set, [instance.pk]
+        else:
+            source_pks, target_pks = [instance.pk], pk_set
+        self._sync_historical_m2m(field, action == 'post_add', source_pks,
+                                  target_pks)
+
+    def m2m_through_changed(self, model, name, sender, instance, signal,
+                            **kws):
+        """
+        A pre_save, post_save and post_delete signal handler for the
+        through model of an m2m relation, which syncs the row with the
+        historical relation.
+
+        Args:
+            model: The model the m2m field is defined on.
+            name: Name of the m2m field.
+        """
+        field = model._meta.get_field(name)
+        source_name = field.m2m_field_name()
+        target_name = field.m2m_reverse_field_name()
+        if signal is models.signals.pre_save:
+            # A row saved again may point at other objects now, so look
+            # up the ones it pointed at before.
+            was = []
+            if instance.pk is not None:
+                was = sender._default_manager.filter(
+                    pk=instance.pk).values_list(source_name, target_name)
+            instance._historical_m2m_was = (list(was) or [None])[0]
+            return
+
+        coalesce.write_held()
+        outbox.sync()
+        source_pk = getattr(instance,
+                            sender._meta.get_field(source_name).attname)
+        target_pk = getattr(instance,
+                            sender._meta.get_field(target_name).attname)
+        if signal is models.signals.post_delete:
+            # Rows deleted along with either object are part of the
+            # object's deletion, not a change to the relation.
+            target = field.rel.to
+            if (not model._base_manager.filter(pk=source_pk).exists() or
+                    not target._base_manager.filter(pk=target_pk).exists()):
+                return
+        else:
+            was = getattr(instance, '_historical_m2m_was', None)
+            if was is not None and was != (source_pk, target_pk):
+                self._sync_historical_m2m(field, False, [was[0]], [was[1]])
+        self._sync_historical_m2m(field, signal is models.signals.post_save,
+                                  [source_pk], [target_pk])
+
+    def _historical_m2m(self, field):
+        """
+        Returns:
+            A tuple of the intermediate model of the historical relation
+            that mirrors the m2m field, and the names of its fields
+            pointing at the source and at the target historical records.
+        """
+        history_model = getattr(field.model, self.manager_name).model
+        hist_field = history_model._meta.get_field(field.name)
+        return (hist_field.rel.through, hist_field.m2m_field_name(),
+                hist_field.m2m_reverse_field_name())
+
+    def _latest_historical_ids_of(self, model, pks):
+        """
+        Returns:
+            A list of the history_id of the most recent historical record
+            of each of the objects of model with the provided primary keys.
+            Objects without a history are left out.
+        """
+        history = getattr(model, model._history_manager_name)
+        latest = self._latest_historical_ids(
+            history.model, history._pk_lookup_name(), pks)
+        return [latest[pk] for pk in set(pks) if pk in latest]
+
+    def _sync_historical_m2m(self, field, add, source_pks, target_pks):
+        """
+        Links (or unlinks) the most recent historical records of the
+        source objects to those of the target objects in the historical
+        relation mirroring the m2m field.  Costs a query to look up each
+        side's historical records and one or two to write the links,
+        however many objects there are.
+
+        Args:
+            field: An m2m field to a versioned model.
+            add: If True, add the links, otherwise remove them.
+            source_pks: Primary keys of objects of the model field is
+                defined on.
+            target_pks: Primary keys of objects of the model field points
+                at.
+        """
+        sources = self._latest_historical_ids_of(field.model, source_pks)
+        targets = self._latest_historical_ids_of(field.rel.to, target_pks)
+        if not sources or not targets:
+            return
+        through, source_name, target_name = self._historical_m2m(field)
+        links = through._default_manager.filter(**{
+            '%s__in' % source_name: sources,
+            '%s__in' % target_name: targets,
+        })
+        if not add:
+            links.delete()
+            return
+
+        existing = set(links.values_list(source_name, target_name))
+        source_attname = through._meta.get_field(source_name).attname
+        target_attname = through._meta.get_field(target_name).attname
+        bulk_insert(through, [
+            through(**{source_attname: source_id, target_attname: target_id})
+            for source_id in sources for target_id in targets
+            if (source_id, target_id) not in existing
+        ])
+
+    def _clear_historical_m2m(self, field, pk):
+        """
+        Removes every link from the most recent historical record of the
+        object with the provided primary key in the historical relation
+        mirroring the m2m field.
+        """
+        sources = self._latest_historical_ids_of(field.model, [pk])
+        if not sources:
+            return
+        through, source_name, target_name = self._historical_m2m(field)
+        through._default_manager.filter(
+            **{'%s__in' % source_name: sources}).delete()
 
     def create_historical_record(self, instance, type):
-        manager = getattr(instance, self.manager_name)
+        """
+        Writes a historical record of the instance, or puts it in the
+        outbox if the model's history is deferred, or holds it back if
+        we're in a coalesce_history() block.
+
+        Returns:
+            The new historical instance, or None if no record was
+            written.
+        """
         # If they set track_changes to False
         # then we don't auto-create a revision here.
         if not instance._track_changes:
+            return None
+        if coalesce.is_active():
+            coalesce.hold(self, instance, type)
+            return None
+        if self.deferred:
+            outbox.put(self, instance, type)
+            return None
+        return self._write_historical_record(instance, type)
+
+    def _write_historical_record(self, instance, type):
+        manager = getattr(instance, self.manager_name)
+        history = manager
+        if manager.model._lineage:
+            lineage = self._lineages(instance.__class__, [instance])[0]
+            # The object may have been re-created, or its unique fields
+            # changed, since its last historical record.
+            history = getattr(instance.__class__, self.manager_name)
+            if lineage is not None:
+                history = history.filter(history_lineage=lineage)
+            else:
+                # A new lineage has no history yet, even if the object's
+                # primary key belonged to a deleted object.
+                history = history.filter(history_id__in=[])
+        digest = digest_of(instance)
+        if self.skip_unchanged and type == TYPE_UPDATED:
+            latest = history.values_list('history_digest', flat=True)
+            if list(latest[:1]) == [digest]:
+                return None
+        latest_ids = self._resolve_versioned_foreign_keys(
+            [instance], self._saved_at(instance))
+        attrs = self._get_historical_attrs(instance, latest_ids)
+        attrs.update(self._get_save_with_attrs(instance))
+        attrs['history_digest'] = digest
+        attrs['history_version_number'] = self._next_version_number(history)
+        if manager.model._lineage:
+            attrs['history_lineage'] = lineage
+        keyframe = self._encode_deltas(history, attrs)
+
+        def insert():
+            return manager.create(history_type=type, **attrs)
+
+        def renumber():
+            attrs['history_version_number'] = self._next_version_number(
+                history)
+        hm = self._insert_numbered(insert, renumber)
+        if manager.model._lineage and lineage is None:
+            # A new object starts a new lineage.
+            manager.model._base_manager.filter(history_id=hm.pk).update(
+                history_lineage=hm.pk)
+            hm.history_lineage = hm.pk
+        cache.invalidate(manager.model)
+        if keyframe:
+            delta.remember_keyframe(manager.model, hm.pk, keyframe)
+        if manager.model._head_model is not None:
+            self._set_heads(manager.model, {manager.head_key(): hm.pk})
+        return hm
+
+    def create_historical_records(self, instances, type):
+        """
+        Like create_historical_record(), but for many instances of the
+        same model at once.  Versioned foreign keys are resolved with a
+        single query per related model and the historical records are
+        written using multi-row INSERTs.
+
+        Args:
+            instances: A list of saved instances of a single model.
+            type: The history type to record, e.g. TYPE_UPDATED.
+        """
+        instances = [m for m in instances if m._track_changes]
+        if coalesce.is_active():
+            for m in instances:
+                coalesce.hold(self, m, type)
             return
-        attrs = {}
-        for field in instance._meta.fields:
-            if isinstance(field, models.fields.related.ForeignKey):
-                is_fk_to_self = (field.related.parent_model ==
-                                 instance.__class__)
-                if is_versioned(field.related.parent_model) or is_fk_to_self:
-                    if field.rel.parent_link:
-                        # Concrete model inheritance and the parent is
-                        # versioned.  In this case, we subclass the
-                        # parent historical model and use that parent
-                        # related field instead.
-                        continue
+        if self.deferred:
+            for m in instances:
+                outbox.put(self, m, type)
+            return
+        self.write_historical_records(instances, type)
 
-                    # If the FK field is versioned, set it to the most
-                    # recent version of that object.
-                    # The object the FK id refers to may have been
-                    # deleted so we can't simply do Model.objects.get().
-                    fk_hist_model = field.rel.to.history.model
-                    fk_id_name = field.rel.field_name
-                    fk_id_val = getattr(instance, field.attname)
-                    fk_objs = fk_hist_model.objects.filter(
-                        **{fk_id_name: fk_id_val}
-                    )
-
-                    if fk_objs:
-                        attrs[field.name] = fk_objs[0]  # most recent version
-                    else:
-                        attrs[field.name] = None
+    def write_historical_records(self, instances, type):
+        """
+        Writes historical records of instances right away, even if the
+        model's history is deferred.  Used to drain the outbox.
+        """
+        if not instances:
+            return
+        model = instances[0].__class__
+        if model._meta.parents:
+            # Concrete model inheritance spreads the historical record
+            # across tables, so it's written one at a time.
+            for m in instances:
+                hm = self._write_historical_record(m, type)
+                if hm is not None and type in (TYPE_UPDATED, TYPE_REVERTED):
+                    self.m2m_init(m, hm)
+            return
+        history_model = getattr(model, self.manager_name).model
+        digests = dict([(id(m), digest_of(m)) for m in instances])
+        if self.skip_unchanged and type == TYPE_UPDATED:
+            instances = self._changed(model, instances, digests)
+            if not instances:
+                return
+
+        if not self.deferred:
+            latest_ids = self._resolve_versioned_foreign_keys(instances)
+        if history_model._lineage:
+            lineages = self._lineages(model, instances)
+            version_numbers = self._lineage_version_numbers(
+                history_model, instances, lineages)
+        else:
+            lineages = None
+            version_numbers = self._next_version_numbers(model, instances)
+        carry_m2m = (type in (TYPE_UPDATED, TYPE_REVERTED) and
+                     self._versioned_m2m_fields(model))
+        if carry_m2m:
+            previous = self._current_history_ids(model, instances, lineages)
+        records = []
+        for i, m in enumerate(instances):
+            if self.deferred:
+                latest_ids = self._resolve_versioned_foreign_keys(
+                    [m], self._saved_at(m))
+            attrs = self._get_historical_attrs(m, latest_ids)
+            attrs.update(self._get_save_with_attrs(m))
+            attrs['history_version_number'] = version_numbers[i]
+            attrs['history_digest'] = digests[id(m)]
+            if lineages is not None:
+                attrs['history_lineage'] = lineages[i]
+            self._encode_deltas(getattr(m, self.manager_name), attrs)
+            records.append(history_model(history_type=type, **attrs))
+
+        def insert():
+            bulk_insert(history_model, records)
+
+        def renumber():
+            if lineages is not None:
+                numbers = self._lineage_version_numbers(
+                    history_model, instances, lineages)
+            else:
+                numbers = self._next_version_numbers(model, instances)
+            for record, number in zip(records, numbers):
+                record.history_version_number = number
+        self._insert_numbered(insert, renumber)
+        if lineages is not None and None in lineages:
+            # New objects start new lineages.
+            history = getattr(model, self.manager_name)
+            new_pks = [m.pk for m, lineage in zip(instances, lineages)
+                       if lineage is None]
+            for i in range(0, len(new_pks), DEFAULT_BATCH_SIZE):
+                history.filter(**{
+                    '%s__in' % history._pk_lookup_name():
+                        new_pks[i:i + DEFAULT_BATCH_SIZE],
+                    'history_lineage__isnull': True,
+                }).update(history_lineage=F('history_id'))
+        cache.invalidate(history_model)
+        if history_model._head_model is not None:
+            self._set_bulk_heads(model, instances)
+
+        if carry_m2m:
+            # New objects have nothing to carry, so the lineages looked
+            # up before writing will do.
+            self._carry_historical_m2m(
+                instances, previous,
+                self._current_history_ids(model, instances, lineages))
+
+    def _changed(self, model, instances, digests):
+        """
+        Returns:
+            The instances whose digest differs from the digest of their
+            most recent historical record.
+        """
+        history_model = getattr(model, self.manager_name).model
+        latest = self._latest_history_ids(model, instances)
+        if latest is None:
+            changed = []
+            for m in instances:
+                history = getattr(m, self.manager_name)
+                latest = history.values_list('history_digest', flat=True)
+                if list(latest[:1]) != [digests[id(m)]]:
+                    changed.append(m)
+            return changed
+        ids = [i for i in set(latest) if i is not None]
+        stored = {}
+        for i in range(0, len(ids), DEFAULT_BATCH_SIZE):
+            stored.update(history_model.objects.filter(
+                history_id__in=ids[i:i + DEFAULT_BATCH_SIZE]).values_list(
+                    'history_id', 'history_digest'))
+        return [m for m, i in zip(instances, latest)
+                if stored.get(i) != digests[id(m)]]
+
+    def _encode_deltas(self, manager, attrs):
+        """
+        Replaces the values of the delta fields in attrs with patches
+        against the object's most recent keyframe, unless it's time for
+        a new keyframe.
+
+        Args:
+            manager: The instance-bound history manager of the object.
+            attrs: The attributes of the historical record to be written.
+
+        Returns:
+            A dictionary of the delta fields' values if the record is a
+            keyframe, otherwise None.
+        """
+        history_model = manager.model
+        fields = history_model._delta_fields
+        if not fields:
+            return None
+        full = dict([(f.attname, attrs.get(f.attname)) for f in fields])
+        attrs['history_keyframe'] = None
+
+        latest = manager.filter(history_keyframe__isnull=True).order_by(
+            '-history_id').values_list('history_id', 'history_version_number')
+        latest = latest[:1]
+        if not latest:
+            return full
+        keyframe_id, keyframe_number = latest[0]
+        number = attrs['history_version_number']
+        if (keyframe_number is None or
+            number - keyframe_number >= history_model._keyframe_interval):
+            return full
+
+        keyframe = delta.get_keyframe(history_model, keyframe_id)
+        patches = {}
+        for attname, text in full.iteritems():
+            if text is None:
+                patches[attname] = None
+                continue
+            patch = delta.encode(keyframe[attname] or u'', text)
+            if patch is None or len(patch) >= len(text):
+                # Not worth patching.
+                return full
+            patches[attname] = patch
+        attrs.update(patches)
+        attrs['history_keyframe'] = keyframe_id
+        return None
+
+    def _set_heads(self, history_model, heads):
+        """
+        Args:
+            history_model: A historical model with a head table.
+            heads: A dictionary mapping head keys to the history_id of the
+                object's most recent historical record.
+        """
+        head_model = history_model._head_model
+        # Update the rows in place rather than replacing them, so that
+        # saves of the same object running at the same time don't both
+        # try to insert its row.
+        missing = dict([(k, v) for k, v in heads.iteritems()
+            if not head_model.objects.filter(key=k).update(version=v)])
+        if not missing:
+            return
+        sid = transaction.savepoint()
+        try:
+            bulk_insert(head_model, [head_model(key=k, version_id=v)
+                                     for k, v in missing.iteritems()])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Some of the rows were inserted by another save in the
+            # meantime, so they can be updated now.
+            transaction.savepoint_rollback(sid)
+            for k, v in missing.iteritems():
+                if not head_model.objects.filter(key=k).update(version=v):
+                    head_model.objects.create(key=k, version_id=v)
+
+    def _delete_heads(self, history_model, keys):
+        head_model = history_model._head_model
+        for i in range(0, len(keys), DEFAULT_BATCH_SIZE):
+            head_model.objects.filter(
+                key__in=keys[i:i + DEFAULT_BATCH_SIZE]).delete()
+
+    def _set_bulk_heads(self, model, instances):
+        """
+        Points the head table at the historical records just written for
+        instances by create_historical_records().
+        """
+        history_model = getattr(model, self.manager_name).model
+        keys = [head_key_for(getattr(m, self.manager_name)._identity_lookup())
+                for m in instances]
+        latest = self._latest_history_ids(model, instances)
+        if latest is None:
+            # Not a simple column lookup, so we can't find the new heads
+            # with a single query.  Forget the old heads and have
+            # most_recent() fall back to sorting the history.
+            self._delete_heads(history_model, list(set(keys)))
+            return
+        self._set_heads(history_model, dict(zip(keys, latest)))
+
+    def _identity_column(self, model):
+        """
+        Returns:
+            The name of the single column that identifies objects of
+            model in its historical model, or None if there isn't one,
+            e.g. if the model is unique_together.
+        """
+        lookups = unique_lookup_fields_for(model)
+        if not lookups and not model._meta.parents:
+            lookups = [model._meta.pk.name]
+        if len(lookups) != 1 or LOOKUP_SEP in lookups[0]:
+            return None
+        return lookups[0]
+
+    def _latest_history_ids(self, model, instances):
+        """
+        Returns:
+            A list of the history_id of the most recent historical record
+            of each of instances (None if there isn't one), in the same
+            order as instances.  Or None if the objects can't be looked
+            up in bulk.
+        """
+        name = self._identity_column(model)
+        if name is None:
+            return None
+        history_model = getattr(model, self.manager_name).model
+        attname = model._meta.get_field(name).attname
+        keys = [getattr(m, attname) for m in instances]
+        unique_keys = list(set(keys))
+        latest = {}
+        for i in range(0, len(unique_keys), DEFAULT_BATCH_SIZE):
+            qs = history_model.objects.filter(
+                **{'%s__in' % name: unique_keys[i:i + DEFAULT_BATCH_SIZE]}
+            )
+            qs = qs.order_by().values(name).annotate(Max('history_id'))
+            for row in qs:
+                latest[row[name]] = row['history_id__max']
+        return [latest.get(k) for k in keys]
+
+    def _current_history_ids(self, model, instances, lineages=None):
+        """
+        Args:
+            lineages: For models with lineages, the lineage of each of
+                instances, as returned by _lineages().  Looked up if not
+                provided.
+
+        Returns:
+            A list of the history_id of the most recent historical record
+            of each of instances (None if there isn't one), in the same
+            order as instances.
+        """
+        history_model = getattr(model, self.manager_name).model
+        if history_model._lineage:
+            if lineages is None:
+                lineages = self._lineages(model, instances)
+            return self._latest_lineage_ids(history_model, lineages)
+        ids = self._latest_history_ids(model, instances)
+        if ids is None:
+            ids = []
+            for m in instances:
+                latest = getattr(m, self.manager_name).order_by(
+                    '-history_id').values_list('history_id', flat=True)
+                ids.append((list(latest[:1]) or [None])[0])
+        return ids
+
+    def _latest_lineage_ids(self, history_model, lineages):
+        """
+        Returns:
+            A list of the history_id of the most recent historical record
+            in each of lineages (None for a lineage of None), in the same
+            order as lineages.
+        """
+        known = list(set([l for l in lineages if l is not None]))
+        latest = {}
+        for i in range(0, len(known), DEFAULT_BATCH_SIZE):
+            qs = history_model.objects.filter(
+                history_lineage__in=known[i:i + DEFAULT_BATCH_SIZE])
+            qs = qs.order_by().values('history_lineage').annotate(
+                Max('history_id'))
+            for row in qs:
+                latest[row['history_lineage']] = row['history_id__max']
+        return [latest.get(l) for l in lineages]
+
+    def _versioned_foreign_keys(self, model):
+        """
+        Returns:
+            The ForeignKey fields of model that point at versioned models,
+            and so point at historical models on the historical model.
+        """
+        fks = []
+        for field in model._meta.fields:
+            if not isinstance(field, models.fields.related.ForeignKey):
+                continue
+            is_fk_to_self = field.related.parent_model == model
+            if is_versioned(field.related.parent_model) or is_fk_to_self:
+                if field.rel.parent_link:
+                    # Concrete model inheritance and the parent is
+                    # versioned.  In this case, we subclass the
+                    # parent historical model and use that parent
+                    # related field instead.
                     continue
+                fks.append(field)
+        return fks
+
+    def _get_historical_attrs(self, instance, latest_ids):
+        """
+        Args:
+            instance: A model instance.
+            latest_ids: The result of _resolve_versioned_foreign_keys()
+                for a list containing instance.
 
+        Returns:
+            A dictionary mapping field attnames on the historical model
+            to their values for a historical record of instance.
+        """
+        attrs = {}
+        versioned_fks = self._versioned_foreign_keys(instance.__class__)
+        for field in instance._meta.fields:
+            if field in versioned_fks:
+                # If the FK field is versioned, set it to the most
+                # recent version of that object.
+                attrs[field.attname] = latest_ids[field.name].get(
+                    getattr(instance, field.attname))
+                continue
+            if (field.rel and field.rel.parent_link and
+                is_versioned(field.rel.to)):
+                continue
             attrs[field.attname] = getattr(instance, field.attname)
+        return attrs
 
-        attrs.update(self._get_save_with_attrs(instance))
-        manager.create(history_type=type, **attrs)
+    def _resolve_versioned_foreign_keys(self, instances, date=None):
+        """
+        Looks up the historical records that the versioned foreign keys
+        of instances should point to on their historical records.  Costs
+        at most a single query per related historical model, however long
+        the histories are.
+
+        Args:
+            instances: A list of instances of a single model.
+            date: If provided, look up the most recent versions as of
+                this date rather than now.
+
+        Returns:
+            A dictionary mapping the name of each versioned ForeignKey
+            field to a dictionary mapping the field's values to the
+            history_id of the most recent version of the related object.
+        """
+        if not instances:
+            return {}
+        fks = self._versioned_foreign_keys(instances[0].__class__)
+        # Fields pointing at the same object, e.g. two ForeignKeys to
+        # the same model, can share a single lookup.
+        values = {}
+        for field in fks:
+            target = (field.rel.to.history.model, field.rel.field_name)
+            values.setdefault(target, set()).update(
+                [getattr(m, field.attname) for m in instances])
+        resolved = {}
+        for target, vals in values.iteritems():
+            fk_hist_model, fk_id_name = target
+            resolved[target] = self._latest_historical_ids(
+                fk_hist_model, fk_id_name, vals, date)
+        return dict(
+            [(field.name, resolved[(field.rel.to.history.model,
+                                    field.rel.field_name)])
+             for field in fks]
+        )
+
+    def _latest_historical_ids(self, fk_hist_model, fk_id_name, values,
+                               date=None):
+        """
+        Args:
+            fk_hist_model: The historical model of a versioned model.
+            fk_id_name: Name of the field on the historical model that
+                the values refer to.
+            values: A list of values of the field.
+            date: If provided, only consider historical records up to
+                this date.
+
+        Returns:
+            A dictionary mapping each of the values to the history_id of
+            the most recent historical record of the object it refers to.
+            Uses the request's cache, if enabled and date isn't provided.
+        """
+        values = [v for v in set(values) if v is not None]
+        if date is None:
+            latest, values = cache.get_latest_ids(fk_hist_model, fk_id_name,
+                                                  values)
+        else:
+            latest = {}
+        for i in range(0, len(values), DEFAULT_BATCH_SIZE):
+            qs = fk_hist_model.objects.filter(
+                **{'%s__in' % fk_id_name: values[i:i + DEFAULT_BATCH_SIZE]}
+            )
+            if date is not None:
+                qs = qs.filter(history_date__lte=date)
+            qs = qs.order_by().values(fk_id_name).annotate(Max('history_id'))
+            for row in qs:
+                latest[row[fk_id_name]] = row['history_id__max']
+        if date is None:
+            cache.set_latest_ids(fk_hist_model, fk_id_name, latest)
+        return latest
+
+    def _insert_numbered(self, insert, renumber):
+        """
+        Writes numbered historical records by calling insert().  If
+        another save took one of the version numbers in the meantime, the
+        unique index from get_unique_indexes() rejects the records, so
+        renumber() hands out fresh numbers and we try again.
+
+        Returns:
+            The return value of insert().
+        """
+        for attempt in range(VERSION_NUMBER_ATTEMPTS):
+            sid = transaction.savepoint()
+            try:
+                result = insert()
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                if attempt == VERSION_NUMBER_ATTEMPTS - 1:
+                    raise
+                renumber()
+                continue
+            transaction.savepoint_commit(sid)
+            return result
+
+    def _next_version_number(self, manager):
+        """
+        Returns the version number the next historical record written via
+        the provided (instance-bound) history manager should carry.
+        """
+        counts = manager.aggregate(Max('history_version_number'),
+                                   Count('history_id'))
+        latest = counts['history_version_number__max']
+        if latest is None:
+            # Historical records written before version numbers were
+            # stored.  Run the backfill_history command to number them.
+            latest = counts['history_id__count'] or 0
+        return latest + 1
+
+    def _next_version_numbers(self, model, instances):
+        """
+        Returns:
+            A list of the version numbers the next historical records of
+            instances should carry, in the same order as instances.
+        """
+        name = self._identity_column(model)
+        if name is None:
+            # Not a simple column lookup, so we can't group by it.
+            return [self._next_version_number(getattr(m, self.manager_name))
+                    for m in instances]
+
+        keys = [getattr(m, model._meta.get_field(name).attname)
+                for m in instances]
+        history = getattr(model, self.manager_name)
+        latest = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), DEFAULT_BATCH_SIZE):
+            qs = history.filter(
+                **{'%s__in' % name: unique_keys[i:i + DEFAULT_BATCH_SIZE]}
+            )
+            qs = qs.order_by().values(name).annotate(
+                Max('history_version_number'), Count('history_id'))
+            for row in qs:
+                number = row['history_version_number__max']
+                if number is None:
+                    number = row['history_id__count']
+                latest[row[name]] = number
+
+        numbers = []
+        for key in keys:
+            # The same object may appear more than once.
+            latest[key] = latest.get(key, 0) + 1
+            numbers.append(latest[key])
+        return numbers
+
+    def _lineages(self, model, instances):
+        """
+        Returns:
+            A list of the lineage of each of instances, in the same order,
+            or None for objects that don't have one yet.
+        """
+        history = getattr(model, self.manager_name)
+        name = history._pk_lookup_name()
+        pks = list(set([m.pk for m in instances]))
+        latest = {}
+        for i in range(0, len(pks), DEFAULT_BATCH_SIZE):
+            rows = history.filter(
+                **{'%s__in' % name: pks[i:i + DEFAULT_BATCH_SIZE]}
+            ).order_by('history_id').values_list(
+                name, 'history_lineage', 'history_type')
+            for pk, lineage, type in rows:
+                latest[pk] = (lineage, type)
+
+        has_uniques = bool(
+            unique_lookup_fields_for(history.model._original_model))
+        lineages = []
+        for m in instances:
+            lineage, type = latest.get(m.pk, (None, None))
+            deleted = type in (TYPE_DELETED, TYPE_REVERTED_DELETED)
+            if has_uniques and (lineage is None or deleted):
+                # A new object, or a primary key recycled by the
+                # database.  The object may have existed before, though,
+                # and been deleted, so look it up by its unique fields.
+                previous = history.filter(
+                    **unique_lookup_values_for(m)
+                ).exclude(history_lineage=None).order_by(
+                    '-history_id').values_list('history_lineage', flat=True)
+                previous = list(previous[:1])
+                lineage = previous and previous[0] or None
+            lineages.append(lineage)
+        return lineages
+
+    def _lineage_version_numbers(self, history_model, instances, lineages):
+        """
+        Returns:
+            A list of the version numbers the next historical records of
+            instances should carry, given their lineages.
+        """
+        known = list(set([l for l in lineages if l is not None]))
+        latest = {}
+        for i in range(0, len(known), DEFAULT_BATCH_SIZE):
+            qs = history_model.objects.filter(
+                history_lineage__in=known[i:i + DEFAULT_BATCH_SIZE])
+            qs = qs.order_by().values('history_lineage').annotate(
+                Max('history_version_number'), Count('history_id'))
+            for row in qs:
+                number = row['history_version_number__max']
+                if number is None:
+                    number = row['history_id__count']
+                latest[row['history_lineage']] = number
+
+        numbers = []
+        for m, lineage in zip(instances, lineages):
+            # Objects without a lineage yet are told apart by their pk.
+            key = lineage
+            if key is None:
+                key = ('pk', m.pk)
+            latest[key] = latest.get(key, 0) + 1
+            numbers.append(latest[key])
+        return numbers
+
+    def _saved_at(self, instance):
+        """
+        Returns:
+            For deferred history, the date the snapshot of the instance in
+            the outbox was taken, so that its versioned foreign keys point
+            at the versions current at the time.  Otherwise None.
+        """
+        if not self.deferred:
+            return None
+        return getattr(instance, '_save_with', {}).get('date')
 
     def _get_save_with_attrs(self, instance):
         """
@@ -514,55 +1599,56 @@ class TrackChanges(object):
             return
 
         manager = getattr(instance, self.manager_name)
+        outbox.sync(manager.model)
         for entry in manager.all():
             entry.delete()
 
 
-def _related_objs_delete_passalong(m):
-    """
-    For all related objects, set _track_changes and _save_with
-    accordingly.
+def _invalidate_cache(sender, **kws):
+    cache.invalidate(sender)
 
-    Args:
-        m: A model instance.
+
+def _release_keyframe(sender, instance, **kws):
+    delta.release_keyframe(sender, instance)
+
+
+# Only create the indexes once per syncdb, rather than once per app.
+models.signals.post_syncdb.connect(indexes.create_composite_indexes,
+                                   sender=sys.modules[__name__])
+
+
+# The stack of instances whose delete() is running in this thread,
+# innermost last.
+_deleting = threading.local()
+
+
+def _deletions():
+    if not hasattr(_deleting, 'stack'):
+        _deleting.stack = []
+    return _deleting.stack
+
+
+def _related_objs_delete_passalong(sender, instance, **kws):
+    """
+    A pre_delete signal handler.  For the objects deleted along with an
+    instance whose delete() is running, e.g. by a cascade, set
+    _track_changes and _save_with the way that delete() was called.
     """
     # We use signals here.  One alternative would be to do the
     # cascade ourselves, but we can't be sure of casade behavior.
-    def _set_arguments_for(child_m, model, ids_to_catch, instance, **kws):
-        if instance.pk in ids_to_catch:
-            instance._track_changes = child_m._track_changes
-            instance._save_with = child_m._save_with
-
-    m._rel_objs_to_catch = defaultdict(dict)
-    m._rel_objs_methods = {}
-    # Get the related objects.
-    related_objects = m._meta.get_all_related_objects()
-    related_versioned = [o for o in related_objects if is_versioned(o.model)]
-    # Using related objs, build a dictionary mapping model class -> pks
-    for rel_o in related_versioned:
-        accessor = rel_o.get_accessor_name()
-        if not hasattr(m, accessor):
-            continue
-        # OneToOneField means a single object.
-        if rel_o.field.related.field.__class__ == models.OneToOneField:
-            objs = [getattr(m, accessor)]
-        else:
-            objs = getattr(m, accessor).all()
-        for o in objs:
-            # We use a dictionary for fast lookup in
-            # _set_arguments_for
-            m._rel_objs_to_catch[o.__class__][o.pk] = True
-
-    # Construct a method that will check to see if the sender is
-    # one of the related objects
-    for model in m._rel_objs_to_catch:
-        ids_to_catch = m._rel_objs_to_catch[model]
-        _pass_on_arguments = partial(_set_arguments_for, m, model,
-            ids_to_catch)
-        models.signals.pre_delete.connect(_pass_on_arguments, sender=model,
-            weak=False)
-        # Save the method so we can disconnect it
-        m._rel_objs_methods[model] = _pass_on_arguments
+    stack = _deletions()
+    if not stack or not is_versioned(sender):
+        return
+    m = stack[-1]
+    if instance is m:
+        return
+    instance._track_changes = m._track_changes
+    instance._save_with = m._save_with
+
+
+# Connected before any TrackChanges handlers, so that they see the
+# passed along arguments.
+models.signals.pre_delete.connect(_related_objs_delete_passalong)
 
 
 def save_func(model_save):
@@ -610,5 +1696,9 @@ def delete_with_arguments(model_delete, m, using=None,
     if is_pk_recycle_a_problem(m):
         m._track_changes = False
 
-    _related_objs_delete_passalong(m)
-    return model_delete(m, using=using)
+    stack = _deletions()
+    stack.append(m)
+    try:
+        return model_delete(m, using=using)
+    finally:
+        stack.pop()
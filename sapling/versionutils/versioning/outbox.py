@@ -0,0 +1,328 @@
+"""
+Deferred writing of historical records.
+
+Models tracked with ``TrackChanges(deferred=True)`` don't write their
+historical records while the object is saved.  Instead, a snapshot of the
+object is saved as a row of the outbox table, in the same transaction as
+the object, and the outbox is drained later, in batches, by:
+
+    * the worker thread, every ``VERSIONING_OUTBOX_INTERVAL`` seconds, if
+      that's set,
+    * the ``drain_history_outbox`` management command, e.g. run by cron,
+    * reading the history of a model this thread has put records of in
+      the outbox, so that history.most_recent() returns what was just
+      saved.
+
+Records are written in the order their objects were saved, so an
+object's history, and the versions its foreign keys point at, come out
+just as if they had been written right away.
+
+The outbox rows are committed or rolled back along with the changes they
+record, so records of rolled back changes are never written, and records
+still in the outbox when the process exits are written by the next drain.
+A drain claims the rows it writes, and writes and deletes them in one
+transaction, so each record is written once, even if several drains run
+at the same time.  If writing a batch fails, its rows are left in the
+outbox for the next drain.
+"""
+import base64
+import cPickle as pickle
+import datetime
+import logging
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import models, transaction, DEFAULT_DB_ALIAS
+
+from bulk import DEFAULT_BATCH_SIZE
+from registry import FieldRegistry
+from utils import snapshot_of
+
+logger = logging.getLogger('versionutils.versioning')
+
+
+class OutboxEntry(models.Model):
+    """
+    A historical record waiting in the outbox.
+    """
+    # 'app_label.ModelName' of the model with the TrackChanges, and of
+    # the instance, which may be a subclass of it.
+    tracker = models.CharField(max_length=200)
+    model = models.CharField(max_length=200)
+    type = models.SmallIntegerField()
+    # The instance's field values and _save_with, pickled.
+    data = models.TextField()
+    # Set by the drain writing the record.
+    claim = models.CharField(max_length=32, null=True, db_index=True)
+
+    class Meta:
+        app_label = 'versioning'
+        ordering = ('id',)
+
+
+# The (database, id) of each outbox row this thread has saved since it
+# last flushed, and the number of records of each historical model among
+# them.
+_local = threading.local()
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def put(tracker, instance, type):
+    """
+    Adds a historical record of the instance, as it is now, to the
+    outbox.
+
+    Args:
+        tracker: The TrackChanges of the instance's model.
+        instance: The saved or deleted instance.
+        type: The history type to record, e.g. TYPE_UPDATED.
+    """
+    history_model = getattr(instance.__class__, tracker.manager_name).model
+    save_with = dict(getattr(instance, '_save_with', {}))
+    # The record is dated by when the object was saved, not written.
+    save_with.setdefault('date', datetime.datetime.now())
+    save_with.update(_request_values(history_model))
+    using = instance._state.db or DEFAULT_DB_ALIAS
+    entry = OutboxEntry(tracker=_label(tracker.model),
+                        model=_label(instance.__class__), type=type,
+                        data=_encode(instance, save_with))
+    entry.save(using=using)
+    ids, pending = _own()
+    ids.append((using, entry.pk))
+    pending[history_model] = pending.get(history_model, 0) + 1
+    _start_worker()
+
+
+def is_pending(history_model=None):
+    """
+    Returns:
+        True if this thread has put records of the historical model in
+        the outbox since it last flushed, or any records at all if
+        history_model is None.
+    """
+    ids, pending = _own()
+    if history_model is None:
+        return bool(ids)
+    return bool(pending.get(history_model))
+
+
+def flush():
+    """
+    Writes the historical records this thread has put in the outbox,
+    other than those another drain has written or is writing.
+    """
+    if getattr(_local, 'draining', False):
+        return
+    ids, pending = _own()
+    _local.draining = True
+    try:
+        while ids:
+            using = ids[0][0]
+            mine = [pk for db, pk in ids if db == using]
+            for i in range(0, len(mine), DEFAULT_BATCH_SIZE):
+                _drain(OutboxEntry.objects.using(using).filter(
+                    pk__in=mine[i:i + DEFAULT_BATCH_SIZE]), using)
+            ids[:] = [(db, pk) for db, pk in ids if db != using]
+        pending.clear()
+    finally:
+        _local.draining = False
+
+
+def sync(history_model=None):
+    """
+    Flushes this thread's records if it has put records of the historical
+    model in the outbox, or any records if history_model is None.
+    """
+    if is_pending(history_model):
+        flush()
+
+
+def drain(using=DEFAULT_DB_ALIAS, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Writes every historical record in the outbox, whichever thread or
+    process put it there.
+
+    Returns:
+        The number of records written.
+    """
+    written = 0
+    while True:
+        oldest = list(OutboxEntry.objects.using(using).filter(
+            claim=None).values_list('pk', flat=True)[:batch_size])
+        if not oldest:
+            return written
+        written += _drain(OutboxEntry.objects.using(using).filter(
+            pk__in=oldest), using)
+
+
+def _drain(entries, using):
+    """
+    Claims the unclaimed rows among entries, then writes their historical
+    records and deletes them, in one transaction.  If the records can't
+    be written, the rows are left in the outbox and the error is raised.
+
+    Returns:
+        The number of records written.
+    """
+    managed = transaction.is_managed(using=using)
+    if not managed:
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+    else:
+        sid = transaction.savepoint(using=using)
+    token = uuid.uuid4().hex
+    claimed = OutboxEntry.objects.using(using).filter(claim=token)
+    try:
+        entries.filter(claim=None).update(claim=token)
+        rows = list(claimed.order_by('id'))
+        for tracker, batch, type in _batches([_decode(r) for r in rows]):
+            tracker.write_historical_records(
+                [instance for pk, instance in batch], type)
+            claimed.filter(pk__in=[pk for pk, instance in batch]).delete()
+    except:
+        if not managed:
+            transaction.rollback(using=using)
+            transaction.leave_transaction_management(using=using)
+        else:
+            transaction.savepoint_rollback(sid, using=using)
+            # Without savepoints, the batches written so far stay written
+            # as part of the caller's transaction; the rest go back.
+            claimed.update(claim=None)
+        raise
+    if not managed:
+        transaction.commit(using=using)
+        transaction.leave_transaction_management(using=using)
+    else:
+        transaction.savepoint_commit(sid, using=using)
+    return len(rows)
+
+
+def _own():
+    if not hasattr(_local, 'ids'):
+        _local.ids = []
+        _local.pending = {}
+    return _local.ids, _local.pending
+
+
+def _label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def _encode(instance, save_with):
+    """
+    Returns:
+        The instance's field values and save_with, pickled into a string.
+        Model instances in save_with, e.g. the user, are kept by their
+        primary key, under the name of their foreign key's attname.
+    """
+    values = []
+    for field in instance._meta.fields:
+        value = getattr(instance, field.attname)
+        if isinstance(field, models.FileField):
+            value = value.name
+        values.append(value)
+    kept = {}
+    for name, value in save_with.iteritems():
+        if isinstance(value, models.Model):
+            name, value = '%s_id' % name, value.pk
+        kept[name] = value
+    return base64.b64encode(pickle.dumps((values, kept),
+                                         pickle.HIGHEST_PROTOCOL))
+
+
+def _decode(row):
+    """
+    Returns:
+        A (tracker, (row id, snapshot of the instance), history type)
+        tuple for the outbox row.
+    """
+    values, save_with = pickle.loads(base64.b64decode(row.data))
+    instance = models.get_model(*row.model.split('.'))(*values)
+    instance._state.adding = False
+    instance._state.db = row._state.db
+    snapshot = snapshot_of(instance)
+    snapshot._save_with = save_with
+    tracker = models.get_model(*row.tracker.split('.'))._history_tracker
+    return tracker, (row.pk, snapshot), row.type
+
+
+def _batches(records):
+    """
+    Yields (tracker, [(row id, instance), ...], type) tuples of
+    consecutive records that can be written together.  A batch never
+    holds two records of the same object, so each object's records are
+    written in order.
+    """
+    batch = []
+    seen = set()
+    for tracker, entry, type in records:
+        instance = entry[1]
+        key = (instance.__class__, instance.pk)
+        if batch:
+            last_tracker, last_entry, last_type = batch[-1]
+            if (tracker is not last_tracker or type != last_type or
+                    instance.__class__ is not last_entry[1].__class__ or
+                    key in seen):
+                yield last_tracker, [e[1] for e in batch], last_type
+                batch = []
+                seen = set()
+        batch.append((tracker, entry, type))
+        seen.add(key)
+    if batch:
+        yield batch[-1][0], [e[1] for e in batch], batch[-1][2]
+
+
+def _request_values(history_model):
+    """
+    Returns:
+        The values that pre_save handlers, e.g. AutoTrackUserInfoMiddleware,
+        fill in on historical records of the model during this request.
+        They wouldn't be around by the time the record is written, so we
+        keep them with the snapshot, keyed like _save_with.
+    """
+    fields = (FieldRegistry('user').get_fields(history_model) +
+              FieldRegistry('ip').get_fields(history_model))
+    if not fields:
+        return {}
+    stub = history_model()
+    models.signals.pre_save.send(sender=history_model, instance=stub,
+                                 raw=False, using='default')
+    values = {}
+    for field in fields:
+        value = getattr(stub, field.name)
+        if value is not None:
+            values[field.name[len('history_'):]] = value
+    return values
+
+
+def _start_worker():
+    """
+    Starts the worker thread, once per process, if
+    VERSIONING_OUTBOX_INTERVAL is set.
+    """
+    global _worker
+    interval = getattr(settings, 'VERSIONING_OUTBOX_INTERVAL', None)
+    if interval is None or _worker is not None:
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_work, args=(interval,),
+                                       name='history-outbox')
+            _worker.daemon = True
+            _worker.start()
+
+
+def _work(interval):
+    wake = threading.Event()
+    while True:
+        wake.wait(interval)
+        try:
+            drain()
+        except Exception:
+            # The records are still in the outbox, so the next drain
+            # tries again.
+            logger.exception("Couldn't write the historical records in "
+                             "the outbox")
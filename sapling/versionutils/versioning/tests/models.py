@@ -1,6 +1,6 @@
 from django.db import models
 
-from versionutils.versioning import TrackChanges
+from versionutils.versioning import TrackChanges, TrackedManager
 
 """
 TODO: It would be cool to write a little thing to randomly generate
@@ -153,6 +153,14 @@ class M17ForeignKeyVersionedCustom(models.Model):
     history = TrackChanges()
 
 
+class M17ForeignKeysVersioned(models.Model):
+    name = models.CharField(max_length=200)
+    m2 = models.ForeignKey(M2)
+    m16 = models.ForeignKey(M16Unique, null=True)
+
+    history = TrackChanges()
+
+
 class M18OneToOneFieldVersioned(models.Model):
     name = models.CharField(max_length=200)
     m2 = models.OneToOneField(M2)
@@ -173,6 +181,68 @@ class M19ManyToManyFieldVersioned(models.Model):
     history = TrackChanges()
 
 
+class M39ManyToManyBulk(models.Model):
+    a = models.TextField()
+    tags = models.ManyToManyField(LameTag)
+    objects = TrackedManager()
+
+    history = TrackChanges()
+
+
+class M34Deferred(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.IntegerField()
+    m2 = models.ForeignKey(M2, null=True)
+    objects = TrackedManager()
+
+    history = TrackChanges(deferred=True)
+
+
+class M37DeferredUniqueTogether(models.Model):
+    a = models.CharField(max_length=200)
+    b = models.IntegerField()
+    objects = TrackedManager()
+
+    history = TrackChanges(deferred=True)
+
+    class Meta:
+        unique_together = ('a', 'b')
+
+
+class M33ManyToManyThrough(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.IntegerField()
+    tags = models.ManyToManyField(LameTag, through='M33Tagging')
+
+    history = TrackChanges()
+
+
+class M33Tagging(models.Model):
+    m33 = models.ForeignKey(M33ManyToManyThrough)
+    tag = models.ForeignKey(LameTag)
+    note = models.CharField(max_length=200, blank=True)
+
+
+class M35CascadeParent(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+
+    history = TrackChanges()
+
+
+class M35CascadeChild(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    parent = models.ForeignKey(M35CascadeParent)
+
+    history = TrackChanges()
+
+
+class M35CascadeGrandchild(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    parent = models.ForeignKey(M35CascadeChild)
+
+    history = TrackChanges()
+
+
 class CustomManager(models.Manager):
     def foo(self):
         return "bar"
@@ -215,6 +285,72 @@ class M23AutoNow(models.Model):
     history = TrackChanges()
 
 
+class M27Bulk(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.IntegerField()
+    m2 = models.ForeignKey(M2, null=True)
+    objects = TrackedManager()
+
+    history = TrackChanges()
+
+
+class M28HeadTable(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.IntegerField()
+    objects = TrackedManager()
+
+    history = TrackChanges(head_table=True)
+
+
+class M29DeltaText(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.TextField(null=True)
+    objects = TrackedManager()
+
+    history = TrackChanges(delta_fields=('b',), keyframe_interval=3)
+
+
+class M30SkipUnchanged(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.IntegerField()
+    objects = TrackedManager()
+
+    history = TrackChanges(skip_unchanged=True)
+
+
+class M38SkipUnchangedAutoNow(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.DateTimeField(auto_now=True)
+    c = models.IntegerField()
+    objects = TrackedManager()
+
+    history = TrackChanges(skip_unchanged=True)
+
+
+class M31MetadataListings(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.TextField()
+    objects = TrackedManager()
+
+    history = TrackChanges(metadata_listings=True)
+
+
+class M32Lineage(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    b = models.IntegerField()
+    objects = TrackedManager()
+
+    history = TrackChanges(lineage=True)
+
+
+class M36LineageManyToMany(models.Model):
+    a = models.CharField(max_length=200, unique=True)
+    tags = models.ManyToManyField(LameTag)
+    objects = TrackedManager()
+
+    history = TrackChanges(lineage=True)
+
+
 ############################################################
 # Model inheritance test models
 ############################################################
@@ -282,9 +418,15 @@ TEST_MODELS = [
     M1, M2, M3BigInteger, M4Date, M5Decimal, M6Email, M7Numbers,
     M8Time, M9URL, M10File, M11Image, M12ForeignKey, M13ForeignKeySelf,
     M14ManyToMany, M15OneToOne, M16Unique, M17ForeignKeyVersioned,
-    M18OneToOneFieldVersioned, M19ManyToManyFieldVersioned,
+    M17ForeignKeysVersioned,
+    M18OneToOneFieldVersioned, M19ManyToManyFieldVersioned, M39ManyToManyBulk,
     M20CustomManager, M21CustomAttribute,
-    M22ManyToManySelfVersioned, M23AutoNow,
+    M22ManyToManySelfVersioned, M23AutoNow, M27Bulk,
+    M28HeadTable, M29DeltaText, M30SkipUnchanged, M38SkipUnchangedAutoNow,
+    M31MetadataListings,
+    M32Lineage, M33ManyToManyThrough, M33Tagging, M34Deferred,
+    M37DeferredUniqueTogether,
+    M35CascadeParent, M35CascadeChild, M35CascadeGrandchild,
     M24SubclassProxy, M25SubclassAbstract,
     M26SubclassConcreteA, M26ConcreteModelB,
     M26SubclassConcreteB, M26ConcreteModelC, M26SubclassConcreteC,
@@ -1,17 +1,26 @@
 import os
 import copy
 import datetime
+from StringIO import StringIO
 from decimal import Decimal
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.conf import settings
 from django.core.files import File
 from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, models, transaction, IntegrityError
 from django.utils.unittest import skipIf
 
 from utils import TestSettingsManager
 from models import *
 from versionutils.versioning.constants import *
+from versionutils.versioning.utils import (unique_lookup_values_for,
+    unique_lookup_fields_for)
+from versionutils.versioning import cache, outbox, prefetch_history_related
+from versionutils.versioning import coalesce_history
+from versionutils.versioning.indexes import composite_index_name, index_exists
+from versionutils.versioning.indexes import sql_for_composite_index
 
 mgr = TestSettingsManager()
 INSTALLED_APPS = list(settings.INSTALLED_APPS)
@@ -267,10 +276,67 @@ class TrackChangesTest(TestCase):
         for i in range(1, 100):
             v_cur = m.history.most_recent()
             date = v_cur.history_info.date
-            self.assertEqual(v_cur.history_info.version_number(), i)
+            self.assertEqual(v_cur.history_info.version_number, i)
             m.b += "."
             m.save()
 
+    def test_version_number_backfill(self):
+        m = M16Unique(a="Numbered later", b="B!", c=1)
+        m.save()
+        for i in range(2, 6):
+            m.c = i
+            m.save()
+        m.delete()
+        m = M16Unique(a="Numbered later", b="B!", c=6)
+        m.save()
+        digests = [h.history_info.digest for h in m.history.all()]
+        # Simulate records written before version numbers were stored.
+        m.history.all().update(history_version_number=None,
+                               history_digest=None)
+
+        call_command('backfill_history', 'tests.M16Unique', verbosity=0)
+        self.assertEqual(
+            [h.history_info.version_number for h in m.history.all()],
+            range(7, 0, -1)
+        )
+        self.assertEqual([h.history_info.digest for h in m.history.all()],
+                         digests)
+        m.save()
+        self.assertEqual(m.history.most_recent().history_info.version_number,
+                         8)
+
+        # Records numbered out of order swap their numbers.
+        ids = list(m.history.order_by('history_id').values_list(
+            'history_id', flat=True))
+        m.history.all().update(history_version_number=None)
+        for number, history_id in enumerate(reversed(ids)):
+            M16Unique.history.filter(history_id=history_id).update(
+                history_version_number=number + 1)
+        call_command('backfill_history', 'tests.M16Unique', verbosity=0)
+        self.assertEqual(
+            [h.history_info.version_number for h in m.history.all()],
+            range(8, 0, -1)
+        )
+
+    def test_version_number_unnumbered(self):
+        m = M16Unique(a="Not numbered yet", b="B!", c=1)
+        m.save()
+        for i in range(2, 4):
+            m.c = i
+            m.save()
+        # Simulate records written before version numbers were stored,
+        # and not yet numbered by backfill_history.
+        m.history.all().update(history_version_number=None)
+        m.c = 4
+        m.save()
+        self.assertEqual(
+            [h.history_info.version_number for h in m.history.all()],
+            [4, 3, 2, 1])
+        for version in range(1, 5):
+            self.assertEqual(m.history.as_of(version=version).c, version)
+        self.assertRaises(M16Unique.DoesNotExist, m.history.as_of,
+                          version=5)
+
     def test_version_number_grab(self):
         m = M2(a="Yay versioning!", b="Hey!", c=1)
         m.save()
@@ -283,6 +349,457 @@ class TrackChangesTest(TestCase):
             m_old = m.history.as_of(version=i)
             self.assertEqual(m_old.c, i)
 
+    def test_version_number_index(self):
+        hist_model = M16Unique.history.model
+        self.assertEqual(hist_model._composite_indexes,
+                         [('a', '-history_date', '-history_id')])
+        self.assertEqual(hist_model._unique_indexes,
+                         [('a', 'history_version_number')])
+        for field_names in hist_model._composite_indexes:
+            name = composite_index_name(hist_model, field_names, connection)
+            self.assertTrue(index_exists(name, connection))
+        name = composite_index_name(hist_model, ('a', 'history_version_number'),
+                                    connection, unique=True)
+        self.assertTrue(index_exists(name, connection))
+        # Objects with a lineage are looked up by their lineage.
+        self.assertEqual(M32Lineage.history.model._composite_indexes,
+                         [('history_lineage', '-history_date', '-history_id')])
+        self.assertEqual(M32Lineage.history.model._unique_indexes,
+                         [('history_lineage', 'history_version_number')])
+
+        # Lookups that span tables can't be covered by an index on a
+        # single table.
+        self.assertEqual(M26SubclassConcreteC.history.model._composite_indexes,
+                         [])
+        # Subclasses number their records in their parent's table.
+        self.assertEqual(M26ConcreteModelC.history.model._unique_indexes, [])
+
+    def test_version_number_taken(self):
+        m = M27Bulk(a="Taken", b=1)
+        m.save()
+        tracker = M27Bulk._history_tracker
+        # Another save of the object gets the next version number in
+        # between working it out and writing the record.
+        stale = []
+        next_version_number = tracker._next_version_number
+        next_version_numbers = tracker._next_version_numbers
+        tracker._next_version_number = lambda manager: (
+            stale and stale.pop() or next_version_number(manager))
+        tracker._next_version_numbers = lambda model, instances: (
+            stale and [stale.pop()] or
+            next_version_numbers(model, instances))
+        try:
+            stale.append(1)
+            m.b = 2
+            m.save()
+            self.assertEqual([h.history_info.version_number
+                              for h in m.history.all()], [2, 1])
+            self.assertEqual(m.history.as_of(version=2).b, 2)
+
+            # The same goes for records written in bulk.
+            stale.append(2)
+            M27Bulk.objects.filter(a="Taken").update(b=3)
+            self.assertEqual([h.history_info.version_number
+                              for h in m.history.all()], [3, 2, 1])
+        finally:
+            del tracker._next_version_number
+            del tracker._next_version_numbers
+
+    def test_composite_indexes_setting(self):
+        settings_manager = TestSettingsManager()
+        settings_manager.set(VERSIONING_INDEXES={
+            'tests.M16Unique': [('a', '-history_date')]})
+        try:
+            self.assertEqual(
+                TrackChanges().get_composite_indexes(
+                    M16Unique, M16Unique.history.model),
+                [('a', '-history_date')])
+        finally:
+            settings_manager.revert()
+        sql = sql_for_composite_index(M16Unique.history.model,
+                                      ('a', '-history_date'), connection)
+        self.assertTrue(sql.endswith('DESC);'))
+
+    def test_history_pages(self):
+        m = M16Unique(a="Paged", b="B!", c=0)
+        m.save()
+        for i in range(1, 12):
+            m.c = i
+            m.save()
+        # Two records with the same date are still ordered consistently.
+        m.history.filter(history_info__version_number__in=[5, 6]).update(
+            history_date=m.history.as_of(version=7).history_info.date)
+
+        pages = list(m.history.iter_pages(5))
+        self.assertEqual([len(p) for p in pages], [5, 5, 2])
+        numbers = [h.history_info.version_number for p in pages for h in p]
+        self.assertEqual(sorted(numbers, reverse=True), range(12, 0, -1))
+        self.assertEqual(len(set(numbers)), 12)
+
+        after = pages[0][-1].history_id
+        with self.assertNumQueries(2):
+            page = m.history.page(5, after=after)
+        self.assertEqual([h.history_id for h in page],
+                         [h.history_id for h in pages[1]])
+        self.assertEqual(m.history.page(5, after=pages[2][-1].history_id), [])
+
+    def test_snapshot(self):
+        day = lambda d: datetime.datetime(2010, 10, d)
+        m1 = M16Unique(a="Snapshot 1", b="B!", c=1)
+        m1.save(date=day(1))
+        m2 = M16Unique(a="Snapshot 2", b="B!", c=1)
+        m2.save(date=day(2))
+        m1.c = 2
+        m1.save(date=day(3))
+        m2.delete(date=day(4))
+        m3 = M16Unique(a="Snapshot 3", b="B!", c=1)
+        m3.save(date=day(5))
+
+        def snapshot(date):
+            return sorted([(h.a, h.c) for h in
+                           M16Unique.history.snapshot(date)])
+        self.assertEqual(snapshot(day(1)), [("Snapshot 1", 1)])
+        self.assertEqual(snapshot(day(2)),
+                         [("Snapshot 1", 1), ("Snapshot 2", 1)])
+        self.assertEqual(snapshot(day(3)),
+                         [("Snapshot 1", 2), ("Snapshot 2", 1)])
+        self.assertEqual(snapshot(day(4)), [("Snapshot 1", 2)])
+        with self.assertNumQueries(1):
+            self.assertEqual(snapshot(day(5)),
+                             [("Snapshot 1", 2), ("Snapshot 3", 1)])
+        self.assertEqual(len(m1.history.snapshot(day(5))), 1)
+
+        # Deleted by reverting to a deleted version.
+        deleted = m2.history.most_recent()
+        m2 = M16Unique(a="Snapshot 2", b="B!", c=1)
+        m2.save(date=day(6))
+        m2.history.as_of(version=1).revert_to(date=day(7))
+        self.assertTrue(("Snapshot 2", 1) in snapshot(day(7)))
+        deleted.revert_to(date=day(8))
+        self.assertEqual(m2.history.most_recent().history_info.type,
+                         TYPE_REVERTED_DELETED)
+        self.assertEqual(snapshot(day(8)),
+                         [("Snapshot 1", 2), ("Snapshot 3", 1)])
+
+        # The most recent record is the one with the latest date, with
+        # ties going to the last one written, as with as_of(date=..).
+        m3.c = 2
+        m3.save(date=day(10))
+        m3.c = 3
+        m3.save(date=day(9))
+        m3.c = 4
+        m3.save(date=day(10))
+        self.assertEqual(m3.history.as_of(date=day(10)).c, 4)
+        self.assertEqual(snapshot(day(10)),
+                         [("Snapshot 1", 2), ("Snapshot 3", 4)])
+        self.assertEqual(snapshot(day(9)),
+                         [("Snapshot 1", 2), ("Snapshot 3", 3)])
+
+        # Objects without unique fields are told apart by their pk.
+        other = M2(a="Snapshot", b="B!", c=1)
+        other.save(date=day(1))
+        other.c = 2
+        other.save(date=day(2))
+        self.assertEqual([h.c for h in M2.history.snapshot(day(1))], [1])
+        self.assertEqual([h.c for h in M2.history.snapshot(day(3))], [2])
+
+        sub = M26SubclassConcreteC(a="Snapshot", b="1")
+        sub.save()
+        sub.b = "2"
+        sub.save()
+        now = datetime.datetime.now()
+        self.assertEqual(
+            [h.b for h in M26SubclassConcreteC.history.snapshot(now)],
+            ["2"])
+
+    def test_lineage(self):
+        m = M32Lineage(a="Lineage", b=1)
+        m.save()
+        lineage = m.history.most_recent().history_lineage
+        self.assertEqual(lineage, m.history.most_recent().history_id)
+
+        # Renaming keeps the history together.
+        m.a = "Lineage renamed"
+        m.save()
+        self.assertEqual([h.a for h in m.history.all()],
+                         ["Lineage renamed", "Lineage"])
+        latest = m.history.most_recent()
+        self.assertEqual(latest.history_info.version_number, 2)
+        # Looked up by the lineage's value, not a subquery.
+        query = str(m.history.all().query)
+        self.assertTrue('history_lineage' in query)
+        self.assertEqual(query.count('SELECT'), 1)
+
+        # So does deleting and re-creating the object.
+        m.delete()
+        m = M32Lineage(a="Lineage renamed", b=2)
+        m.save()
+        self.assertEqual(len(m.history.all()), 4)
+        latest = m.history.most_recent()
+        self.assertEqual(latest.history_lineage, lineage)
+        self.assertEqual(latest.history_info.version_number, 4)
+
+        m.history.as_of(version=1).revert_to()
+        m = M32Lineage.objects.get(pk=m.pk)
+        self.assertEqual(m.a, "Lineage")
+        latest = m.history.most_recent()
+        self.assertEqual(latest.history_info.version_number, 5)
+
+        other = M32Lineage(a="Lineage other", b=1)
+        other.save()
+        self.assertNotEqual(other.history.most_recent().history_lineage,
+                            lineage)
+        now = datetime.datetime.now()
+        self.assertEqual(
+            sorted([h.a for h in M32Lineage.history.snapshot(now)]),
+            ["Lineage", "Lineage other"])
+
+        M32Lineage.objects.all().update(b=3)
+        self.assertEqual(len(m.history.all()), 6)
+        versions = [h.history_info.version_number
+                    for h in (m.history.most_recent(),
+                              other.history.most_recent())]
+        self.assertEqual(versions, [6, 2])
+
+        # Deleting the object by reverting to a deleted version ends its
+        # lineage, too, so a new object given the same primary key starts
+        # its own.
+        m = M32Lineage(a="Lineage reverted", b=1)
+        m.save()
+        m.delete()
+        m = M32Lineage(a="Lineage reverted", b=1)
+        m.save()
+        lineage = m.history.most_recent().history_lineage
+        m.history.get(history_type=TYPE_DELETED).revert_to()
+        self.assertEqual(m.history.most_recent().history_info.type,
+                         TYPE_REVERTED_DELETED)
+        recycled = M32Lineage(pk=m.pk, a="Lineage recycled", b=1)
+        recycled.save()
+        latest = recycled.history.most_recent()
+        self.assertNotEqual(latest.history_lineage, lineage)
+        self.assertEqual(latest.history_info.version_number, 1)
+        self.assertEqual(len(recycled.history.all()), 1)
+
+    def test_deferred(self):
+        history_model = M34Deferred.history.model
+        m2 = M2(a="deferred", b="B!", c=1)
+        m2.save()
+        m = M34Deferred(a="Deferred", b=1, m2=m2)
+        m.save(comment="first")
+        m.b = 2
+        m.save()
+        m2.c = 2
+        m2.save()
+        m.b = 3
+        m.save(comment="third")
+        self.assertTrue(outbox.is_pending(history_model))
+        self.assertEqual(len(history_model._base_manager.values('pk')), 0)
+
+        # Reading the history writes what's in the outbox first.
+        versions = list(m.history.all())
+        self.assertFalse(outbox.is_pending())
+        self.assertEqual([h.b for h in versions], [3, 2, 1])
+        self.assertEqual([h.history_info.version_number for h in versions],
+                         [3, 2, 1])
+        self.assertEqual([h.history_info.comment for h in versions],
+                         ["third", None, "first"])
+        # Foreign keys point at the version that was current at the time.
+        self.assertEqual([h.m2.c for h in versions], [2, 1, 1])
+
+        M34Deferred.objects.filter(pk=m.pk).update(b=4)
+        m.delete()
+        self.assertTrue(outbox.is_pending(history_model))
+        outbox.flush()
+        self.assertFalse(outbox.is_pending(history_model))
+        self.assertEqual(len(history_model._base_manager.values('pk')), 5)
+        self.assertEqual(M34Deferred.history.all()[0].history_info.type,
+                         TYPE_DELETED)
+
+    def test_deferred_outbox(self):
+        history_model = M34Deferred.history.model
+        tracker = M34Deferred._history_tracker
+        m = M34Deferred(a="Outbox", b=1)
+        m.save()
+        self.assertEqual(outbox.OutboxEntry.objects.count(), 1)
+
+        # Records left behind by a process that exited are written by the
+        # next drain.
+        outbox._local.__dict__.clear()
+        self.assertFalse(outbox.is_pending(history_model))
+        self.assertEqual(len(m.history.all()), 0)
+        out = StringIO()
+        call_command('drain_history_outbox', stdout=out)
+        self.assertEqual(out.getvalue(), "1 historical records written\n")
+        self.assertEqual(outbox.OutboxEntry.objects.count(), 0)
+        self.assertEqual([h.b for h in m.history.all()], [1])
+
+        # Records that fail to be written stay in the outbox.
+        m.b = 2
+        m.save()
+
+        def fail(instances, type):
+            raise IntegrityError("Failed to write")
+        tracker.write_historical_records = fail
+        try:
+            self.assertRaises(IntegrityError, outbox.drain)
+            self.assertRaises(IntegrityError, outbox.flush)
+        finally:
+            del tracker.write_historical_records
+        self.assertEqual(
+            list(outbox.OutboxEntry.objects.values_list('claim', flat=True)),
+            [None])
+        self.assertTrue(outbox.is_pending(history_model))
+        self.assertEqual([h.b for h in m.history.all()], [2, 1])
+        self.assertEqual(outbox.drain(), 0)
+
+    def test_deferred_snapshot(self):
+        history_model = M37DeferredUniqueTogether.history.model
+        m = M37DeferredUniqueTogether(a="Deferred", b=1)
+        m.save()
+        self.assertEqual(len(m.history.all()), 1)
+        m.save()
+        # Changed before the outbox is flushed.  The records in the
+        # outbox go by the object as it was saved, not as it is now.
+        m.b = 2
+        m.save()
+        outbox.flush()
+        old = M37DeferredUniqueTogether.history.filter(a="Deferred", b=1)
+        self.assertEqual([h.history_info.version_number for h in old],
+                         [2, 1])
+        self.assertEqual(
+            [h.history_info.version_number for h in m.history.all()], [1])
+
+        m.b = 3
+        m.save()
+        pk = m.pk
+        m.delete()
+        self.assertEqual(m.pk, None)
+        self.assertTrue(outbox.is_pending(history_model))
+        outbox.flush()
+        versions = M37DeferredUniqueTogether.history.filter(a="Deferred", b=3)
+        self.assertEqual([h.history_info.type for h in versions],
+                         [TYPE_DELETED, TYPE_UPDATED])
+        self.assertEqual([h.history_info.version_number for h in versions],
+                         [2, 1])
+        self.assertEqual(versions[0].id, pk)
+
+    def test_coalesce_history(self):
+        history_model = M16Unique.history.model
+        m = M16Unique(a="Coalesced", b="B!", c=1)
+        m.save()
+        with coalesce_history():
+            m.c = 2
+            m.save(comment="first")
+            m.c = 3
+            m.save(comment="second")
+            # Held back until the block exits.
+            self.assertEqual(len(m.history.all()), 1)
+        versions = list(m.history.all())
+        self.assertEqual([h.c for h in versions], [3, 1])
+        self.assertEqual([h.history_info.type for h in versions],
+                         [TYPE_UPDATED, TYPE_ADDED])
+        self.assertEqual(versions[0].history_info.comment, "first; second")
+
+        # Nested blocks are written when the outermost block exits.
+        @coalesce_history()
+        def bump(obj):
+            obj.c += 1
+            obj.save()
+        with coalesce_history():
+            bump(m)
+            bump(m)
+            self.assertEqual(len(m.history.all()), 2)
+        self.assertEqual([h.c for h in m.history.all()], [5, 3, 1])
+
+        # The records held back are looked up by the object as it was
+        # saved, even once it's deleted.
+        m2 = M2(a="Held", b="B!", c=1)
+        m2.save()
+        pk = m2.pk
+        with coalesce_history():
+            m2.a = "Held, then deleted"
+            m2.save()
+            m2.delete()
+        self.assertFalse(M2.objects.filter(pk=pk).exists())
+        versions = M2.history.filter(id=pk)
+        self.assertEqual([h.history_info.type for h in versions],
+                         [TYPE_DELETED, TYPE_ADDED])
+
+        # Objects that came and went leave no history.
+        with coalesce_history():
+            gone = M16Unique(a="Gone", b="B!", c=1)
+            gone.save()
+            gone.c = 2
+            gone.save()
+            gone.delete()
+        self.assertFalse(history_model.objects.filter(a="Gone").exists())
+
+        # Records are dropped if the block raises.
+        try:
+            with coalesce_history():
+                m.c = 6
+                m.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([h.c for h in m.history.all()], [5, 3, 1])
+
+    def test_lookup_rewriting(self):
+        m = M16Unique(a="Rewritten", b="B!", c=1)
+        m.save()
+        m.c = 2
+        m.save()
+        history = m.history
+        self.assertEqual(
+            [h.c for h in history.exclude(history_info__version_number=1)],
+            [2])
+        self.assertEqual(
+            [h.c for h in history.filter(
+                models.Q(history_info__version_number=1) |
+                models.Q(history_info__version_number=3))],
+            [1])
+        self.assertEqual(
+            [h.c for h in history.order_by('history_info__version_number')],
+            [1, 2])
+        self.assertEqual(
+            list(history.order_by('-history_info__version_number').values_list(
+                'history_info__version_number', flat=True)),
+            [2, 1])
+        self.assertEqual(
+            history.values('history_info__type')[0], {'history_type': 1})
+        # Translations are remembered.
+        self.assertEqual(
+            M16Unique.history.model._lookup_rewrites['history_info__type'],
+            'history_type')
+
+        # Lookups spanning versioned relations.
+        m2 = M2(a="Rewritten", b="B!", c=1)
+        m2.save()
+        M17ForeignKeyVersioned(name="related", m2=m2).save()
+        self.assertEqual(
+            len(M2.history.filter(m17foreignkeyversioned__name="related")),
+            1)
+        self.assertEqual(
+            len(M2.history.filter(m17foreignkeyversioned__name="other")), 0)
+
+    def test_unique_lookup_values(self):
+        m2 = M2(a="parent", b="B!", c=1)
+        m2.save()
+        m18 = M18OneToOneFieldVersioned(name="child", m2=m2)
+        m18.save()
+        m18 = M18OneToOneFieldVersioned.objects.get(pk=m18.pk)
+        # The related object's pk comes straight from the foreign key.
+        with self.assertNumQueries(0):
+            self.assertEqual(unique_lookup_values_for(m18),
+                             {'m2__id': m2.pk})
+        self.assertEqual(unique_lookup_fields_for(M18OneToOneFieldVersioned),
+                         ['m2__id'])
+        self.assertEqual(
+            unique_lookup_values_for(M16Unique(a="unique", b="B!", c=1)),
+            {'a': "unique"})
+        self.assertEqual(unique_lookup_values_for(m2), {})
+        self.assertEqual(m18.history.most_recent().name, "child")
+
     def test_version_date_grab(self):
         m = M2(a="Yay versioning!", b="Hey!", c=1)
         m.save()
@@ -301,6 +818,231 @@ class TrackChangesTest(TestCase):
             m_old = m.history.as_of(date=datetime.datetime(2010, 10, i, 10))
             self.assertEqual(m_old.c, i)
 
+    def test_bulk_history(self):
+        m2 = M2(a="bulk target", b="B!", c=1)
+        m2.save()
+        m2.c = 2
+        m2.save()
+        objs = [M27Bulk(a="bulk %d" % i, b=i, m2=m2) for i in range(20)]
+        M27Bulk.objects.bulk_create(objs)
+
+        m = M27Bulk.objects.get(a="bulk 7")
+        self.assertEqual(len(m.history.all()), 1)
+        m_h = m.history.most_recent()
+        self.assertEqual(m_h.history_info.type, TYPE_ADDED)
+        self.assertEqual(m_h.history_info.version_number, 1)
+        self.assertEqual(m_h.b, 7)
+        self.assertEqual(m_h.m2.c, 2)
+
+        m2.c = 3
+        m2.save()
+        # However many objects are updated, the number of queries stays
+        # the same.
+        with self.assertNumQueries(6):
+            M27Bulk.objects.filter(b__lt=10).update(b=100)
+        m_h = m.history.most_recent()
+        self.assertEqual(m_h.history_info.type, TYPE_UPDATED)
+        self.assertEqual(m_h.history_info.version_number, 2)
+        self.assertEqual(m_h.b, 100)
+        self.assertEqual(m_h.m2.c, 3)
+        self.assertEqual(len(M27Bulk.objects.get(a="bulk 15").history.all()),
+                         1)
+
+        # Regular saves continue numbering after the bulk update.
+        m.save()
+        self.assertEqual(m.history.most_recent().history_info.version_number,
+                         3)
+
+    def test_head_table(self):
+        m = M28HeadTable(a="head", b=0)
+        m.save()
+        head_model = M28HeadTable.history.model._head_model
+        first_head = head_model.objects.get(key=m.history.head_key())
+        for i in range(1, 5):
+            m.b = i
+            m.save()
+        head = head_model.objects.get(key=m.history.head_key())
+        # The object's row is updated in place.
+        self.assertEqual(head.pk, first_head.pk)
+        with self.assertNumQueries(1):
+            m_h = m.history.most_recent()
+        self.assertEqual(m_h.history_id, head.version_id)
+        self.assertEqual(m_h.b, 4)
+        self.assertEqual(m_h.history_info.version_number, 5)
+        self.assertEqual(m.history.most_recent(), m.history.all()[0])
+
+        # Deleting the version the head points to empties the pointer.
+        m_h.delete()
+        self.assertEqual(
+            head_model.objects.get(key=m.history.head_key()).version, None)
+        self.assertEqual(m.history.most_recent().b, 3)
+
+        m.history.as_of(version=2).revert_to(delete_newer_versions=True)
+        self.assertEqual(m.history.most_recent().b, 1)
+        self.assertEqual(m.history.most_recent().history_info.type,
+                         TYPE_REVERTED)
+
+        m.delete()
+        self.assertEqual(m.history.most_recent().history_info.type,
+                         TYPE_DELETED)
+
+        objs = [M28HeadTable(a="head %d" % i, b=i) for i in range(5)]
+        M28HeadTable.objects.bulk_create(objs)
+        M28HeadTable.objects.filter(b__lt=3).update(b=100)
+        m = M28HeadTable.objects.get(a="head 1")
+        head = head_model.objects.get(key=m.history.head_key())
+        m_h = m.history.most_recent()
+        self.assertEqual(m_h.history_id, head.version_id)
+        self.assertEqual(m_h.b, 100)
+        self.assertEqual(m_h.history_info.type, TYPE_UPDATED)
+        m = M28HeadTable.objects.get(a="head 4")
+        self.assertEqual(m.history.most_recent().history_info.type,
+                         TYPE_ADDED)
+
+    def test_delta_fields(self):
+        text = u"The quick brown fox jumps over the lazy dog. " * 20
+        m = M29DeltaText(a="delta", b=text)
+        m.save()
+        versions = [text]
+        for i in range(7):
+            text = text.replace(u"quick", u"sl\xf6w %d" % i, 1)
+            m.b = text
+            m.save()
+            versions.append(text)
+        m.b = None
+        m.save()
+        versions.append(None)
+
+        history = list(m.history.all().order_by('history_id'))
+        self.assertEqual([h.b for h in history], versions)
+        keyframes = [h.history_info.keyframe for h in history]
+        self.assertEqual(keyframes.count(None), 3)
+        # Intermediate versions store patches, not the full text.
+        raw = m.history.filter(history_id=history[1].history_id).values(
+            'b')[0]['b']
+        self.assertTrue(len(raw) < len(versions[1]) / 2)
+
+        # Deleting a keyframe re-bases the versions patched against it.
+        history[3].delete()
+        del versions[3]
+        history = list(m.history.all().order_by('history_id'))
+        self.assertEqual([h.b for h in history], versions)
+        self.assertEqual(m.history.as_of(version=5).b, versions[3])
+
+        m.history.as_of(version=2).revert_to()
+        self.assertEqual(M29DeltaText.objects.get(a="delta").b, versions[1])
+        self.assertEqual(m.history.most_recent().b, versions[1])
+
+        M29DeltaText.objects.filter(a="delta").update(b=u"Bulk")
+        self.assertEqual(m.history.most_recent().b, u"Bulk")
+
+        # Deleting a keyframe and then, using the instance loaded before,
+        # the version that took its place.
+        m = M29DeltaText(a="delta 2", b=text)
+        m.save()
+        for i in range(2):
+            m.b = text.replace(u"lazy", u"sleepy %d" % i, 1)
+            m.save()
+        history = list(m.history.all().order_by('history_id'))
+        history[0].delete()
+        history[1].delete()
+        self.assertEqual([h.b for h in m.history.all()], [m.b])
+
+    def test_skip_unchanged(self):
+        m = M30SkipUnchanged(a="same", b=1)
+        m.save()
+        m.save()
+        self.assertEqual(len(m.history.all()), 1)
+        m.b = 2
+        m.save()
+        self.assertEqual(len(m.history.all()), 2)
+        self.assertEqual(m.history.most_recent().history_info.version_number,
+                         2)
+
+        other = M30SkipUnchanged(a="other", b=2)
+        other.save()
+        M30SkipUnchanged.objects.all().update(b=2)
+        self.assertEqual(len(m.history.all()), 2)
+        self.assertEqual(len(other.history.all()), 1)
+        M30SkipUnchanged.objects.filter(a="same").update(b=3)
+        self.assertEqual(len(m.history.all()), 3)
+        self.assertEqual(len(other.history.all()), 1)
+
+        m = M30SkipUnchanged.objects.get(a="same")
+        m.delete()
+        self.assertEqual(m.history.most_recent().history_info.type,
+                         TYPE_DELETED)
+        m.save()
+        self.assertEqual(m.history.most_recent().history_info.type,
+                         TYPE_ADDED)
+
+    def test_skip_unchanged_auto_now(self):
+        m = M38SkipUnchangedAutoNow(a="auto now", c=1)
+        m.save()
+        m.save()
+        M38SkipUnchangedAutoNow.objects.all().update(c=1)
+        self.assertEqual(len(m.history.all()), 1)
+        m.c = 2
+        m.save()
+        versions = m.history.all()
+        self.assertEqual([h.c for h in versions], [2, 1])
+        # The field is still recorded, just not digested.
+        self.assertEqual(versions[0].b, m.b)
+
+    def test_metadata_only(self):
+        m = M31MetadataListings(a="Listed", b="Long text " * 100)
+        m.save()
+        m.b = "Longer text " * 100
+        m.save()
+        with self.assertNumQueries(1):
+            history = m.history.page(10)
+            self.assertEqual([h.history_info.version_number for h in history],
+                             [2, 1])
+        # The other fields are loaded when they're accessed.
+        with self.assertNumQueries(1):
+            self.assertEqual(history[1].b, "Long text " * 100)
+        self.assertEqual(history[0].a, "Listed")
+        self.assertEqual(history[0].history_info._object.b,
+                         "Longer text " * 100)
+        # Listings only.
+        self.assertEqual(m.history.all()[0].__dict__['b'],
+                         "Longer text " * 100)
+        self.assertEqual(m.history.as_of(version=1).__dict__['b'],
+                         "Long text " * 100)
+
+        m2 = M2(a="Metadata", b="Text", c=1)
+        m2.save()
+        M17ForeignKeyVersioned(name="related", m2=m2).save()
+        m2.save()
+        self.assertTrue('b' in m2.history.most_recent().__dict__)
+        m2_h = m2.history.metadata().most_recent()
+        self.assertFalse('b' in m2_h.__dict__)
+        self.assertEqual(m2_h.b, "Text")
+        # Reverse lookups on historical instances still work.
+        self.assertEqual(len(m2_h.m17foreignkeyversioned_set.all()), 1)
+        self.assertEqual(len(m2.history.metadata().all()), 2)
+
+    def test_identical_to(self):
+        m = M16Unique(a="Same again", b="B!", c=1)
+        m.save()
+        m.c = 2
+        m.save()
+        m.c = 1
+        m.save()
+        history = list(m.history.all().order_by('history_id'))
+        self.assertEqual(history[0].history_info.digest,
+                         history[2].history_info.digest)
+        self.assertNotEqual(history[0].history_info.digest,
+                            history[1].history_info.digest)
+        self.assertEqual(
+            [h.history_id for h in m.history.identical_to(history[0])],
+            [history[2].history_id, history[0].history_id]
+        )
+        other = M16Unique(a="Different", b="B!", c=1)
+        other.save()
+        self.assertEqual(
+            len(M16Unique.history.identical_to(history[0])), 2)
+
     def test_revert_to(self):
         m = M2(a="Sup", b="Dude", c=0)
         m.save()
@@ -638,6 +1380,189 @@ class TrackChangesTest(TestCase):
         tags = m19_h.tags.all()
         self.assertEqual(set([t.name for t in tags]), set(["T1", "T2"]))
 
+    def test_manytomany_sync(self):
+        tags = []
+        for i in range(20):
+            t = LameTag(name="sync %d" % i)
+            t.save()
+            tags.append(t)
+        m19 = M19ManyToManyFieldVersioned(a="synced")
+        m19.save()
+        # Django adds each row on its own, but the historical rows are
+        # looked up and written all at once.
+        with self.assertNumQueries(len(tags) + 5):
+            m19.tags.add(*tags)
+        m19_h = m19.history.most_recent()
+        self.assertEqual(len(m19_h.tags.all()), 20)
+
+        m19.tags.remove(*tags[:10])
+        self.assertEqual(len(m19_h.tags.all()), 10)
+        m19.tags.clear()
+        self.assertEqual(len(m19_h.tags.all()), 0)
+
+        # Changes from the other side of the relation.
+        tags[0].m19manytomanyfieldversioned_set.add(m19)
+        self.assertEqual([t.name for t in m19_h.tags.all()], ["sync 0"])
+        tags[0].m19manytomanyfieldversioned_set.clear()
+        self.assertEqual(len(m19_h.tags.all()), 0)
+
+        # Rows of an explicit through model.
+        m33 = M33ManyToManyThrough(a="through", b=1)
+        m33.save()
+        tagging = M33Tagging(m33=m33, tag=tags[0], note="first")
+        tagging.save()
+        m33_h = m33.history.most_recent()
+        self.assertEqual([t.name for t in m33_h.tags.all()], ["sync 0"])
+        m33.b = 2
+        m33.save()
+        tagging.delete()
+        self.assertEqual(len(m33.history.most_recent().tags.all()), 0)
+        self.assertEqual(len(m33.history.as_of(version=1).tags.all()), 1)
+
+        # A row saved again pointing at another object moves the link.
+        tagging = M33Tagging(m33=m33, tag=tags[0])
+        tagging.save()
+        tagging.tag = tags[2]
+        tagging.save()
+        self.assertEqual(
+            [t.name for t in m33.history.most_recent().tags.all()],
+            ["sync 2"])
+        tagging.delete()
+
+        # Deleting the object doesn't change its last version's relation.
+        M33Tagging(m33=m33, tag=tags[1]).save()
+        m33.b = 3
+        m33.save()
+        m33.delete()
+        m33_h = M33ManyToManyThrough.history.get(
+            b=3, history_type=TYPE_UPDATED)
+        self.assertEqual([t.name for t in m33_h.tags.all()], ["sync 1"])
+
+    def test_manytomany_carried_forward(self):
+        tags = []
+        for i in range(20):
+            t = LameTag(name="carried %d" % i)
+            t.save()
+            tags.append(t)
+        m19 = M19ManyToManyFieldVersioned(a="carried")
+        m19.save()
+        m19.tags.add(*tags)
+
+        def saved_tags():
+            return sorted([t.name for t in
+                           m19.history.most_recent().tags.all()])
+
+        # The relation is copied in a single query, however many related
+        # objects there are.
+        m19.a += "!"
+        with self.assertNumQueries(6):
+            m19.save()
+        self.assertEqual(len(saved_tags()), 20)
+
+        # The copies point at the related objects' latest versions.
+        tags[0].name += "!"
+        tags[0].save()
+        tags[1].delete()
+        m19.save()
+        self.assertEqual(saved_tags()[:2], ["carried 0!", "carried 10"])
+        self.assertEqual(len(saved_tags()), 19)
+        # Earlier versions are left alone.
+        names = [t.name for t in m19.history.as_of(version=2).tags.all()]
+        self.assertTrue("carried 0" in names)
+
+        # Bulk updates carry it forward, too.
+        m39 = M39ManyToManyBulk(a="carried")
+        m39.save()
+        m39.tags.add(*tags[2:])
+        M39ManyToManyBulk.objects.filter(pk=m39.pk).update(
+            a="carried in bulk")
+        latest = m39.history.most_recent()
+        self.assertEqual(latest.a, "carried in bulk")
+        self.assertEqual(len(latest.tags.all()), 18)
+
+    def test_manytomany_carried_forward_lineage(self):
+        tag = LameTag(name="lineage tag")
+        tag.save()
+        for i in range(10):
+            m = M36LineageManyToMany(a="lineage carried %d" % i)
+            m.save()
+            m.tags.add(tag)
+
+        # Objects with lineages are looked up in bulk, too, so the number
+        # of queries doesn't grow with the number of objects.
+        pks = list(M36LineageManyToMany.objects.values_list('pk', flat=True))
+        for some in (pks[:2], pks):
+            qs = M36LineageManyToMany.objects.filter(pk__in=some)
+            with self.assertNumQueries(9):
+                qs.update(a=models.F('a'))
+        for m in M36LineageManyToMany.objects.all():
+            self.assertEqual(
+                [t.name for t in m.history.most_recent().tags.all()],
+                ["lineage tag"])
+
+    def test_fk_version_lookup_queries(self):
+        m2 = M2(a="target", b="B!", c=0)
+        m2.save()
+        m = M17ForeignKeyVersioned(name="pointer", m2=m2)
+        m.save()
+        for i in range(10):
+            m2.c = i
+            m2.save()
+        # The cost of a save doesn't depend on how long the related
+        # object's history is.
+        with self.assertNumQueries(5):
+            m.save()
+
+        cache.enable()
+        try:
+            m.save()
+            # The related object's most recent version is now cached.
+            with self.assertNumQueries(4):
+                m.save()
+            # Saving the related object invalidates the cache.
+            m2.c = 100
+            m2.save()
+            m.save()
+            self.assertEqual(m.history.most_recent().m2.c, 100)
+        finally:
+            cache.disable()
+
+    def test_identity_map(self):
+        m2 = M2(a="mapped", b="B!", c=0)
+        m2.save()
+        m17 = M17ForeignKeyVersioned(name="pointer", m2=m2)
+        m17.save()
+        cache.enable()
+        try:
+            m2_h = m2.history.most_recent()
+            with self.assertNumQueries(0):
+                self.assertEqual(m2.history.most_recent(), m2_h)
+                self.assertEqual(
+                    M2.history.get(history_id=m2_h.history_id), m2_h)
+            # Each caller gets its own copy.
+            m2_h.c = 100
+            m2_h.history_info._object.b = "Changed"
+            with self.assertNumQueries(0):
+                self.assertEqual(m2.history.most_recent().c, 0)
+                self.assertEqual(
+                    m2.history.most_recent().history_info._object.b, "B!")
+                self.assertFalse(m2.history.most_recent() is
+                                 m2.history.most_recent())
+            m17_h = M17ForeignKeyVersioned.history.get(
+                history_id=m17.history.most_recent().history_id)
+            # Reconstructing the object doesn't need the related record.
+            with self.assertNumQueries(0):
+                self.assertEqual(m17_h.history_info._object.m2_id, m2.pk)
+
+            # Writing a historical record invalidates the map.
+            m2.c = 1
+            m2.save()
+            self.assertEqual(m2.history.most_recent().c, 1)
+        finally:
+            cache.disable()
+        with self.assertNumQueries(1):
+            m2.history.most_recent()
+
     def test_fk_to_self_hist_lookup(self):
         m = M13ForeignKeySelf(a=None, b="Yo!")
         m.save()
@@ -660,6 +1585,82 @@ class TrackChangesTest(TestCase):
         # Test with a specified related_name
         #m12related = M12ForeignKeyRelatedSpecified()
 
+    def test_attribute_access(self):
+        m2 = M2(a="fast", b="attributes", c=1)
+        m2.save()
+        m2_h = m2.history.most_recent()
+        # Fields are read as on any other model, without an override of
+        # attribute access in the way.
+        self.assertFalse('__getattribute__' in m2_h.__class__.__dict__)
+        with self.assertNumQueries(0):
+            self.assertEqual((m2_h.a, m2_h.b, m2_h.c, m2_h.pk),
+                             (m2.a, m2.b, m2.c, m2_h.history_id))
+
+    def test_historical_object(self):
+        m2 = M2(a="object", b="reconstructed", c=1)
+        m2.save()
+        m17 = M17ForeignKeyVersioned(name="points at m2", m2=m2)
+        m17.save()
+        m17_h = m17.history.most_recent()
+        with self.assertNumQueries(1):
+            obj = m17_h.history_info._object
+            self.assertEqual(obj.m2_id, m2.pk)
+            self.assertTrue(m17_h.history__object is obj)
+        self.assertEqual(obj.name, "points at m2")
+
+        # Reverting changes the object, so it's not handed out again.
+        m17_h.revert_to()
+        self.assertFalse(m17_h.history_info._object is obj)
+
+        # The pks of the foreign keys are looked up together.
+        m16 = M16Unique(a="pointed at", b="B!", c=1)
+        m16.save()
+        m17s = M17ForeignKeysVersioned(name="two", m2=m2, m16=m16)
+        m17s.save()
+        m17s_h = M17ForeignKeysVersioned.history.get(
+            history_id=m17s.history.most_recent().history_id)
+        with self.assertNumQueries(1):
+            obj = m17s_h.history_info._object
+        self.assertEqual((obj.m2_id, obj.m16_id), (m2.pk, m16.pk))
+
+        # The related historical record is gone.
+        M17ForeignKeysVersioned.history.all().update(m16=0)
+        m17s_h = M17ForeignKeysVersioned.history.get(
+            history_id=m17s_h.history_id)
+        self.assertRaises(M16Unique.history.model.DoesNotExist,
+                          getattr, m17s_h.history_info, '_object')
+
+    def test_prefetch_history_related(self):
+        m2 = M2(a="prefetched", b="b", c=0)
+        m2.save()
+        other = M2(a="other", b="b", c=0)
+        other.save()
+        m17 = M17ForeignKeyVersioned(name="first", m2=m2)
+        m17.save()
+        M17ForeignKeyVersioned(name="other's", m2=other).save()
+        m2.c = 1
+        m2.save()
+        m17.name = "first!"
+        m17.save()
+        M17ForeignKeyVersioned(name="second", m2=m2).save()
+        m2.c = 2
+        m2.save()
+        other.c = 1
+        other.save()
+
+        instances = list(M2.history.all())
+        expected = [sorted([h.name for h in
+                            M2.history.get(history_id=m.history_id).
+                            m17foreignkeyversioned_set])
+                    for m in instances]
+        self.assertEqual(expected[0], ["other's"])
+        self.assertEqual(expected[1], ["first!", "second"])
+        with self.assertNumQueries(1):
+            prefetch_history_related(instances, 'm17foreignkeyversioned_set')
+            names = [sorted([h.name for h in m.m17foreignkeyversioned_set])
+                     for m in instances]
+        self.assertEqual(names, expected)
+
     def test_fk_reverse_lookup(self):
         # Reverse foreign key lookups on historical models should,
         # if the parent model is versioned, return the related set
@@ -674,6 +1675,10 @@ class TrackChangesTest(TestCase):
         # of the most recent historical version of m2 should be
         # empty
         m2_h = m2.history.most_recent()
+        # The lookup is set up once, on the historical model.
+        self.assertFalse('m17foreignkeyversioned_set' in m2_h.__dict__)
+        self.assertTrue('m17foreignkeyversioned_set' in
+                        M2.history.model._reverse_lookups)
         self.assertEqual(len(m2_h.m17foreignkeyversioned_set.all()), 0)
 
         m2.a += "!"
@@ -732,6 +1737,40 @@ class TrackChangesTest(TestCase):
         latest_m12 = M12ForeignKey.history.filter(b="i am the parent 2")[0]
         self.assertNotEqual(latest_m12.history_info.type, TYPE_DELETED)
 
+    def test_delete_passalong(self):
+        parent = M35CascadeParent(a="parent")
+        parent.save()
+        child = M35CascadeChild(a="child", parent=parent)
+        child.save()
+        M35CascadeGrandchild(a="grandchild", parent=child).save()
+        receivers = len(models.signals.pre_delete.receivers)
+
+        parent.delete(comment="the comment")
+        self.assertEqual(len(models.signals.pre_delete.receivers), receivers)
+        # The delete's arguments are passed along the whole cascade.
+        for model in (M35CascadeChild, M35CascadeGrandchild):
+            hm = model.history.all()[0]
+            self.assertEqual(hm.history_info.type, TYPE_DELETED)
+            self.assertEqual(hm.history_info.comment, "the comment")
+
+        parent = M35CascadeParent(a="parent 2")
+        parent.save()
+        M35CascadeChild(a="child 2", parent=parent).save()
+        parent.delete(track_changes=False)
+        self.assertEqual(len(models.signals.pre_delete.receivers), receivers)
+        hm = M35CascadeChild.history.filter(a="child 2")[0]
+        self.assertEqual(hm.history_info.type, TYPE_ADDED)
+
+        # Deleting on its own doesn't pick up an earlier delete's arguments.
+        parent = M35CascadeParent(a="parent 3")
+        parent.save()
+        child = M35CascadeChild(a="child 3", parent=parent)
+        child.save()
+        M35CascadeChild.objects.filter(pk=child.pk).delete()
+        hm = M35CascadeChild.history.filter(a="child 3")[0]
+        self.assertEqual(hm.history_info.type, TYPE_DELETED)
+        self.assertEqual(hm.history_info.comment, None)
+
     def test_fk_reverse_proper_instance(self):
         """
         If we have
@@ -930,3 +1969,109 @@ class TrackChangesTest(TestCase):
 #
 #        pass
 #
+
+
+class CoalesceHistoryTransactionTest(TransactionTestCase):
+    # TestCase doesn't let transactions commit or roll back.
+    def test_nested_rollback(self):
+        m = M16Unique(a="Rolled back", b="B!", c=1)
+        m.save()
+        try:
+            with coalesce_history():
+                with coalesce_history():
+                    m.c = 2
+                    m.save()
+                # The nested block didn't commit, so its change is rolled
+                # back along with its held back record.
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(M16Unique.objects.get(pk=m.pk).c, 1)
+        self.assertEqual([h.c for h in m.history.all()], [1])
+
+        # A nested block that raises leaves its changes to the outer
+        # block, and its records, too.
+        with coalesce_history():
+            try:
+                with coalesce_history():
+                    m.c = 3
+                    m.save()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(M16Unique.objects.get(pk=m.pk).c, 3)
+        self.assertEqual([h.c for h in m.history.all()], [3, 1])
+
+
+class DeferredHistoryTransactionTest(TransactionTestCase):
+    # TestCase doesn't let transactions commit or roll back.
+    def test_rollback(self):
+        m = M34Deferred(a="Rolled back", b=1)
+        m.save()
+        try:
+            with transaction.commit_on_success():
+                m.b = 2
+                m.save()
+                raise ValueError
+        except ValueError:
+            pass
+        # The record of the rolled back save went with it.
+        self.assertEqual(outbox.OutboxEntry.objects.count(), 1)
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([h.b for h in m.history.all()], [1])
+
+
+class CheckHistoryIndexesTest(TransactionTestCase):
+    # SQLite commits the transaction before running EXPLAIN.
+    def test_check_history_indexes(self):
+        m = M16Unique(a="Checked", b="B!", c=1)
+        m.save()
+        out = StringIO()
+        call_command('check_history_indexes', 'tests.M16Unique',
+                     verbosity=2, stdout=out)
+        lines = out.getvalue().splitlines()
+        # One line per lookup, then the total.
+        lookups = ['history.all()', 'history.most_recent()',
+                   'history.as_of(date=..)', 'history.as_of(version=..)',
+                   'history.page(..)']
+        self.assertEqual(len(lines), len(lookups) + 1)
+        unindexed = 0
+        for lookup, line in zip(lookups, lines):
+            self.assertTrue(line.startswith('M16Unique: %s is' % lookup))
+            if "isn't indexed: " in line:
+                unindexed += 1
+            else:
+                self.assertTrue(line.endswith(' is indexed'))
+        self.assertEqual(lines[-1], "%d unindexed history lookups" % unindexed)
+
+        # Without history, there's nothing to explain.
+        M16Unique.history.all().delete()
+        out = StringIO()
+        call_command('check_history_indexes', 'tests.M16Unique', stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[0],
+                         "M16Unique: no historical records, skipped")
+
+    @skipIf(connection.vendor != 'sqlite', "Reads SQLite's index list")
+    def test_history_indexes_exist(self):
+        history_model = M16Unique.history.model
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA index_list(%s)' %
+                       qn(history_model._meta.db_table))
+        # seq, name, unique, ...
+        unique = dict((row[1], bool(row[2])) for row in cursor.fetchall())
+
+        def columns(index_name):
+            cursor.execute('PRAGMA index_info(%s)' % qn(index_name))
+            # seqno, cid, name
+            return [row[2] for row in cursor.fetchall()]
+
+        name = composite_index_name(
+            history_model, ('a', '-history_date', '-history_id'), connection)
+        self.assertEqual(unique.get(name), False)
+        self.assertEqual(columns(name), ['a', 'history_date', 'history_id'])
+        name = composite_index_name(
+            history_model, ('a', 'history_version_number'), connection,
+            unique=True)
+        self.assertEqual(unique.get(name), True)
+        self.assertEqual(columns(name), ['a', 'history_version_number'])
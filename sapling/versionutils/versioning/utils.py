@@ -1,9 +1,13 @@
+import copy
+import hashlib
 from collections import defaultdict
 from functools import partial
 
 from django.db import models
 from django.conf import settings
 from django.db.models.sql.constants import LOOKUP_SEP
+from django.db.models.loading import app_cache_ready
+from django.utils.encoding import force_unicode
 
 
 def is_versioned(m):
@@ -37,6 +41,16 @@ def is_directly_versioned(m):
     return (hist_manager.model._original_model == m.__class__)
 
 
+def directly_versioned_models():
+    """
+    Returns:
+        A list of all installed model classes that have TrackChanges on
+        their own class definition, and therefore their own historical
+        model.
+    """
+    return [m for m in models.get_models() if is_directly_versioned(m)]
+
+
 def is_historical_instance(m):
     """
     Is the provided instance a historical instance?
@@ -74,7 +88,62 @@ def unique_lookup_values_for(m):
         A {name: value} dictionary of the unique fields of the
         model instance m.
     """
-    for field in m._meta.fields:
+    values = {}
+    parent_values = {}
+    for lookup, attname, field in _identity_plan(m.__class__):
+        if attname is not None:
+            values[lookup] = getattr(m, attname)
+            continue
+        # The lookup goes through a versioned OneToOneField to a unique
+        # field of the related object, so we need the related object.
+        if field.name not in parent_values:
+            parent_values[field.name] = unique_lookup_values_for(
+                getattr(m, field.name))
+        parent_lookup = lookup.split(LOOKUP_SEP, 1)[1]
+        values[lookup] = parent_values[field.name][parent_lookup]
+    return values
+
+
+def unique_lookup_fields_for(model):
+    """
+    The class-level counterpart of unique_lookup_values_for.
+
+    Args:
+        model: A model class.
+
+    Returns:
+        A list of the lookup names (keys) unique_lookup_values_for returns
+        for instances of model, or an empty list if the model has no
+        unique fields.
+    """
+    return [lookup for lookup, attname, field in _identity_plan(model)]
+
+
+_identity_plans = {}
+
+
+def _identity_plan(model):
+    """
+    Works out which fields identify instances of model, once per model.
+
+    Returns:
+        A list of (lookup, attname, field) tuples, one per lookup
+        unique_lookup_values_for returns.  The value of the lookup is
+        the instance's attname attribute or, if attname is None, comes
+        from the unique fields of the object the versioned OneToOneField
+        field points to.
+    """
+    if model in _identity_plans:
+        return _identity_plans[model]
+    plan = _make_identity_plan(model)
+    # Related models may not be set up until all the models are loaded.
+    if app_cache_ready():
+        _identity_plans[model] = plan
+    return plan
+
+
+def _make_identity_plan(model):
+    for field in model._meta.fields:
         if field.primary_key or field.auto_created:
             continue
         if not field.unique:
@@ -92,53 +161,111 @@ def unique_lookup_values_for(m):
             # p.history.filter(fk=historical_fk).  To build this unique
             # dictionary we need to use the pk of the provided
             # NON-historical object, m.
+            parent_model = field.related.parent_model
+            parent_plan = _identity_plan(parent_model)
+            if not parent_plan:
+                # E.g. {'page__id': 3}, which we can read right off the
+                # foreign key without fetching the page.
+                pk_name = parent_model._meta.pk.name
+                return [("%s%s%s" % (field.name, LOOKUP_SEP, pk_name),
+                         field.attname, None)]
+            # Something like {'page__slug': 'front page'}
+            return [("%s%s%s" % (field.name, LOOKUP_SEP, parent_lookup),
+                     None, field)
+                    for parent_lookup, a, f in parent_plan]
 
-            # Get the unique fields of the related model.
-            uniques = {}
-            # tring to getattr MapData, page
-            parent_instance = getattr(m, field.name)
-            parent_unique = unique_lookup_values_for(parent_instance)
-            if not parent_unique:
-                # E.g. {'id': 3}
-                parent_pk_name = parent_instance._meta.pk.name
-                parent_unique = {parent_pk_name: parent_instance.pk}
-
-            for parent_k, parent_v in parent_unique.iteritems():
-                # Create something like {'page__id': 3} or
-                # {'page__slug': 'front page'}
-                k = "%s%s%s" % (field.name, LOOKUP_SEP, parent_k)
-                uniques[k] = parent_v
-            return uniques
-
-        return {field.name: getattr(m, field.name)}
-
-    if m._meta.unique_together:
-        unique_fields = {}
-        # See note about OneToOneFields above.
-        onetoone_versioned = []
-        for field in m._meta.fields:
-            is_onetoone = (
-                hasattr(field, 'related') and
-                field.related.field.__class__ == models.OneToOneField
-            )
-            if is_onetoone and is_versioned(field.related.model):
-                onetoone_versioned.append(field.name)
+        return [(field.name, field.attname, None)]
 
+    plan = []
+    if model._meta.unique_together:
         # Tuple of field names, e.g. ('email', 'cellphone')
-        for k in m._meta.unique_together[0]:
-            # Do fancy lookup for versioned OneToOneFields.
-            if k in onetoone_versioned:
-                k = "%s%sid" % (field.name, LOOKUP_SEP)
-                v = getattr(m, field.name).pk
-                unique_fields[k] = v
+        for k in model._meta.unique_together[0]:
+            field = model._meta.get_field(k)
+            # See note about OneToOneFields above.
+            is_onetoone = isinstance(field, models.OneToOneField)
+            if is_onetoone and is_versioned(field.rel.to):
+                pk_name = field.rel.to._meta.pk.name
+                plan.append(("%s%s%s" % (k, LOOKUP_SEP, pk_name),
+                             field.attname, None))
             else:
-                unique_fields[k] = getattr(m, k)
-        return unique_fields
+                plan.append((k, field.attname, None))
+    return plan
+
+
+def head_key_for(lookup):
+    """
+    Args:
+        lookup: A {name: value} dictionary identifying an object, as used
+            by HistoryManager to look up the object's history.
+
+    Returns:
+        A SHA-1 hex digest of the lookup, used as the key of the object's
+        row in the head table.
+    """
+    return _digest(sorted(lookup.items()))
+
+
+def digest_of(m):
+    """
+    Args:
+        m: A model instance.
+
+    Returns:
+        A SHA-1 hex digest of the values of the model instance's
+        digested fields.
+    """
+    return _digest([(f.attname, getattr(m, f.attname))
+                    for f in digested_fields(m.__class__)])
+
+
+def digested_fields(model):
+    """
+    Args:
+        model: A model class.
+
+    Returns:
+        The fields of the model that digest_of() covers.  Like diff(),
+        this ignores AutoFields.  auto_now fields are left out, too: they
+        change on every save, so saving an object without changing it
+        would change its digest.
+    """
+    return [f for f in model._meta.fields
+            if not isinstance(f, models.AutoField) and
+            not getattr(f, 'auto_now', False)]
+
+
+def _digest(items):
+    parts = []
+    for k, v in items:
+        if isinstance(v, models.Model):
+            v = v.pk
+        if v is None:
+            parts.append(force_unicode(k))
+        else:
+            parts.append(u'%s=%s' % (k, force_unicode(v)))
+    return hashlib.sha1(u'\x00'.join(parts).encode('utf-8')).hexdigest()
+
+
+def snapshot_of(m):
+    """
+    Args:
+        m: A model instance.
+
+    Returns:
+        A copy of the model instance as it is now, to write a historical
+        record of later.  The history manager cached on m is left out, so
+        the copy's history is looked up by the copy's own values, even
+        if m is changed or deleted in the meantime.
+    """
+    snapshot = copy.copy(m)
+    snapshot._state = copy.copy(m._state)
+    snapshot.__dict__.pop('_history_manager', None)
+    return snapshot
 
 
 def is_pk_recycle_a_problem(instance):
     if (settings.DATABASE_ENGINE == 'sqlite3' and
-        not unique_lookup_values_for(instance)):
+        not unique_lookup_fields_for(instance.__class__)):
         return True
 
 